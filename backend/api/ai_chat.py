@@ -1,6 +1,7 @@
 # api/ai_chat.py
 from flask import Blueprint, request, jsonify
 from services.ai_service import process_chat
+from services import claude_dispatcher
 from user_store import get_user_by_session  # Optional: used to verify the user exists
 
 ai_chat_bp = Blueprint('ai_chat', __name__)
@@ -26,3 +27,8 @@ def ai_chat():
         return jsonify({'response': answer})
     except Exception as e:
         return jsonify({'error': str(e)}), 400
+
+@ai_chat_bp.route('/stats', methods=['GET'])
+def ai_chat_stats():
+    # Claude dispatcher queue depth, admission wait times and rate-limit state.
+    return jsonify(claude_dispatcher.stats())
@@ -4,17 +4,16 @@ import logging
 import os
 import base64
 from flask import Blueprint, jsonify, request
-import anthropic  # Import Anthropic for Claude AI
+import user_store
 from user_store import update_user_analysis, get_user_by_session
 from supabase_client import supabase  # Use your existing Supabase client
 from dotenv import load_dotenv
 import datetime
-import re
+import threading
+import time
 
 # Import for handling Google OAuth errors.
 from google.auth.exceptions import RefreshError
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
 from services.gmail_service import (
@@ -24,8 +23,24 @@ from services.gmail_service import (
     tag_email,
     analyze_user_emails,
     _get_gmail_service,  # used in endpoints with an active session
-    get_email_by_id,     # used to fetch full email details
+    find_draft_for_thread,
+    forget_draft,
+    get_thread_id_for_message,
+    get_thread,
+    get_thread_cache_stats,
 )
+from services.google_clients import get_service, invalidate_user
+from services import mailbox_mirror
+from services import async_google
+from services import claude_dispatcher
+from services import classification_cache
+from services import backfill
+from services import preclassifier
+from services import dedup_store
+from services import mailbox_lanes
+from services.anthropic_client import get_anthropic_client
+from services.async_google import AsyncGoogleClient
+from services.classification_engine import run_classification, persist_state
 
 from utils.supabae_utils import get_token_from_supabase
 
@@ -36,62 +51,21 @@ logging.getLogger("httpcore").setLevel(logging.INFO)
 logger = logging.getLogger(__name__)
 emails_bp = Blueprint('emails', __name__)
 
-def strip_html_tags(text):
+def get_gmail_service_for_user(email, token=None):
     """
-    Remove HTML tags from a given string using a simple regular expression.
+    Retrieves the stored OAuth token for the given user (from Supabase, unless the
+    caller already has it) and returns a (cached) Gmail API service.
     """
-    # This regex finds anything within angle brackets.
-    return re.sub(r'<[^>]*>', '', text)
-
-def extract_email_content(email_detail):
-    """
-    Helper to extract subject, sender, and plain text body from email_detail.
-    Only returns the relevant text.
-    """
-    headers = email_detail.get("payload", {}).get("headers", [])
-    subject = next((h["value"] for h in headers if h["name"].lower() == "subject"), "")
-    from_email = next((h["value"] for h in headers if h["name"].lower() == "from"), "")
-    body_data = email_detail.get("payload", {}).get("body", {}).get("data", "")
-
-    if body_data:
-        try:
-            # Decode the body from base64.
-            body_text = base64.urlsafe_b64decode(body_data.encode("UTF-8")).decode("utf-8", errors="ignore")
-        except Exception as decode_error:
-            logger.error("Error decoding email body: %s", decode_error)
-            body_text = email_detail.get("snippet", "")
-    else:
-        body_text = email_detail.get("snippet", "")
-
-    # Strip HTML tags from the body text to get plain text.
-    plain_body_text = strip_html_tags(body_text).strip()
-
-    return subject, from_email, plain_body_text
-
-def get_gmail_service_for_user(email):
-    """
-    Retrieves the stored OAuth token for the given user (from Supabase)
-    and builds a Gmail API service.
-    """
-    user_resp = supabase.table("users").select("token").eq("email", email).single().execute()
-    if not user_resp.data:
-        raise Exception(f"User with email {email} not found in Supabase.")
-    token = user_resp.data.get("token")
+    if token is None:
+        user_resp = supabase.table("users").select("token").eq("email", email).single().execute()
+        if not user_resp.data:
+            raise Exception(f"User with email {email} not found in Supabase.")
+        token = user_resp.data.get("token")
     if not token:
         raise Exception("No token available for user.")
     if not token.get("refresh_token"):
         raise Exception("Missing refresh token; please reauthenticate.")
-    creds = Credentials(
-        token=token.get("access_token"),
-        refresh_token=token.get("refresh_token"),
-        token_uri="https://oauth2.googleapis.com/token",
-        client_id=os.getenv("CLIENT_ID"),
-        client_secret=os.getenv("CLIENT_SECRET"),
-        scopes=token.get("scope").split() if token.get("scope") else None,
-        id_token=token.get("id_token")
-    )
-    service = build("gmail", "v1", credentials=creds)
-    return service
+    return get_service("gmail", "v1", token, email)
 
 def get_email_by_id_for_service(service, msg_id):
     """
@@ -106,24 +80,60 @@ def get_emails():
         max_results = request.args.get("maxResults", default=20, type=int)
         page_token = request.args.get("pageToken", default=None, type=str)
         label = request.args.get("label", default="INBOX", type=str)
-        emails, next_page_token = list_emails(max_results=max_results, page_token=page_token, label_ids=[label])
+        # view=summary returns headers and snippet only; bodies load via GET /api/emails/<msg_id>.
+        view = request.args.get("view", default="full", type=str)
+        if view not in ("full", "summary"):
+            return jsonify({"error": "view must be 'full' or 'summary'"}), 400
+        emails, next_page_token = list_emails(max_results=max_results, page_token=page_token, label_ids=[label], view=view)
         logger.debug("Emails retrieved: %s", emails)
         return jsonify({"emails": emails, "nextPageToken": next_page_token})
     except Exception as e:
         logger.error("Error in get_emails: %s", e, exc_info=True)
         return jsonify({"error": str(e)}), 400
 
+@emails_bp.route("/thread_cache_stats", methods=["GET"])
+def thread_cache_stats():
+    return jsonify(get_thread_cache_stats())
+
+@emails_bp.route("/classification_cache_stats", methods=["GET"])
+def classification_cache_stats():
+    return jsonify(classification_cache.stats())
+
+@emails_bp.route("/preclassifier_stats", methods=["GET"])
+def preclassifier_stats():
+    return jsonify(preclassifier.stats())
+
+@emails_bp.route("/items", methods=["GET"])
+def get_items():
+    """
+    Return the user's classified items as {category: [item, ...]}. An optional
+    comma-separated ?category= limits the categories returned.
+    """
+    session_id = request.cookies.get("session_id")
+    if not session_id:
+        return jsonify({"error": "No session id provided"}), 400
+    user = get_user_by_session(session_id)
+    if not user:
+        return jsonify({"error": "User not found"}), 400
+    categories = [c for c in (request.args.get("category") or "").split(",") if c]
+    try:
+        return jsonify(user_store.list_items(user.get("email"), categories or None))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+@emails_bp.route("/lane_stats", methods=["GET"])
+def lane_stats():
+    return jsonify(mailbox_lanes.stats())
+
 @emails_bp.route("/<msg_id>", methods=["GET"])
 def get_email(msg_id):
     logger.info("GET /api/emails/%s called", msg_id)
     try:
-        # Fetch the full email details.
-        message = get_email_by_id(msg_id)
-        thread_id = message.get("threadId")
-        logger.debug("Thread ID: %s for message ID: %s", thread_id, msg_id)
         service = _get_gmail_service()
-        thread = service.users().threads().get(userId="me", id=thread_id, format="full").execute()
-        logger.debug("Thread retrieved: %s", thread)
+        thread_id = get_thread_id_for_message(service, msg_id)
+        logger.debug("Thread ID: %s for message ID: %s", thread_id, msg_id)
+        thread = get_thread(service, thread_id)
+        logger.debug("Thread retrieved: %s (cache %s)", thread_id, get_thread_cache_stats())
         return jsonify(thread)
     except Exception as e:
         logger.error("Error in get_email: %s", e, exc_info=True)
@@ -202,10 +212,10 @@ def analyze_user_route():
             "Profile:"
         )
         logger.info("Sending prompt to Claude for user analysis")
-        # Initialize the Anthropic client
-        claude_client = anthropic.Anthropic(api_key=os.getenv("CLAUDE_API_KEY"))
+        claude_client = get_anthropic_client()
         try:
-            claude_response = claude_client.messages.create(
+            claude_response = claude_dispatcher.create(
+                claude_client,
                 model="claude-3-5-haiku-20241022",
                 messages=[{"role": "user", "content": prompt}],
                 max_tokens=500,
@@ -217,6 +227,9 @@ def analyze_user_route():
             if session_id:
                 update_user_analysis(session_id, profile)
             return jsonify({"profile": profile})
+        except claude_dispatcher.DispatcherOverloaded as overloaded:
+            logger.warning("Claude dispatcher overloaded during user analysis: %s", overloaded)
+            return jsonify({"error": "AI service is busy, please try again shortly"}), 503
         except Exception as claude_e:
             logger.error("Error during Claude API call: %s", claude_e)
             return jsonify({"error": f"Error during Claude API call: {str(claude_e)}"}), 400
@@ -236,13 +249,30 @@ def get_analysis():
     else:
         return jsonify({"profile": ""})
 
+def _process_latest_for_mailbox(service, user_email, email_ids):
+    """
+    Classify email_ids against a fresh read of the user's row (only USER_COLUMNS; the
+    session lookup is usually a cache hit, so this is the request's one Supabase read)
+    and persist the results.
+    Runs on the mailbox's lane. Returns the run, or None when the user row is missing.
+    """
+    user_data = user_store.get_user_by_email(user_email)
+    if not user_data:
+        return None
+    run = run_classification(
+        service,
+        user_email,
+        user_data.get("token") or {},
+        user_data,
+        email_ids,
+    )
+    persist_state(user_email, run["state"])
+    return run
+
 @emails_bp.route("/process_latest", methods=["GET"])
 def process_latest_emails():
     logger.info("GET /api/emails/process_latest called")
     try:
-        # Fetch the latest 10 emails.
-        emails, _ = list_emails(max_results=10, page_token=None, label_ids=["INBOX"])
-        
         # Retrieve session and user data.
         session_id = request.cookies.get("session_id")
         if not session_id:
@@ -254,370 +284,75 @@ def process_latest_emails():
             logger.error("User not found for session_id: %s", session_id)
             return jsonify({"error": "User not found"}), 400
         
-        user_email = user.get("email")
-        user_record = supabase.table("users").select("*").eq("email", user_email).single().execute()
-        if not user_record.data:
-            logger.error("No user record found for email: %s", user_email)
-            return jsonify({"error": "User record not found"}), 400
-        
-        user_data = user_record.data
-        promotions = user_data.get("promotions") or []
-        information = user_data.get("information") or []
-        drafts = user_data.get("drafts") or []
-        # NEW: Initialize additional category arrays.
-        action_required = user_data.get("action_required") or []
-        receipts = user_data.get("receipts") or []
-        meeting_updates = user_data.get("meeting_updates") or []
-        others = user_data.get("others") or []
-        
-        latest_processed_emails = user_data.get("latest_processed_emails") or []
-        latest_processed_threads = user_data.get("latest_processed_threads") or []
-        processed_emails_count = user_data.get("processed_emails") or 0
-
-        processed_results = []
+        # Fetch the latest 10 emails.
+        emails, _ = list_emails(max_results=10, page_token=None, label_ids=["INBOX"], view="summary")
         
-        # Process each email individually.
-        for email in emails:
-            email_id = email.get("id")
-            if email_id in latest_processed_emails:
-                logger.info("Skipping already processed email ID: %s", email_id)
-                continue
+        # The service and user are resolved here, in the request; the read-classify-write
+        # of the users row runs on the mailbox's lane.
+        service = _get_gmail_service()
+        run = mailbox_lanes.run(
+            user.get("email"),
+            _process_latest_for_mailbox,
+            service,
+            user.get("email"),
+            [email.get("id") for email in emails],
+        )
+        if run is None:
+            logger.error("No user record found for email: %s", user.get("email"))
+            return jsonify({"error": "User record not found"}), 400
 
-            try:
-                # Fetch full email details.
-                from services.gmail_service import get_email_by_id
-                email_detail = get_email_by_id(email_id)
-                subject, from_email, body_text = extract_email_content(email_detail)
-                thread_id = email_detail.get("threadId", "")
-                
-                # Build context for this email.
-                email_context = (
-                    f"Email ID: {email_id}\n"
-                    f"Subject: {subject}\n"
-                    f"From: {from_email}\n"
-                    f"Body: {body_text}\n"
-                    f"Thread ID: {thread_id}\n"
-                )
-                
-                # Build Claude prompt with standardized JSON formats.
-                # Get user's previous analysis if available
-                previous_analysis = user_data.get("analysis", "No previous analysis available")
-                
-                prompt = (
-                    "You are an assistant that analyzes and writes emails mimicking your client.\n"
-                    "Previous analysis:\n"
-                    f"{previous_analysis}\n\n"
-                    "Analyze the following email and classify it as one of the following:\n\n"
-                    "1. Draft - Format:\n"
-                    '{\n'
-                    '  "category": "Draft",\n'
-                    '  "emailId": "<email_id>",\n'
-                    '  "sender": {\n'
-                    '      "name": "<sender name>",\n'
-                    '      "type": "<Individual/Company>"\n'
-                    '  },\n'
-                    '  "content": {\n'
-                    '    "replySubject": "<subject for reply>",\n'
-                    '    "draftContent": "<draft reply content>"\n'
-                    '  }\n'
-                    '}\n'
-                    "Description: Use this classification for all emails that require a reply via email. If choosing between another classification that this one, always choose this one. "
-                    "It should include a subject line for the reply and a draft version of the reply content.\n\n"
-                    "2. Promotion - Format:\n"
-                    '{\n'
-                    '  "category": "Promotion",\n'
-                    '  "emailId": "<email_id>",\n'
-                    '  "sender": {\n'
-                    '      "name": "<sender name>",\n'
-                    '      "type": "<Individual/Company>"\n'
-                    '  },\n'
-                    '  "content": {\n'
-                    '    "title": "<promotion title>",\n'
-                    '    "details": "<promotion details>",\n'
-                    '    "expiration": "<promotion expiration date>"\n'
-                    '  }\n'
-                    '}\n'
-                    "Description: Use this classification when the email is advertising a product, service, or special offer. "
-                    "Include a clear promotion title, detailed information about the promotion, and the expiration date in the form mm/dd/yyyy. If you cannot find a specific expiration date, please give your best estimate.\n\n"
-                    "3. Information - Format:\n"
-                    '{\n'
-                    '  "category": "Information",\n'
-                    '  "emailId": "<email_id>",\n'
-                    '  "sender": {\n'
-                    '      "name": "<sender name>",\n'
-                    '      "type": "<Individual/Company>"\n'
-                    '  },\n'
-                    '  "content": {\n'
-                    '    "summary": "<summary of information>"\n'
-                    '  }\n'
-                    '}\n'
-                    "Description: Use this classification when the email is primarily providing general information or updates without requiring any action or response.\n\n"
-                    "4. Action Required - Format:\n"
-                    '{\n'
-                    '  "category": "Action Required",\n'
-                    '  "emailId": "<email_id>",\n'
-                    '  "sender": {\n'
-                    '      "name": "<sender name>",\n'
-                    '      "type": "<Individual/Company>"\n'
-                    '  },\n'
-                    '  "content": {\n'
-                    '    "actionPoints": "<summary of action items>",\n'
-                    '    "summary": "<summary of purpose of the actions>"\n'
-                    '  }\n'
-                    '}\n'
-                    "Description: Use this classification when the email includes specific tasks, requests, or instructions that go beyond a response email. "
-                    "Include a list of the action items and a summary of why these actions are needed.\n\n"
-                    "5. Receipts - Format:\n"
-                    '{\n'
-                    '  "category": "Receipts",\n'
-                    '  "emailId": "<email_id>",\n'
-                    '  "sender": {\n'
-                    '      "name": "<sender name>",\n'
-                    '      "type": "<Individual/Company>"\n'
-                    '  },\n'
-                    '  "content": {\n'
-                    '    "orderNumber": "<order or receipt number if available>",\n'
-                    '    "totalAmount": "<total amount if applicable>",\n'
-                    '    "summary": "<receipt details summary>"\n'
-                    '  }\n'
-                    '}\n'
-                    "Description: Use this classification when the email pertains to financial transactions or orders. "
-                    "It should include an order or receipt number, the total amount (if applicable), and a brief summary of the transaction details.\n\n"
-                    "6. Meeting Update - Format:\n"
-                    '{\n'
-                    '  "category": "Meeting Update",\n'
-                    '  "emailId": "<email_id>",\n'
-                    '  "sender": {\n'
-                    '      "name": "<sender name>",\n'
-                    '      "type": "<Individual/Company>"\n'
-                    '  },\n'
-                    '  "content": {\n'
-                    '    "meetingSubject": "<meeting subject>",\n'
-                    '    "oldDateTime": "<old meeting date and time>",\n'
-                    '    "oldLocation": "<old meeting location or link>",\n'
-                    '    "newDateTime": "<new meeting date and time>",\n'
-                    '    "newLocation": "<new meeting location or link>",\n'
-                    '    "additionalNotes": "<any additional meeting details>",\n'
-                    '    "summary": "<summary of meeting update>"\n'
-                    '  }\n'
-                    '}\n'
-                    "Description: Use this classification when the email communicates changes to a scheduled meeting. "
-                    "It should list the previous meeting details (date, time, and location) and the updated meeting details, along with any additional notes.\n\n"
-                    "7. None - Format:\n"
-                    '{\n'
-                    '  "category": "None",\n'
-                    '  "emailId": "<email_id>",\n'
-                    '  "sender": {\n'
-                    '      "name": "<sender name>",\n'
-                    '      "type": "<Individual/Company>"\n'
-                    '  },\n'
-                    '  "content": {\n'
-                    '    "summary": "<summary of email information>"\n'
-                    '  }\n'
-                    '}\n'
-                    "Description: Use this classification when the email does not clearly fit into any of the above categories. "
-                    "Simply provide a brief summary of the email content.\n\n"
-                    "Analyze the following email and return ONLY a valid JSON object in the above format with no explanations or additional text.\n"
-                    "Email:\n" + email_context +
-                    "\nRETURN ONLY JSON:"
-                )
-
-                logger.debug("Claude prompt for email %s: %s", email_id, prompt)
-                
-                # Call Claude for this single email.
-                claude_client = anthropic.Anthropic(api_key=os.getenv("CLAUDE_API_KEY"))
-                response = claude_client.messages.create(
-                    model="claude-3-5-haiku-20241022",
-                    messages=[{"role": "user", "content": prompt}],
-                    max_tokens=500,
-                    temperature=0.7,
-                )
-                result_text = response.content[0].text.strip()
-                logger.debug("Claude response for email %s: %s", email_id, result_text)
-                
-                # More robust JSON extraction
-                try:
-                    # First, try to find JSON content between backticks
-                    if "```json" in result_text or "```" in result_text:
-                        # Extract content between backticks
-                        start_idx = result_text.find("```")
-                        if start_idx != -1:
-                            start_idx = result_text.find("\n", start_idx) + 1
-                            end_idx = result_text.find("```", start_idx)
-                            if end_idx != -1:
-                                result_text = result_text[start_idx:end_idx].strip()
-                    
-                    # Find JSON object pattern
-                    if "{" in result_text and "}" in result_text:
-                        json_start = result_text.find("{")
-                        json_end = result_text.rfind("}") + 1
-                        result_text = result_text[json_start:json_end]
-                    
-                    classification_result = json.loads(result_text)
-                except Exception as parse_error:
-                    logger.error("Failed to parse Claude response for email %s: %s", email_id, parse_error, exc_info=True)
-                    processed_results.append({"emailId": email_id, "error": "Invalid classification format"})
-                    continue
-
-                # Verify the returned JSON contains the expected emailId.
-                if isinstance(classification_result, dict) and classification_result.get("emailId") == email_id:
-                    category = classification_result.get("category", "")
-                    content = classification_result.get("content", {})
-                    sender = classification_result.get("sender", {})
-                    if category == "Promotion":
-                        promotions.append({
-                            "emailId": email_id,
-                            "sender": sender,
-                            "content": content
-                        })
-                        try:
-                            service = _get_gmail_service()
-                            tag_email(email_id, add_labels=["Promotion"], service=service)
-                        except Exception as tag_err:
-                            logger.error("Failed to tag email %s as Promotion: %s", email_id, tag_err)
-                        logger.info("Email %s classified as Promotion.", email_id)
-                    elif category == "Information":
-                        information.append({
-                            "emailId": email_id,
-                            "sender": sender,
-                            "content": content
-                        })
-                        try:
-                            service = _get_gmail_service()
-                            tag_email(email_id, add_labels=["Information"], service=service)
-                        except Exception as tag_err:
-                            logger.error("Failed to tag email %s as Information: %s", email_id, tag_err)
-                        logger.info("Email %s classified as Information.", email_id)
-                    elif category == "Draft":
-                        logger.info("Email %s classified as Draft.", email_id)
-                        # Use the Gmail service when checking for existing drafts
-                        service = _get_gmail_service()
-                        if thread_id not in latest_processed_threads and not draft_exists_for_email(service, thread_id):
-                            reply_subject = f"Re: {subject}" if not subject.lower().startswith("re:") else subject
-                            try:
-                                draft_response = create_draft_email(
-                                    to=from_email,
-                                    subject=reply_subject,
-                                    body=content.get("draftContent", ""),
-                                    service=service,
-                                    thread_id=thread_id,
-                                )
-                                logger.info("Successfully created draft response for email %s", email_id)
-                            except Exception as draft_err:
-                                logger.error("Failed to create draft for email %s: %s", email_id, draft_err)
-                                continue
-                            gmail_draft_id = draft_response.get("id")
-                            drafts.append({
-                                "emailId": email_id,
-                                "sender": sender,
-                                "draft": content,
-                                "gmailDraftId": gmail_draft_id
-                            })
-                            try:
-                                tag_email(email_id, add_labels=["To Respond"], service=service)
-                            except Exception as tag_err:
-                                logger.error("Failed to tag email %s as 'To Respond': %s", email_id, tag_err)
-                        else:
-                            logger.info("Draft already exists for email %s.", email_id)
-                    elif category == "Action Required":
-                        try:
-                            service = _get_gmail_service()
-                            tag_email(email_id, add_labels=["Action Required"], service=service)
-                        except Exception as tag_err:
-                            logger.error("Failed to tag email %s as Action Required: %s", email_id, tag_err)
-                        logger.info("Email %s classified as Action Required.", email_id)
-                        action_required.append({
-                            "emailId": email_id,
-                            "sender": sender, 
-                            "content": content
-                        })
-                    elif category == "Receipts":
-                        try:
-                            service = _get_gmail_service()
-                            tag_email(email_id, add_labels=["Receipts"], service=service)
-                        except Exception as tag_err:
-                            logger.error("Failed to tag email %s as Receipts: %s", email_id, tag_err)
-                        logger.info("Email %s classified as Receipts.", email_id)
-                        receipts.append({
-                            "emailId": email_id,
-                            "sender": sender,
-                            "content": content
-                        })
-                    elif category == "Meeting Update":
-                        try:
-                            service = _get_gmail_service()
-                            tag_email(email_id, add_labels=["Meeting Update"], service=service)
-                        except Exception as tag_err:
-                            logger.error("Failed to tag email %s as Meeting Update: %s", email_id, tag_err)
-                        logger.info("Email %s classified as Meeting Update.", email_id)
-                        meeting_updates.append({
-                            "emailId": email_id,
-                            "sender": sender,
-                            "content": content
-                        })
-                    elif category == "None":
-                        try:
-                            service = _get_gmail_service()
-                            tag_email(email_id, add_labels=["Other"], service=service)
-                        except Exception as tag_err:
-                            logger.error("Failed to tag email %s as Other: %s", email_id, tag_err)
-                        logger.info("Email %s classified as None.", email_id)
-                        others.append({
-                            "emailId": email_id,
-                            "sender": sender,
-                            "content": content
-                        })
-                    else:
-                        logger.info("Email %s classified as unrecognized category: %s", email_id, category)
-
-                    processed_results.append({
-                        "emailId": email_id,
-                        "classification": classification_result
-                    })
-                    latest_processed_threads.append(thread_id)
-                else:
-                    logger.error("Claude response for email %s does not contain the expected emailId.", email_id)
-                    processed_results.append({"emailId": email_id, "error": "Invalid classification format"})
+        return jsonify({"processed": run["results"]})
+    
+    except Exception as e:
+        logger.error("Error in process_latest_emails: %s", e, exc_info=True)
+        return jsonify({"error": str(e)}), 400
 
-                
-                latest_processed_emails.append(email_id)
-                processed_emails_count += 1
 
-            except Exception as e:
-                logger.error("Error processing email %s: %s", email_id, e, exc_info=True)
-                processed_results.append({"emailId": email_id, "error": "Processing error"})
-                continue
-
-        # # Trim deduplication lists if needed.
-        # if len(latest_processed_emails) > 10:
-        #     latest_processed_emails = latest_processed_emails[-10:]
-        # if len(latest_processed_threads) > 10:
-        #     latest_processed_threads = latest_processed_threads[-10:]
-
-        update_data = {
-            "promotions": promotions,
-            "information": information,
-            "drafts": drafts,
-            "action_required": action_required,
-            "receipts": receipts,
-            "meeting_updates": meeting_updates,
-            "others": others,
-            "latest_processed_emails": latest_processed_emails,
-            "latest_processed_threads": latest_processed_threads,
-            "processed_emails": processed_emails_count,
-        }
-        update_resp = supabase.table("users").update(update_data).eq("email", user_email).execute()
-        if update_resp.dict().get("error"):
-            logger.error("Failed to update user record for %s: %s", user_email, update_resp.dict().get("error"))
-        else:
-            logger.info("User record updated for %s", user_email)
 
-        return jsonify({"processed": processed_results})
-    
+@emails_bp.route("/backfill", methods=["POST"])
+def start_backfill_route():
+    """
+    Start (or resume) classifying the user's recent inbox through an offline message batch.
+    Optional JSON body: {"days": 30} (clamped to 1-90).
+    """
+    logger.info("POST /api/emails/backfill called")
+    session_id = request.cookies.get("session_id")
+    if not session_id:
+        return jsonify({"error": "Missing session identifier"}), 400
+    user = get_user_by_session(session_id)
+    if not user:
+        return jsonify({"error": "User not found"}), 400
+    data = request.get_json(silent=True) or {}
+    try:
+        job = backfill.start_backfill(user.get("email"), data.get("days"))
+        return jsonify(_backfill_summary(job)), 202
     except Exception as e:
-        logger.error("Error in process_latest_emails: %s", e, exc_info=True)
+        logger.error("Error starting backfill: %s", e, exc_info=True)
         return jsonify({"error": str(e)}), 400
 
+@emails_bp.route("/backfill", methods=["GET"])
+def get_backfill_route():
+    session_id = request.cookies.get("session_id")
+    if not session_id:
+        return jsonify({"error": "Missing session identifier"}), 400
+    user = get_user_by_session(session_id)
+    if not user:
+        return jsonify({"error": "User not found"}), 400
+    job = backfill.get_latest_job(user.get("email"))
+    if not job:
+        return jsonify({"status": "none"})
+    return jsonify(_backfill_summary(job))
+
+def _backfill_summary(job):
+    return {
+        "id": job.get("id"),
+        "status": job.get("status"),
+        "days": job.get("days"),
+        "total": len(job.get("message_ids") or []),
+        "applied": job.get("applied_count") or 0,
+        "error": job.get("error"),
+        "updatedAt": job.get("updated_at"),
+    }
 
 
 @emails_bp.route("/watch", methods=["POST"])
@@ -649,6 +384,7 @@ def watch_emails():
                     "latest_processed_threads": []
                 }
                 update_resp = supabase.table("users").update(update_data).eq("email", user_email).execute()
+                dedup_store.reset(user_email)
                 if update_resp.dict().get("error"):
                     logger.error("Failed to update user record for %s: %s", user_email, update_resp.dict().get("error"))
                 else:
@@ -665,22 +401,81 @@ def draft_exists_for_email(service, thread_id):
     Check if a draft exists in Gmail for the given thread_id.
     """
     try:
-        drafts_response = service.users().drafts().list(userId="me").execute()
-        drafts = drafts_response.get("drafts", [])
-        logger.info("Checking drafts for thread '%s'. Found %d drafts.", thread_id, len(drafts))
-        for d in drafts:
-            draft_detail = service.users().drafts().get(userId="me", id=d["id"]).execute()
-            draft_thread_id = draft_detail.get("message", {}).get("threadId")
-            logger.info("Draft with id '%s' has thread id '%s'.", d["id"], draft_thread_id)
-            if draft_thread_id == thread_id:
-                logger.info("Matching draft found for thread '%s' (draft id '%s').", thread_id, d["id"])
-                return True
+        draft_id = find_draft_for_thread(service, thread_id)
+        if draft_id:
+            logger.info("Matching draft found for thread '%s' (draft id '%s').", thread_id, draft_id)
+            return True
         logger.info("No matching draft found for thread '%s'.", thread_id)
         return False
     except Exception as e:
         logger.error("Error checking existing drafts for thread '%s': %s", thread_id, e, exc_info=True)
         return False
 
+# Pub/Sub pushes for one mailbox are coalesced: while a processing pass is queued or
+# running, later pushes only raise the pending historyId, and the pass loops once more
+# to cover it. A short settle delay lets a burst of pushes collapse into one pass.
+# Passes run on the mailbox's lane (services/mailbox_lanes.py), so they never overlap
+# with process_latest or a backfill for the same user, while other mailboxes proceed
+# in parallel on their own lanes.
+NOTIFICATION_SETTLE_SECONDS = float(os.getenv("NOTIFICATION_SETTLE_SECONDS", "0.5"))
+_pending_push_history = {}
+_active_mailboxes = set()
+_push_lock = threading.Lock()
+
+def _coalesce_push(email_address, push_history_id):
+    with _push_lock:
+        pending = _pending_push_history.get(email_address)
+        if pending is None or int(push_history_id) > int(pending):
+            _pending_push_history[email_address] = push_history_id
+        if email_address in _active_mailboxes:
+            logger.info("Pass already queued for %s; coalesced historyId %s.", email_address, push_history_id)
+            return jsonify({"status": "Coalesced", "historyId": push_history_id}), 200
+        _active_mailboxes.add(email_address)
+
+    # Settle in the request thread; the lane is only occupied by the actual pass.
+    # _drain_pushes owns the active flag from here on and clears it on every exit.
+    if NOTIFICATION_SETTLE_SECONDS > 0:
+        time.sleep(NOTIFICATION_SETTLE_SECONDS)
+    result, status = mailbox_lanes.run(email_address, _drain_pushes, email_address)
+    return jsonify(result), status
+
+def _drain_pushes(email_address):
+    """
+    Process the pending historyId for a mailbox until no newer push is waiting.
+    Runs on the mailbox's lane. Returns (response_dict, status_code).
+
+    The mailbox's active flag is cleared here and nowhere else: under _push_lock together
+    with the empty-queue check, or, when a pass fails, on the way out. A push arriving after
+    a failure starts a new pass that picks up the pending historyId.
+    """
+    passes = 0
+    new_emails_count = 0
+    processed = []
+    result, status = {"status": "Nothing to process"}, 200
+    drained = False
+    try:
+        while True:
+            with _push_lock:
+                target_history_id = _pending_push_history.pop(email_address, None)
+                if target_history_id is None:
+                    _active_mailboxes.discard(email_address)
+                    drained = True
+                    break
+            result, status = _process_mailbox_history(email_address, target_history_id)
+            passes += 1
+            new_emails_count += result.get("new_emails_count", 0)
+            processed.extend(result.get("processed", []))
+            if status != 200 or "error" in result:
+                break
+    finally:
+        if not drained:
+            with _push_lock:
+                _active_mailboxes.discard(email_address)
+
+    if passes > 1:
+        logger.info("Coalesced pushes for %s into %d pass(es).", email_address, passes)
+    return dict(result, new_emails_count=new_emails_count, processed=processed, passes=passes), status
+
 @emails_bp.route("/notification", methods=["POST"], strict_slashes=False)
 def notification():
     """
@@ -717,410 +512,101 @@ def notification():
         logger.info("emailAddress missing in push data; ignoring notification.")
         return jsonify({"status": "No emailAddress found"}), 200
 
+    return _coalesce_push(email_address, push_history_id)
+
+
+def _process_mailbox_history(email_address, push_history_id):
+    """
+    Run one processing pass for a mailbox: read the user row once, walk every page of
+    history since last_history_id, classify new messages and persist the results.
+    Returns (response_dict, status_code).
+    """
     # Retrieve the user's record from Supabase.
-    user_resp = supabase.table("users").select("*").eq("email", email_address).single().execute()
-    if not user_resp.data:
+    user_data = user_store.get_user_by_email(email_address)
+    if not user_data:
         logger.error("User record not found for %s.", email_address)
-        return jsonify({"error": "User record not found"}), 400
-    user_data = user_resp.data
+        return {"error": "User record not found"}, 400
 
     stored_history_id = user_data.get("last_history_id")
     if not stored_history_id:
         supabase.table("users").update({"last_history_id": push_history_id}).eq("email", email_address).execute()
         logger.info("Initialized last_history_id to %s for user %s", push_history_id, email_address)
-        return jsonify({"status": "Initial history set", "newHistoryId": push_history_id}), 200
+        return {"status": "Initial history set", "newHistoryId": push_history_id}, 200
 
     try:
-        service = get_gmail_service_for_user(email_address)
+        service = get_gmail_service_for_user(email_address, user_data.get("token") or {})
     except Exception as auth_error:
         logger.error("Error initializing Gmail service for %s: %s", email_address, auth_error, exc_info=True)
-        return jsonify({"error": "Gmail service not available"}), 200
+        return {"error": "Gmail service not available"}, 200
 
+    # Page through the complete history since the stored cursor; stopping at the first
+    # page would drop messages after a burst and then advance last_history_id past them.
+    history_events = []
+    new_history_id = push_history_id
+    page_token = None
     try:
-        history_response = service.users().history().list(
-            userId="me",
-            startHistoryId=stored_history_id,
-            historyTypes=["messageAdded"]
-        ).execute()
+        while True:
+            params = {
+                "userId": "me",
+                "startHistoryId": stored_history_id,
+                "historyTypes": ["messageAdded"]
+            }
+            if page_token:
+                params["pageToken"] = page_token
+            history_response = service.users().history().list(**params).execute()
+            history_events.extend(history_response.get("history", []))
+            response_history_id = history_response.get("historyId")
+            if response_history_id and int(response_history_id) > int(new_history_id):
+                new_history_id = response_history_id
+            page_token = history_response.get("nextPageToken")
+            if not page_token:
+                break
+    except HttpError as e:
+        if e.resp.status == 404:
+            # The stored cursor is older than Gmail keeps history for; restart from this push.
+            logger.warning("History %s expired for %s; resetting to %s.", stored_history_id, email_address, push_history_id)
+            supabase.table("users").update({"last_history_id": push_history_id}).eq("email", email_address).execute()
+            return {"status": "History expired; cursor reset", "newHistoryId": push_history_id}, 200
+        logger.error("Error fetching history for user %s: %s", email_address, e, exc_info=True)
+        return {"error": str(e)}, 400
     except RefreshError as re:
         logger.error("RefreshError for user %s: %s", email_address, re, exc_info=True)
-        supabase.table("users").update({"token": {}}).eq("email", email_address).execute()
-        return jsonify({"error": "User token invalid, please reauthenticate"}), 200
+        invalidate_user(email_address)
+        user_store.clear_token(email=email_address)
+        return {"error": "User token invalid, please reauthenticate"}, 200
     except Exception as e:
         logger.error("Error fetching history for user %s: %s", email_address, e, exc_info=True)
-        return jsonify({"error": str(e)}), 400
+        return {"error": str(e)}, 400
 
-    history_events = history_response.get("history", [])
     new_emails_count = 0
     processed_classifications = []
-
-    # Retrieve deduplication data from Supabase.
-    latest_processed_emails = user_data.get("latest_processed_emails") or []
-    latest_processed_threads = user_data.get("latest_processed_threads") or []
-    processed_emails_count = user_data.get("processed_emails") or 0
-    promotions = user_data.get("promotions") or []
-    information = user_data.get("information") or []
-    drafts = user_data.get("drafts") or []
-    previous_analysis = user_data.get("analysis", "")
-    action_required = user_data.get("action_required") or []
-    receipts = user_data.get("receipts") or []
-    meeting_updates = user_data.get("meeting_updates") or []
-    others = user_data.get("others") or []
-
     if not history_events:
         logger.info("No new history events found.")
     else:
         logger.info("Processing %d history event(s).", len(history_events))
-        for event in history_events:
-            messages = event.get("messages", [])
-            for msg in messages:
-                email_id = msg.get("id")
-                if email_id in latest_processed_emails:
-                    logger.info("Skipping already processed email ID: %s", email_id)
-                    continue
-                try:
-                    # Attempt to fetch full email details, skipping if not found.
-                    try:
-                        email_detail = get_email_by_id_for_service(service, email_id)
-                    except HttpError as e:
-                        if e.resp.status == 404:
-                            logger.error("Email %s not found; skipping.", email_id)
-                            latest_processed_emails.append(email_id)
-                            continue
-                        else:
-                            raise
-
-                    subject, from_email, body_text = extract_email_content(email_detail)
-                    thread_id = email_detail.get("threadId", "")
-                    email_context = (
-                        f"Email ID: {email_id}\n"
-                        f"Subject: {subject}\n"
-                        f"From: {from_email}\n"
-                        f"Body: {body_text}\n"
-                        f"Thread ID: {thread_id}\n"
-                    )
-                    if thread_id in latest_processed_threads:
-                        logger.info("Thread %s already processed; skipping Claude classification for email %s.", thread_id, email_id)
-                        latest_processed_emails.append(email_id)
-                        continue
-
-                    prompt = (
-                        "You are an assistant that analyzes and writes emails mimicking your client.\n"
-                        "Previous analysis:\n"
-                        f"{previous_analysis}\n\n"
-                        "Analyze the following email and classify it as one of the following:\n\n"
-                        "1. Draft - Format:\n"
-                        '{\n'
-                        '  "category": "Draft",\n'
-                        '  "emailId": "<email_id>",\n'
-                        '  "sender": {\n'
-                        '      "name": "<sender name>",\n'
-                        '      "type": "<Individual/Company>"\n'
-                        '  },\n'
-                        '  "content": {\n'
-                        '    "replySubject": "<subject for reply>",\n'
-                        '    "draftContent": "<draft reply content>"\n'
-                        '  }\n'
-                        '}\n'
-                        "Description: Use this classification for all emails that require a reply via email. If choosing between another classification that this one, always choose this one. "
-                        "It should include a subject line for the reply and a draft version of the reply content.\n\n"
-                        "2. Promotion - Format:\n"
-                        '{\n'
-                        '  "category": "Promotion",\n'
-                        '  "emailId": "<email_id>",\n'
-                        '  "sender": {\n'
-                        '      "name": "<sender name>",\n'
-                        '      "type": "<Individual/Company>"\n'
-                        '  },\n'
-                        '  "content": {\n'
-                        '    "title": "<promotion title>",\n'
-                        '    "details": "<promotion details>",\n'
-                        '    "expiration": "<promotion expiration date>"\n'
-                        '  }\n'
-                        '}\n'
-                        "Description: Use this classification when the email is advertising a product, service, or special offer. "
-                        "Include a clear promotion title, detailed information about the promotion, and the expiration date in the form mm/dd/yyyy. If you cannot find a specific expiration date, please give your best estimate.\n\n"
-                        "3. Information - Format:\n"
-                        '{\n'
-                        '  "category": "Information",\n'
-                        '  "emailId": "<email_id>",\n'
-                        '  "sender": {\n'
-                        '      "name": "<sender name>",\n'
-                        '      "type": "<Individual/Company>"\n'
-                        '  },\n'
-                        '  "content": {\n'
-                        '    "summary": "<summary of information>"\n'
-                        '  }\n'
-                        '}\n'
-                        "Description: Use this classification when the email is primarily providing general information or updates without requiring any action or response.\n\n"
-                        "4. Action Required - Format:\n"
-                        '{\n'
-                        '  "category": "Action Required",\n'
-                        '  "emailId": "<email_id>",\n'
-                        '  "sender": {\n'
-                        '      "name": "<sender name>",\n'
-                        '      "type": "<Individual/Company>"\n'
-                        '  },\n'
-                        '  "content": {\n'
-                        '    "actionPoints": "<summary of action items>",\n'
-                        '    "summary": "<summary of purpose of the actions>"\n'
-                        '  }\n'
-                        '}\n'
-                        "Description: Use this classification when the email includes specific tasks, requests, or instructions that require a response or follow-up. "
-                        "Include a list of the action items and a summary of why these actions are needed.\n\n"
-                        "5. Receipts - Format:\n"
-                        '{\n'
-                        '  "category": "Receipts",\n'
-                        '  "emailId": "<email_id>",\n'
-                        '  "sender": {\n'
-                        '      "name": "<sender name>",\n'
-                        '      "type": "<Individual/Company>"\n'
-                        '  },\n'
-                        '  "content": {\n'
-                        '    "orderNumber": "<order or receipt number if available>",\n'
-                        '    "totalAmount": "<total amount if applicable>",\n'
-                        '    "summary": "<receipt details summary>"\n'
-                        '  }\n'
-                        '}\n'
-                        "Description: Use this classification when the email pertains to financial transactions or orders. "
-                        "It should include an order or receipt number, the total amount (if applicable), and a brief summary of the transaction details.\n\n"
-                        "6. Meeting Update - Format:\n"
-                        '{\n'
-                        '  "category": "Meeting Update",\n'
-                        '  "emailId": "<email_id>",\n'
-                        '  "sender": {\n'
-                        '      "name": "<sender name>",\n'
-                        '      "type": "<Individual/Company>"\n'
-                        '  },\n'
-                        '  "content": {\n'
-                        '    "meetingSubject": "<meeting subject>",\n'
-                        '    "oldDateTime": "<old meeting date and time>",\n'
-                        '    "oldLocation": "<old meeting location or link>",\n'
-                        '    "newDateTime": "<new meeting date and time>",\n'
-                        '    "newLocation": "<new meeting location or link>",\n'
-                        '    "additionalNotes": "<any additional meeting details>",\n'
-                        '    "summary": "<summary of meeting update>"\n'
-                        '  }\n'
-                        '}\n'
-                        "Description: Use this classification when the email communicates changes to a scheduled meeting. "
-                        "It should list the previous meeting details (date, time, and location) and the updated meeting details, along with any additional notes.\n\n"
-                        "7. None - Format:\n"
-                        '{\n'
-                        '  "category": "None",\n'
-                        '  "emailId": "<email_id>",\n'
-                        '  "sender": {\n'
-                        '      "name": "<sender name>",\n'
-                        '      "type": "<Individual/Company>"\n'
-                        '  },\n'
-                        '  "content": {\n'
-                        '    "summary": "<summary of email information>"\n'
-                        '  }\n'
-                        '}\n'
-                        "Description: Use this classification when the email does not clearly fit into any of the above categories. "
-                        "Simply provide a brief summary of the email content.\n\n"
-                        "Analyze the following email and return ONLY a valid JSON object in the above format with no explanations or additional text.\n"
-                        "Email:\n" + email_context +
-                        "\nRETURN ONLY JSON:"
-                    )
-
-                    logger.debug("Claude prompt for email %s: %s", email_id, prompt)
-                    claude_client = anthropic.Anthropic(api_key=os.getenv("CLAUDE_API_KEY"))
-                    response = claude_client.messages.create(
-                        model="claude-3-5-haiku-20241022",
-                        messages=[{"role": "user", "content": prompt}],
-                        max_tokens=500,
-                        temperature=0.7,
-                    )
-                    result_text = response.content[0].text.strip()
-                    logger.debug("Claude response for email %s: %s", email_id, result_text)
-                    
-                    # More robust JSON extraction
-                    try:
-                        # First, try to find JSON content between backticks
-                        if "```json" in result_text or "```" in result_text:
-                            # Extract content between backticks
-                            start_idx = result_text.find("```")
-                            if start_idx != -1:
-                                start_idx = result_text.find("\n", start_idx) + 1
-                                end_idx = result_text.find("```", start_idx)
-                                if end_idx != -1:
-                                    result_text = result_text[start_idx:end_idx].strip()
-                        
-                        # Find JSON object pattern
-                        if "{" in result_text and "}" in result_text:
-                            json_start = result_text.find("{")
-                            json_end = result_text.rfind("}") + 1
-                            result_text = result_text[json_start:json_end]
-                        
-                        classification_result = json.loads(result_text)
-                    except Exception as parse_error:
-                        logger.error("Failed to parse Claude response for email %s: %s", email_id, parse_error, exc_info=True)
-                        classification_result = None
-
-                    # Adjusted parsing: expect a flat object with "emailId" matching the current email.
-                    if classification_result and isinstance(classification_result, dict) and classification_result.get("emailId") == email_id:
-                        classification = classification_result
-                        category = classification.get("category", "")
-                        content = classification.get("content", {})
-                        sender = classification.get("sender", {}) 
-                        if category == "Promotion":
-                            promotions.append({
-                                "emailId": email_id,
-                                "sender": sender, 
-                                "content": content
-                            })
-                            try:
-                                tag_email(email_id, add_labels=["Promotion"], service=service)
-                            except Exception as tag_err:
-                                logger.error("Failed to tag email %s as Promotion: %s", email_id, tag_err)
-                            logger.info("Email %s classified as Promotion.", email_id)
-                        elif category == "Information":
-                            information.append({
-                                "emailId": email_id,
-                                "sender": sender, 
-                                "content": content
-                            })
-                            try:
-                                tag_email(email_id, add_labels=["Information"], service=service)
-                            except Exception as tag_err:
-                                logger.error("Failed to tag email %s as Information: %s", email_id, tag_err)
-                            logger.info("Email %s classified as Information.", email_id)
-                        elif category == "Draft":
-                            logger.info("Email '%s' classified as Draft.", email_id)
-
-                            # use the already-authenticated `service`
-                            gmail_draft_id = get_gmail_draft_id(service, thread_id)
-
-                            if gmail_draft_id is None:          # create it if it doesn't exist
-                                reply_subject = (
-                                    f"Re: {subject}"
-                                    if not subject.lower().startswith("re:")
-                                    else subject
-                                )
-                                try:
-                                    draft_resp = create_draft_email(
-                                        to=from_email,
-                                        subject=reply_subject,
-                                        body=content.get("draftContent", ""),
-                                        service=service,         # ← keep passing the same service
-                                        thread_id=thread_id,
-                                    )
-                                    gmail_draft_id = draft_resp.get("id")
-                                    logger.info(
-                                        "Created Gmail draft %s for email %s", gmail_draft_id, email_id
-                                    )
-
-                                    tag_email(email_id, add_labels=["To Respond"], service=service)
-                                except Exception as err:
-                                    logger.error("Failed to create draft for %s: %s", email_id, err)
-
-                            # always record the draft in Supabase
-                            if not any(d.get("emailId") == email_id for d in drafts):
-                                drafts.append(
-                                    {
-                                        "emailId": email_id,
-                                        "sender": sender,
-                                        "draft": content,
-                                        "gmailDraftId": gmail_draft_id,
-                                    }
-                                )
-
-                        elif category == "Action Required":
-                            try:
-                                tag_email(email_id, add_labels=["Action Required"], service=service)
-                            except Exception as tag_err:
-                                logger.error("Failed to tag email %s as Action Required: %s", email_id, tag_err)
-                            logger.info("Email %s classified as Action Required.", email_id)
-                            action_required.append({
-                                "emailId": email_id,
-                                "sender": sender,
-                                "content": content
-                            })
-                        elif category == "Receipts":
-                            try:
-                                tag_email(email_id, add_labels=["Receipts"], service=service)
-                            except Exception as tag_err:
-                                logger.error("Failed to tag email %s as Receipts: %s", email_id, tag_err)
-                            logger.info("Email %s classified as Receipts.", email_id)
-                            receipts.append({
-                                "emailId": email_id,
-                                "sender": sender,
-                                "content": content
-                            })
-                        elif category == "Meeting Update":
-                            try:
-                                tag_email(email_id, add_labels=["Meeting Update"], service=service)
-                            except Exception as tag_err:
-                                logger.error("Failed to tag email %s as Meeting Update: %s", email_id, tag_err)
-                            logger.info("Email %s classified as Meeting Update.", email_id)
-                            meeting_updates.append({
-                                "emailId": email_id,
-                                "sender": sender, 
-                                "content": content
-                            })
-                        elif category == "None":
-                            try:
-                                tag_email(email_id, add_labels=["Other"], service=service)
-                            except Exception as tag_err:
-                                logger.error("Failed to tag email %s as Other: %s", email_id, tag_err)
-                            logger.info("Email %s classified as None; tagged as Other.", email_id)
-                            others.append({
-                                "emailId": email_id,
-                                "sender": sender, 
-                                "content": content
-                            })
-                        else:
-                            logger.info("Email %s classified as unrecognized category: %s", email_id, category)
-                        processed_classifications.append({
-                            "emailId": email_id,
-                            "classification": classification
-                        })
-                        latest_processed_threads.append(thread_id)
-                    else:
-                        logger.error("Claude response for email %s does not contain the expected emailId.", email_id)
-                        processed_classifications.append({"emailId": email_id, "error": "Invalid classification format"})
-
-
-                    latest_processed_emails.append(email_id)
-                    # if len(latest_processed_emails) > 10:
-                    #     latest_processed_emails = latest_processed_emails[-10:]
-                    # if len(latest_processed_threads) > 10:
-                    #     latest_processed_threads = latest_processed_threads[-10:]
-                    processed_emails_count += 1
-                    new_emails_count += 1
-                except Exception as inner_e:
-                    logger.error("Error processing email %s: %s", email_id, inner_e, exc_info=True)
-                    continue
-
-        update_data = {
-            "promotions": promotions,
-            "information": information,
-            "drafts": drafts,
-            "action_required": action_required,
-            "receipts": receipts,
-            "meeting_updates": meeting_updates,
-            "others": others,
-            "latest_processed_emails": latest_processed_emails,
-            "latest_processed_threads": latest_processed_threads,
-            "processed_emails": processed_emails_count,
-            "last_history_id": push_history_id  # Update stored history ID.
-        }
-        update_resp = supabase.table("users").update(update_data).eq("email", email_address).execute()
-        logger.info("Supabase update returned data=%s count=%s",
-            update_resp.data,
-            getattr(update_resp, "count", None))
+        email_ids = [msg.get("id") for event in history_events for msg in event.get("messages", [])]
+        run = run_classification(
+            service,
+            email_address,
+            user_data.get("token") or {},
+            user_data,
+            email_ids,
+            skip_seen_threads=True,
+        )
+        new_emails_count = run["new_emails_count"]
+        processed_classifications = run["results"]
+        persist_state(email_address, run["state"], {"last_history_id": new_history_id})
 
-        if update_resp.dict().get("error"):
-            logger.error("Failed to update user record for %s: %s", email_address, update_resp.dict().get("error"))
-        else:
-            logger.info("User record updated for %s", email_address)
+    # New history means the local mailbox mirror (if enabled) must sync before its next read.
+    mailbox_mirror.mark_stale(email_address)
 
     logger.info("Notification processed. %d new emails processed.", new_emails_count)
-    return jsonify({
+    return {
         "status": "Notification processed",
         "new_emails_count": new_emails_count,
-        "processed": processed_classifications
-    }), 200
+        "processed": processed_classifications,
+        "newHistoryId": new_history_id
+    }, 200
 
 
 
@@ -1142,13 +628,25 @@ def stop_watch_emails():
         logger.error("Error in stop_watch_emails: %s", e, exc_info=True)
         return jsonify({'error': str(e)}), 400
 
+# Request "type" values used by quick_remove and read_all -> item category.
+ITEM_TYPE_CATEGORIES = {
+    "draft": "drafts",
+    "info": "information",
+    "promotion": "promotions",
+    "action_required": "action_required",
+    "receipts": "receipts",
+    "meeting_updates": "meeting_updates",
+    "other": "others",
+    "sent_emails": "sent_emails",
+}
+
 @emails_bp.route("/quick_remove", methods=["POST"])
 def quick_remove():
     """
-    Endpoint to quickly remove a draft, info, or promotion from the user's record.
+    Endpoint to quickly remove one item from the user's classified items.
     If removing a draft, it will also delete the Gmail draft.
     Expects a JSON payload with:
-      - type: "draft", "info", or "promotion"
+      - type: one of the ITEM_TYPE_CATEGORIES keys ("draft", "info", "promotion", ...)
       - emailId: the email identifier of the item
       - (for drafts only) gmailDraftId: the Gmail draft ID to delete
     """
@@ -1157,6 +655,9 @@ def quick_remove():
     email_id = data.get("emailId")
     if not removal_type or not email_id:
         return jsonify({"error": "Missing required parameters"}), 400
+    category = ITEM_TYPE_CATEGORIES.get(removal_type)
+    if category is None:
+        return jsonify({"error": "Invalid removal type"}), 400
 
     session_id = request.cookies.get("session_id")
     if not session_id:
@@ -1166,15 +667,6 @@ def quick_remove():
     if not user:
         return jsonify({"error": "User not found"}), 400
 
-    user_email = user.get("email")
-    # Retrieve the user's record from Supabase
-    user_record = supabase.table("users").select("*").eq("email", user_email).single().execute()
-    if not user_record.data:
-        return jsonify({"error": "User record not found"}), 400
-
-    user_data = user_record.data
-    updated_field = {}
-
     if removal_type == "draft":
         gmail_draft_id = data.get("gmailDraftId")
         if gmail_draft_id:
@@ -1184,25 +676,8 @@ def quick_remove():
                 delete_draft(gmail_draft_id)
             except Exception as e:
                 logger.error("Error deleting Gmail draft: %s", e)
-        # Remove the draft from the user's drafts array.
-        drafts = user_data.get("drafts") or []
-        drafts = [d for d in drafts if d.get("emailId") != email_id]
-        updated_field["drafts"] = drafts
-
-    elif removal_type == "info":
-        info = user_data.get("information") or []
-        info = [i for i in info if i.get("emailId") != email_id]
-        updated_field["information"] = info
-
-    elif removal_type == "promotion":
-        promotions = user_data.get("promotions") or []
-        promotions = [p for p in promotions if p.get("emailId") != email_id]
-        updated_field["promotions"] = promotions
-
-    else:
-        return jsonify({"error": "Invalid removal type"}), 400
 
-    update_resp = supabase.table("users").update(updated_field).eq("email", user_email).execute()
+    update_resp = user_store.remove_items(user.get("email"), category, [email_id])
     if update_resp.dict().get("error"):
         return jsonify({"error": "Failed to update user record"}), 500
 
@@ -1266,18 +741,32 @@ def clean_promotional_emails(user_email, promotions_list):
                 logger.info("Promotion expired and removed: %s", promo)
 
     # Update the promotions list in the user's record.
-    update_resp = supabase.table("users").update({"promotions": cleaned_promotions}).eq("email", user_email).execute()
+    update_resp = user_store.replace_items(user_email, "promotions", cleaned_promotions)
     if update_resp.dict().get("error"):
         logger.error("Failed to update promotions for user %s: %s", user_email, update_resp.dict().get("error"))
         return {"status": "error", "message": update_resp.dict().get("error")}
     logger.info("Promotions updated for user %s after cleaning", user_email)
     return {"status": "Cleaned promotional emails", "cleaned_count": len(cleaned_promotions)}
 
+async def _send_and_discard_draft(client, gmail_draft_id):
+    """
+    Send one Gmail draft, then delete the obsolete draft. 404s from the delete are
+    ignored because Gmail usually removes the draft itself once it is sent.
+    """
+    sent_msg = await client.send_draft(gmail_draft_id)
+    try:
+        await client.delete_draft(gmail_draft_id)
+    except HttpError as del_err:
+        if del_err.resp.status != 404:
+            raise  # re-raise anything other than 404
+        logger.debug("Draft %s already removed (404 after send).", gmail_draft_id)
+    return sent_msg
+
 @emails_bp.route("/send_all_drafts", methods=["POST"])
 def send_all_drafts():
     """
-    Send every Gmail draft listed in the user's `drafts` array, then
-    move each successfully-sent item into the `sent_emails` array
+    Send every Gmail draft listed in the user's `drafts` items, then
+    move each successfully-sent item into the `sent_emails` items
     in Supabase. 404s from the subsequent delete call are ignored.
     """
     logger.info("POST /api/emails/send_all_drafts called")
@@ -1292,84 +781,66 @@ def send_all_drafts():
         return jsonify({"error": "User not found"}), 400
 
     user_email = user.get("email")
-    rec_resp = supabase.table("users").select("*").eq("email", user_email).single().execute()
-    if not rec_resp.data:
-        return jsonify({"error": "User record not found"}), 400
-
-    user_data   = rec_resp.data
-    drafts      = user_data.get("drafts") or []
-    sent_emails = user_data.get("sent_emails") or []
+    drafts     = user_store.list_items(user_email, ["drafts"])["drafts"]
 
     if not drafts:
         return jsonify({"status": "No drafts to send"}), 200
 
     # ── 2.  Gmail service for the user ────────────────────────────────────────
     try:
-        service = get_gmail_service_for_user(user_email)
+        service = get_gmail_service_for_user(user_email, user.get("token") or {})
     except Exception as e:
         logger.error("Gmail auth error for %s: %s", user_email, e, exc_info=True)
         return jsonify({"error": "Could not authenticate with Gmail"}), 400
 
-    # ── 3.  Send every draft ──────────────────────────────────────────────────
+    # ── 3.  Send every draft (concurrently, capped per user) ─────────────────
     successful_sends, failed_sends = [], []
-    remaining_drafts               = []
+    sent_records                   = []
 
+    sendable = []
     for d in drafts:
+        # Skip if we do not have a Gmail draft id
+        if not d.get("gmailDraftId"):
+            failed_sends.append({"emailId": d.get("emailId"), "error": "Missing gmailDraftId"})
+        else:
+            sendable.append(d)
+
+    client = AsyncGoogleClient(user_email, user.get("token") or {})
+    outcomes = async_google.run(
+        client.gather([_send_and_discard_draft(client, d["gmailDraftId"]) for d in sendable])
+    )
+
+    for d, outcome in zip(sendable, outcomes):
         email_id       = d.get("emailId")
         gmail_draft_id = d.get("gmailDraftId")
 
-        # Skip if we do not have a Gmail draft id
-        if not gmail_draft_id:
-            remaining_drafts.append(d)
-            failed_sends.append({"emailId": email_id, "error": "Missing gmailDraftId"})
+        if isinstance(outcome, HttpError):
+            logger.error("Gmail API error for draft %s: %s", gmail_draft_id, outcome)
+            failed_sends.append({"emailId": email_id, "error": str(outcome)})
+            continue
+        if isinstance(outcome, Exception):
+            logger.error("Unexpected error for draft %s: %s", gmail_draft_id, outcome)
+            failed_sends.append({"emailId": email_id, "error": str(outcome)})
             continue
 
-        try:
-            # 3a. send the draft
-            sent_msg = service.users().drafts() \
-                              .send(userId="me", body={"id": gmail_draft_id}) \
-                              .execute()
-
-            # 3b. record immediately
-            sent_record = {
-                "emailId":        email_id,
-                "gmailDraftId":   gmail_draft_id,
-                "gmailMessageId": sent_msg.get("id"),
-                "sentAt":         datetime.datetime.utcnow().isoformat() + "Z",
-            }
-            sent_emails.append(sent_record)
-            successful_sends.append({"emailId": email_id, "messageId": sent_msg.get("id")})
-
-            # 3c. attempt to delete the obsolete draft (ignore 404)
-            try:
-                service.users().drafts().delete(userId="me", id=gmail_draft_id).execute()
-            except HttpError as del_err:
-                if del_err.resp.status == 404:
-                    # Draft already auto-deleted by Gmail after send; this is fine.
-                    logger.debug("Draft %s already removed (404 after send).", gmail_draft_id)
-                else:
-                    raise  # re-raise anything other than 404
-
-        except HttpError as api_err:
-            logger.error("Gmail API error for draft %s: %s", gmail_draft_id, api_err, exc_info=True)
-            remaining_drafts.append(d)
-            failed_sends.append({"emailId": email_id, "error": str(api_err)})
-        except Exception as err:
-            logger.error("Unexpected error for draft %s: %s", gmail_draft_id, err, exc_info=True)
-            remaining_drafts.append(d)
-            failed_sends.append({"emailId": email_id, "error": str(err)})
-
-    # ── 4.  Persist changes to Supabase ───────────────────────────────────────
-    update_resp = supabase.table("users").update(
-        {
-            "drafts":      remaining_drafts,
-            "sent_emails": sent_emails,
+        # record the sent draft
+        sent_msg = outcome
+        sent_record = {
+            "emailId":        email_id,
+            "gmailDraftId":   gmail_draft_id,
+            "gmailMessageId": sent_msg.get("id"),
+            "sentAt":         datetime.datetime.utcnow().isoformat() + "Z",
         }
-    ).eq("email", user_email).execute()
+        sent_records.append(sent_record)
+        successful_sends.append({"emailId": email_id, "messageId": sent_msg.get("id")})
+        forget_draft(service, gmail_draft_id)
 
-    if update_resp.dict().get("error"):
-        logger.error("Supabase update failed for %s: %s",
-                     user_email, update_resp.dict()["error"])
+    # ── 4.  Persist changes to Supabase (only the sent items move) ────────────
+    try:
+        user_store.add_items(user_email, "sent_emails", sent_records)
+        user_store.remove_items(user_email, "drafts", [r["emailId"] for r in sent_records])
+    except Exception as e:
+        logger.error("Supabase update failed for %s: %s", user_email, e)
         return jsonify({
             "status": "partial_success",
             "sent": successful_sends,
@@ -1408,33 +879,11 @@ def read_all_emails():
     if not user:
         return jsonify({"error": "User not found"}), 400
 
-    user_email = user.get("email")
-    user_record = supabase.table("users").select("*").eq("email", user_email).single().execute()
-    if not user_record.data:
-        return jsonify({"error": "User record not found"}), 400
-
-    updated_field = {}
-    # Map the email type to the corresponding field in the user record
-    if email_type == "draft":
-        updated_field["drafts"] = []
-    elif email_type == "info":
-        updated_field["information"] = []
-    elif email_type == "promotion":
-        updated_field["promotions"] = []
-    elif email_type == "action_required":
-        updated_field["action_required"] = []
-    elif email_type == "receipts":
-        updated_field["receipts"] = []
-    elif email_type == "meeting_updates":
-        updated_field["meeting_updates"] = []
-    elif email_type == "other":
-        updated_field["others"] = []
-    elif email_type == "sent_emails":
-        updated_field["sent_emails"] = []
-    else:
+    category = ITEM_TYPE_CATEGORIES.get(email_type)
+    if category is None:
         return jsonify({"error": "Invalid email type"}), 400
 
-    update_resp = supabase.table("users").update(updated_field).eq("email", user_email).execute()
+    update_resp = user_store.clear_items(user.get("email"), category)
     if update_resp.dict().get("error"):
         return jsonify({"error": "Failed to update user record"}), 500
 
@@ -1446,12 +895,7 @@ def get_gmail_draft_id(service, thread_id):
     or None if no draft exists.
     """
     try:
-        drafts_resp = service.users().drafts().list(userId="me").execute()
-        for d in drafts_resp.get("drafts", []):
-            detail = service.users().drafts().get(userId="me", id=d["id"]).execute()
-            if detail.get("message", {}).get("threadId") == thread_id:
-                return d["id"]
-        return None
+        return find_draft_for_thread(service, thread_id)
     except Exception as e:
         logger.error("Error retrieving draft for thread '%s': %s", thread_id, e, exc_info=True)
         return None
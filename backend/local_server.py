@@ -8,11 +8,24 @@ from api.ai_chat import ai_chat_bp
 from api.automations import automations_bp
 from api.nodes import nodes_bp
 from auth import auth_bp 
+from services.google_clients import warm_discovery
+from services.backfill import resume_pending_jobs
 
 # Set up logging
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# Parse the pinned Gmail/Calendar discovery documents once at worker boot.
+if os.getenv("GOOGLE_DISCOVERY_WARMUP", "1") != "0":
+    warm_discovery()
+
+# Pick up classification backfills that were interrupted by a restart.
+if os.getenv("BACKFILL_RESUME_ON_START", "1") != "0":
+    try:
+        resume_pending_jobs()
+    except Exception as e:
+        logger.error("Could not resume backfill jobs: %s", e)
+
 app = Flask(__name__)
 
 # Update session cookie configuration to allow cross-origin credentials.
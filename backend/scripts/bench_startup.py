@@ -0,0 +1,89 @@
+# scripts/bench_startup.py
+"""
+Startup benchmark for server.py: reports cold and warm time-to-first-Gmail-call.
+
+Each scenario runs in a fresh interpreter so that module and discovery caches start empty:
+  - cold: GOOGLE_DISCOVERY_WARMUP=0, the first Gmail call parses the discovery document.
+  - warm: server.py warms the pinned discovery documents while it is imported.
+
+By default the "first call" is building the messages.list request for a new user's service,
+which is everything except the network round trip. Set BENCH_GMAIL_TOKEN to a JSON token
+(the same shape stored in users.token) to execute the call against Gmail as well.
+
+Usage (from the backend directory):
+    python scripts/bench_startup.py [--runs 5]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _child():
+    started = time.perf_counter()
+    sys.path.insert(0, BACKEND_DIR)
+    import server  # noqa: F401  (import performs the boot-time warmup)
+    imported = time.perf_counter()
+
+    from services.google_clients import get_service
+    token = json.loads(os.getenv("BENCH_GMAIL_TOKEN") or "{}") or {
+        "access_token": "bench-access-token",
+        "refresh_token": "bench-refresh-token",
+        "scope": "https://www.googleapis.com/auth/gmail.readonly",
+    }
+    service = get_service("gmail", "v1", token, "bench@example.com")
+    request = service.users().messages().list(userId="me", maxResults=1)
+    if os.getenv("BENCH_GMAIL_TOKEN"):
+        request.execute()
+    first_call = time.perf_counter()
+
+    print(json.dumps({
+        "import_ms": (imported - started) * 1000,
+        "first_call_ms": (first_call - imported) * 1000,
+        "total_ms": (first_call - started) * 1000,
+    }))
+
+
+def _run(scenario):
+    env = dict(os.environ)
+    env["GOOGLE_DISCOVERY_WARMUP"] = "0" if scenario == "cold" else "1"
+    # Importing server.py must not start resuming real backfill jobs.
+    env["BACKFILL_RESUME_ON_START"] = "0"
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child"],
+        cwd=BACKEND_DIR, env=env, check=True, capture_output=True, text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        _child()
+        return
+
+    mode = "live" if os.getenv("BENCH_GMAIL_TOKEN") else "request build only"
+    print(f"Time to first Gmail call for server.py ({mode}, median of {args.runs} runs)")
+    for scenario in ("cold", "warm"):
+        samples = [_run(scenario) for _ in range(args.runs)]
+        summary = {
+            key: statistics.median(sample[key] for sample in samples)
+            for key in ("import_ms", "first_call_ms", "total_ms")
+        }
+        print(
+            f"  {scenario:<5} import {summary['import_ms']:8.1f} ms   "
+            f"first call {summary['first_call_ms']:8.1f} ms   "
+            f"total {summary['total_ms']:8.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
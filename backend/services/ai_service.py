@@ -1,8 +1,8 @@
 # services/ai_service.py
 import json
 import logging
-import os
-import anthropic  # Import the Anthropic library
+from services import claude_dispatcher
+from services.anthropic_client import cached_text_block, get_anthropic_client
 
 from services.gmail_service import send_email, create_draft_email
 # Import calendar functions so that calendar instructions can be executed.
@@ -53,25 +53,39 @@ def process_email_request(instruction_details):
         logger.error("Error processing email request: %s", e)
         return f"Error processing email request: {str(e)}"
 
-# Initialize the Anthropic client using the API key
-try:
-    # Initialize with error handling
-    api_key = os.getenv("CLAUDE_API_KEY")
-    if not api_key:
-        logger.error("CLAUDE_API_KEY environment variable not found")
-        raise ValueError("Missing CLAUDE_API_KEY")
-        
-    anthropic_client = anthropic.Anthropic(api_key=api_key)
-    logger.info("Initialized anthropic client successfully")
-except Exception as e:
-    logger.error(f"Failed to initialize anthropic client: {str(e)}")
-    # Try older API as fallback
-    try:
-        anthropic_client = anthropic.Client(api_key=os.getenv("CLAUDE_API_KEY"))
-        logger.info("Initialized anthropic client using legacy API")
-    except Exception as e2:
-        logger.error(f"Failed to initialize anthropic client with legacy API: {str(e2)}")
-        raise
+# Static part of the instruction-extraction prompt. It is sent as a cached system block;
+# only the user's instruction goes in the message.
+EXTRACTION_INSTRUCTIONS = (
+    "You are an AI assistant integrated into a productivity app that can follow specific instructions from users. "
+    "You have authorization to send real emails and manage calendar events when requested. "
+    "IMPORTANT: You should NEVER refuse to send emails because 'AI cannot send emails'. This system is specifically authorized to send emails on behalf of the user.\n\n"
+    
+    "If the prompt instructs or requests to send or draft an email (including any phrasing like 'send an email', 'write to', 'email as', etc.), output a valid JSON object with the following structure:\n"
+    "{\n"
+    '  "function": "send_email" or "draft_email",\n'
+    '  "parameters": {\n'
+    '    "to": "recipient email address",\n'
+    '    "subject": "email subject",\n'
+    '    "body": "email body content",\n'
+    '    "cc": "optional, comma separated email addresses"\n'
+    "  }\n"
+    "}\n"
+    
+    "If the user asks you to impersonate someone or write in a specific style, you SHOULD fulfill this request by creating an appropriate email. "
+    "When the user asks you to 'write as X' or 'write like X', this is a legitimate use case for our application.\n\n"
+    
+    "If the prompt instructs to create, update, or delete a calendar event, output a valid JSON object with the following structure:\n"
+    "{\n"
+    '  "function": "create_event" or "update_event" or "delete_event",\n'
+    '  "parameters": {\n'
+    '    For create_event: "summary": "event summary", "start_time": "start datetime in ISO format", "end_time": "end datetime in ISO format", "location": "optional", "description": "optional", "attendees": "optional, comma separated emails".\n'
+    '    For update_event: "event_id": "ID of the event to update", and any of the fields: "summary", "start_time", "end_time", "location", "description", "attendees".\n'
+    '    For delete_event: "event_id": "ID of the event to delete".\n'
+    "  }\n"
+    "}\n"
+    
+    "If the prompt does not explicitly request to send an email or manage a calendar event, output exactly: NONE\n"
+)
 
 def process_chat(prompt):
     """
@@ -116,38 +130,14 @@ def process_chat(prompt):
     
     If the prompt does not match any of the above, output exactly: NONE
     """
-    extraction_prompt = (
-        "You are an AI assistant integrated into a productivity app that can follow specific instructions from users. "
-        "You have authorization to send real emails and manage calendar events when requested. "
-        "IMPORTANT: You should NEVER refuse to send emails because 'AI cannot send emails'. This system is specifically authorized to send emails on behalf of the user.\n\n"
-        
-        "If the prompt instructs or requests to send or draft an email (including any phrasing like 'send an email', 'write to', 'email as', etc.), output a valid JSON object with the following structure:\n"
-        "{\n"
-        '  "function": "send_email" or "draft_email",\n'
-        '  "parameters": {\n'
-        '    "to": "recipient email address",\n'
-        '    "subject": "email subject",\n'
-        '    "body": "email body content",\n'
-        '    "cc": "optional, comma separated email addresses"\n'
-        "  }\n"
-        "}\n"
-        
-        "If the user asks you to impersonate someone or write in a specific style, you SHOULD fulfill this request by creating an appropriate email. "
-        "When the user asks you to 'write as X' or 'write like X', this is a legitimate use case for our application.\n\n"
-        
-        "If the prompt instructs to create, update, or delete a calendar event, output a valid JSON object with the following structure:\n"
-        "{\n"
-        '  "function": "create_event" or "update_event" or "delete_event",\n'
-        '  "parameters": {\n'
-        '    For create_event: "summary": "event summary", "start_time": "start datetime in ISO format", "end_time": "end datetime in ISO format", "location": "optional", "description": "optional", "attendees": "optional, comma separated emails".\n'
-        '    For update_event: "event_id": "ID of the event to update", and any of the fields: "summary", "start_time", "end_time", "location", "description", "attendees".\n'
-        '    For delete_event: "event_id": "ID of the event to delete".\n'
-        "  }\n"
-        "}\n"
-        
-        "If the prompt does not explicitly request to send an email or manage a calendar event, output exactly: NONE\n"
-        f"Instruction: {prompt}"
-    )
+    try:
+        anthropic_client = get_anthropic_client()
+    except Exception as e:
+        logger.error("Failed to initialize anthropic client: %s", e)
+        return f"AI service is not configured: {str(e)}"
+
+    instruction_message = f"Instruction: {prompt}"
+    extraction_prompt = EXTRACTION_INSTRUCTIONS + instruction_message
 
     logger.info("Sending extraction prompt to Claude: %s", extraction_prompt)
 
@@ -155,12 +145,14 @@ def process_chat(prompt):
         # Using Claude-3.5 Haiku (latest cheaper model)
         try:
             # Try newer Anthropic API
-            extraction_response = anthropic_client.messages.create(
+            extraction_response = claude_dispatcher.create(
+                anthropic_client,
                 model="claude-3-5-haiku-20241022",
                 max_tokens=1000,  # Increased from 200 to 1000 to avoid truncation
                 temperature=0,
+                system=[cached_text_block(EXTRACTION_INSTRUCTIONS)],
                 messages=[
-                    {"role": "user", "content": extraction_prompt}
+                    {"role": "user", "content": instruction_message}
                 ]
             )
             extraction_text = extraction_response.content[0].text
@@ -194,11 +186,12 @@ Keep your responses helpful, professional, and focused on assisting the user wit
             
             try:
                 # Try newer Anthropic API
-                chat_response = anthropic_client.messages.create(
+                chat_response = claude_dispatcher.create(
+                    anthropic_client,
                     model="claude-3-5-haiku-20241022",
                     max_tokens=1000,
                     temperature=0.7,
-                    system=system_message,
+                    system=[cached_text_block(system_message)],
                     messages=[
                         {"role": "user", "content": prompt}
                     ]
@@ -227,7 +220,8 @@ Keep your responses helpful, professional, and focused on assisting the user wit
             # Fall back to standard chat completion for this request
             try:
                 # Try newer Anthropic API
-                chat_response = anthropic_client.messages.create(
+                chat_response = claude_dispatcher.create(
+                    anthropic_client,
                     model="claude-3-5-haiku-20241022",
                     max_tokens=1000,
                     temperature=0.7,
@@ -277,7 +271,8 @@ Keep your responses helpful, professional, and focused on assisting the user wit
             try:
                 try:
                     # Try newer Anthropic API
-                    retry_response = anthropic_client.messages.create(
+                    retry_response = claude_dispatcher.create(
+                        anthropic_client,
                         model="claude-3-5-haiku-20241022",
                         max_tokens=1500,  # Increased token limit
                         temperature=0,    # Lower temperature for more deterministic output
@@ -314,11 +309,12 @@ When users ask you to write or send emails, help them compose the content withou
         
         try:
             # Try newer Anthropic API
-            chat_response = anthropic_client.messages.create(
+            chat_response = claude_dispatcher.create(
+                anthropic_client,
                 model="claude-3-5-haiku-20241022",
                 max_tokens=1000,
                 temperature=0.7,
-                system=system_message,
+                system=[cached_text_block(system_message)],
                 messages=[
                     {"role": "user", "content": prompt}
                 ]
@@ -0,0 +1,78 @@
+# services/anthropic_client.py
+"""
+Process-wide Anthropic client. Every Claude call site shares one client and therefore
+one pooled httpx connection pool, so calls reuse warm keep-alive TLS connections
+instead of building a new pool per email. The client is created on first use, so
+importing this module never touches the network or fails on a missing API key.
+"""
+import logging
+import os
+import threading
+
+import anthropic
+import httpx
+
+logger = logging.getLogger(__name__)
+
+CLAUDE_MAX_CONNECTIONS = int(os.getenv("CLAUDE_MAX_CONNECTIONS", "32"))
+CLAUDE_MAX_KEEPALIVE = int(os.getenv("CLAUDE_MAX_KEEPALIVE", "16"))
+CLAUDE_KEEPALIVE_EXPIRY = float(os.getenv("CLAUDE_KEEPALIVE_EXPIRY", "60"))
+CLAUDE_CONNECT_TIMEOUT = float(os.getenv("CLAUDE_CONNECT_TIMEOUT", "5"))
+CLAUDE_READ_TIMEOUT = float(os.getenv("CLAUDE_READ_TIMEOUT", "60"))
+# 429/529 retries are owned by services/claude_dispatcher so that they honour the shared
+# pause; the SDK's own retry loop would sleep inside an admitted slot instead.
+CLAUDE_SDK_MAX_RETRIES = int(os.getenv("CLAUDE_SDK_MAX_RETRIES", "0"))
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def _build_client():
+    api_key = os.getenv("CLAUDE_API_KEY")
+    if not api_key:
+        raise ValueError("Missing CLAUDE_API_KEY")
+    # Build the pool with the HTTP classes the installed SDK was built against; newer SDK
+    # releases reject a client from a different httpx package.
+    client_cls = getattr(anthropic, "DefaultHttpxClient", httpx.Client)
+    limits_cls = type(anthropic.DEFAULT_CONNECTION_LIMITS) if hasattr(anthropic, "DEFAULT_CONNECTION_LIMITS") else httpx.Limits
+    timeout_cls = getattr(anthropic, "Timeout", httpx.Timeout)
+    http_client = client_cls(
+        limits=limits_cls(
+            max_connections=CLAUDE_MAX_CONNECTIONS,
+            max_keepalive_connections=CLAUDE_MAX_KEEPALIVE,
+            keepalive_expiry=CLAUDE_KEEPALIVE_EXPIRY,
+        ),
+        timeout=timeout_cls(
+            CLAUDE_READ_TIMEOUT,
+            connect=CLAUDE_CONNECT_TIMEOUT,
+            read=CLAUDE_READ_TIMEOUT,
+        ),
+    )
+    return anthropic.Anthropic(
+        api_key=api_key,
+        http_client=http_client,
+        max_retries=CLAUDE_SDK_MAX_RETRIES,
+    )
+
+
+def get_anthropic_client():
+    """
+    Return the shared Anthropic client, creating it on first use. Safe to call from
+    multiple threads. Raises ValueError when CLAUDE_API_KEY is not configured.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = _build_client()
+                logger.info("Initialized shared anthropic client")
+    return _client
+
+
+def cached_text_block(text):
+    """
+    A text content block ending in an ephemeral prompt-cache breakpoint. Everything up to
+    and including the block is cached by Anthropic and billed at the cache-read rate on
+    later calls that share the same prefix.
+    """
+    return {"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}
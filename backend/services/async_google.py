@@ -0,0 +1,256 @@
+# services/async_google.py
+"""
+Asyncio client for the Gmail and Calendar REST calls this app makes, for endpoints that
+need to fan out many Google calls at once. All requests share one HTTP/2 connection pool
+owned by a background event loop, and each user's in-flight calls are capped by
+GOOGLE_ASYNC_PER_USER_CONCURRENCY so a single mailbox cannot monopolise the pool or
+trip Gmail's per-user rate limits.
+
+Flask request threads call into it with run(coro). Errors are raised as
+googleapiclient HttpError, exactly like the synchronous service objects. A failed token
+refresh (RefreshError) is handled like on the synchronous path: the user's cached
+services are dropped, the stored token is cleared and the error is re-raised.
+
+Per-user state (credentials, refresh locks, concurrency caps) lives in bounded TTL
+caches; a user's credentials for an older token fingerprint are dropped as soon as the
+new token is seen. Everything here is only touched from the loop thread.
+"""
+import asyncio
+import json
+import logging
+import os
+import random
+import threading
+
+import httplib2
+import httpx
+from cachetools import TTLCache
+from google.auth.exceptions import RefreshError
+from google.auth.transport.requests import Request as GoogleAuthRequest
+from googleapiclient.errors import HttpError
+
+import user_store
+from services.google_clients import build_credentials, invalidate_user, token_fingerprint
+
+logger = logging.getLogger(__name__)
+
+GMAIL_BASE_URL = "https://gmail.googleapis.com/gmail/v1/users/me"
+CALENDAR_BASE_URL = "https://www.googleapis.com/calendar/v3"
+
+PER_USER_CONCURRENCY = int(os.getenv("GOOGLE_ASYNC_PER_USER_CONCURRENCY", "8"))
+MAX_CONNECTIONS = int(os.getenv("GOOGLE_ASYNC_MAX_CONNECTIONS", "64"))
+MAX_RETRIES = 3
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+USER_CACHE_SIZE = int(os.getenv("GOOGLE_ASYNC_USER_CACHE_SIZE", "1024"))
+USER_CACHE_TTL = int(os.getenv("GOOGLE_ASYNC_USER_CACHE_TTL", "3600"))
+
+_loop = None
+_loop_lock = threading.Lock()
+_http_client = None
+_user_semaphores = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+_credentials = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+_refresh_locks = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+# Credential keys whose refresh failed; later calls fail fast instead of retrying it.
+_failed_refreshes = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+
+def _ensure_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="async-google", daemon=True).start()
+    return _loop
+
+
+def run(coro, timeout=None):
+    """
+    Run a coroutine on the shared client loop from synchronous code and return its result.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, _ensure_loop()).result(timeout)
+
+
+def _client():
+    # Only ever called on the loop thread, so no locking is needed.
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS),
+            timeout=httpx.Timeout(30.0, connect=10.0),
+        )
+    return _http_client
+
+
+def _encode_params(params):
+    encoded = {}
+    for key, value in (params or {}).items():
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            value = "true" if value else "false"
+        encoded[key] = value
+    return encoded
+
+
+class AsyncGoogleClient:
+    """
+    Per-user handle over the shared pool. Cheap to create; credentials and the
+    concurrency cap are shared by every handle for the same user.
+    """
+
+    def __init__(self, user_key, token):
+        self.user_key = user_key
+        self.token = token
+        self._credentials_key = (user_key, token_fingerprint(token))
+
+    # ── plumbing ─────────────────────────────────────────────────────────────
+    def _get_credentials(self):
+        credentials = _credentials.get(self._credentials_key)
+        if credentials is None:
+            # A new fingerprint means the user re-authenticated; forget the old token's state.
+            for stale_key in [key for key in list(_credentials.keys()) if key[0] == self.user_key]:
+                _credentials.pop(stale_key, None)
+                _refresh_locks.pop(stale_key, None)
+            credentials = build_credentials(self.token)
+            _credentials[self._credentials_key] = credentials
+        return credentials
+
+    async def _access_token(self, force_refresh=False):
+        failed = _failed_refreshes.get(self._credentials_key)
+        if failed is not None:
+            raise failed
+        credentials = self._get_credentials()
+        if credentials.valid and not force_refresh:
+            return credentials.token
+        lock = _refresh_locks.get(self._credentials_key)
+        if lock is None:
+            lock = _refresh_locks[self._credentials_key] = asyncio.Lock()
+        async with lock:
+            failed = _failed_refreshes.get(self._credentials_key)
+            if failed is not None:
+                raise failed
+            if force_refresh or not credentials.valid:
+                try:
+                    await asyncio.to_thread(credentials.refresh, GoogleAuthRequest())
+                except RefreshError as e:
+                    await self._refresh_failed(e)
+                    raise
+        return credentials.token
+
+    async def _refresh_failed(self, error):
+        # Same handling as the synchronous path: drop the cached services and clear the
+        # stored token so the user is asked to re-authenticate.
+        logger.error("Token refresh failed for %s: %s", self.user_key, error)
+        _failed_refreshes[self._credentials_key] = error
+        _credentials.pop(self._credentials_key, None)
+        invalidate_user(self.user_key)
+        try:
+            await asyncio.to_thread(user_store.clear_token, email=self.user_key)
+        except Exception as e:
+            logger.error("Could not clear the token for %s: %s", self.user_key, e)
+
+    async def request(self, method, url, params=None, body=None):
+        semaphore = _user_semaphores.get(self.user_key)
+        if semaphore is None:
+            semaphore = _user_semaphores[self.user_key] = asyncio.Semaphore(PER_USER_CONCURRENCY)
+        refreshed = False
+        attempt = 0
+        async with semaphore:
+            while True:
+                access_token = await self._access_token()
+                response = await _client().request(
+                    method,
+                    url,
+                    params=_encode_params(params),
+                    json=body,
+                    headers={"Authorization": f"Bearer {access_token}"},
+                )
+                if response.status_code == 401 and not refreshed:
+                    refreshed = True
+                    await self._access_token(force_refresh=True)
+                    continue
+                if response.status_code in RETRY_STATUSES and attempt < MAX_RETRIES:
+                    attempt += 1
+                    retry_after = response.headers.get("retry-after")
+                    delay = float(retry_after) if retry_after and retry_after.isdigit() else 0.5 * (2 ** attempt)
+                    await asyncio.sleep(delay + random.random() * 0.1)
+                    continue
+                if response.status_code >= 400:
+                    raise HttpError(
+                        httplib2.Response({"status": response.status_code, "reason": response.reason_phrase}),
+                        response.content,
+                        uri=str(response.url),
+                    )
+                if not response.content:
+                    return {}
+                return json.loads(response.content)
+
+    async def gather(self, coros):
+        """
+        Run coroutines concurrently (still bounded by the per-user cap). Failures are
+        returned in place as exceptions so one bad item does not cancel the rest.
+        """
+        return await asyncio.gather(*coros, return_exceptions=True)
+
+    # ── Gmail: messages ──────────────────────────────────────────────────────
+    async def list_messages(self, **params):
+        return await self.request("GET", f"{GMAIL_BASE_URL}/messages", params=params)
+
+    async def get_message(self, msg_id, **params):
+        return await self.request("GET", f"{GMAIL_BASE_URL}/messages/{msg_id}", params=params)
+
+    async def get_messages(self, msg_ids, **params):
+        """
+        Fetch many messages concurrently; returns {msg_id: message or exception}.
+        """
+        results = await self.gather([self.get_message(msg_id, **params) for msg_id in msg_ids])
+        return dict(zip(msg_ids, results))
+
+    async def modify_message(self, msg_id, body):
+        return await self.request("POST", f"{GMAIL_BASE_URL}/messages/{msg_id}/modify", body=body)
+
+    async def get_thread(self, thread_id, **params):
+        return await self.request("GET", f"{GMAIL_BASE_URL}/threads/{thread_id}", params=params)
+
+    # ── Gmail: drafts ────────────────────────────────────────────────────────
+    async def list_drafts(self, **params):
+        return await self.request("GET", f"{GMAIL_BASE_URL}/drafts", params=params)
+
+    async def get_draft(self, draft_id, **params):
+        return await self.request("GET", f"{GMAIL_BASE_URL}/drafts/{draft_id}", params=params)
+
+    async def create_draft(self, body):
+        return await self.request("POST", f"{GMAIL_BASE_URL}/drafts", body=body)
+
+    async def send_draft(self, draft_id):
+        return await self.request("POST", f"{GMAIL_BASE_URL}/drafts/send", body={"id": draft_id})
+
+    async def delete_draft(self, draft_id):
+        return await self.request("DELETE", f"{GMAIL_BASE_URL}/drafts/{draft_id}")
+
+    # ── Gmail: labels and history ────────────────────────────────────────────
+    async def list_labels(self):
+        return await self.request("GET", f"{GMAIL_BASE_URL}/labels")
+
+    async def create_label(self, body):
+        return await self.request("POST", f"{GMAIL_BASE_URL}/labels", body=body)
+
+    async def list_history(self, **params):
+        return await self.request("GET", f"{GMAIL_BASE_URL}/history", params=params)
+
+    # ── Calendar: events ─────────────────────────────────────────────────────
+    async def list_events(self, calendar_id="primary", **params):
+        return await self.request("GET", f"{CALENDAR_BASE_URL}/calendars/{calendar_id}/events", params=params)
+
+    async def get_event(self, event_id, calendar_id="primary"):
+        return await self.request("GET", f"{CALENDAR_BASE_URL}/calendars/{calendar_id}/events/{event_id}")
+
+    async def insert_event(self, body, calendar_id="primary"):
+        return await self.request("POST", f"{CALENDAR_BASE_URL}/calendars/{calendar_id}/events", body=body)
+
+    async def update_event(self, event_id, body, calendar_id="primary"):
+        return await self.request("PUT", f"{CALENDAR_BASE_URL}/calendars/{calendar_id}/events/{event_id}", body=body)
+
+    async def delete_event(self, event_id, calendar_id="primary"):
+        return await self.request("DELETE", f"{CALENDAR_BASE_URL}/calendars/{calendar_id}/events/{event_id}")
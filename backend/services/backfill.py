@@ -0,0 +1,430 @@
+# services/backfill.py
+"""
+Offline classification backfill for a user's recent inbox (e.g. right after sign-up).
+
+A job pages through the last BACKFILL_DAYS of INBOX mail, submits one classification
+request per message as an asynchronous message batch (half the price of synchronous
+calls), polls until the batch has ended, and then applies the results through
+classification_engine exactly like process_latest_emails does. Messages the
+pre-classifier or the classification cache can answer are kept out of the batch; their
+classifications are checkpointed with the job and applied alongside the batch results. Progress is
+checkpointed in the Supabase backfill_jobs table (see sql/backfill_jobs.sql), so a job
+picks up where it stopped after a restart. Batch API calls retry transient errors; a job
+that still fails records the step it failed in (failed_status), and the next
+start_backfill for the user resumes it from there instead of starting a new batch.
+
+The batch endpoint is reached through a small client interface. BACKFILL_BATCH_BACKEND
+selects the real Anthropic Message Batches API ("anthropic", default) or
+LocalBatchClient ("local"), a stand-in that answers requests in-process; set_batch_client
+installs any other implementation.
+"""
+import logging
+import os
+import threading
+import time
+
+from googleapiclient.errors import HttpError
+
+import user_store
+from supabase_client import supabase
+from services import (
+    async_google,
+    claude_dispatcher,
+    classification_cache,
+    classification_engine,
+    dedup_store,
+    mailbox_lanes,
+    preclassifier,
+)
+from services.anthropic_client import get_anthropic_client
+from services.async_google import AsyncGoogleClient
+from services.email_content import extract_email_content
+from services.google_clients import get_service
+
+logger = logging.getLogger(__name__)
+
+BACKFILL_DAYS = int(os.getenv("BACKFILL_DAYS", "30"))
+BACKFILL_MAX_DAYS = 90
+BACKFILL_POLL_SECONDS = float(os.getenv("BACKFILL_POLL_SECONDS", "30"))
+BACKFILL_APPLY_CHUNK = int(os.getenv("BACKFILL_APPLY_CHUNK", "50"))
+# Messages applied per mailbox-lane task. Each task loads and persists the user's state
+# once, so larger tasks cost fewer Supabase round trips but hold the lane longer.
+BACKFILL_LANE_TASK = max(1, int(os.getenv("BACKFILL_LANE_TASK", "8")))
+BACKFILL_FETCH_CHUNK = 100
+BACKFILL_BATCH_BACKEND = os.getenv("BACKFILL_BATCH_BACKEND", "anthropic")
+# The shared SDK client has max_retries=0 (retries live in claude_dispatcher), so batch
+# calls retry transient errors themselves, with exponential backoff capped at 60s.
+BACKFILL_API_RETRIES = int(os.getenv("BACKFILL_API_RETRIES", "5"))
+
+# Job lifecycle: listing -> submitting -> submitted -> applying -> done (or failed).
+ACTIVE_STATUSES = ("listing", "submitting", "submitted", "applying")
+
+_running_jobs = set()
+_running_lock = threading.Lock()
+
+
+# ── batch endpoint clients ───────────────────────────────────────────────────
+def _with_retries(description, fn, *args):
+    attempt = 0
+    while True:
+        try:
+            return fn(*args)
+        except Exception as e:
+            if attempt >= BACKFILL_API_RETRIES or not claude_dispatcher.is_transient(e):
+                raise
+            attempt += 1
+            delay = min(60.0, 2.0 ** attempt)
+            logger.warning("%s failed (%s); retrying in %.0fs (retry %d)", description, e, delay, attempt)
+            time.sleep(delay)
+
+
+class AnthropicBatchClient:
+    """
+    Anthropic Message Batches API.
+    """
+
+    def create(self, requests):
+        batch = _with_retries(
+            "Batch create", lambda: get_anthropic_client().messages.batches.create(requests=requests)
+        )
+        return batch.id
+
+    def is_ended(self, batch_id):
+        batch = _with_retries(
+            f"Batch {batch_id} poll", lambda: get_anthropic_client().messages.batches.retrieve(batch_id)
+        )
+        logger.info("Batch %s status %s (%s)", batch_id, batch.processing_status, batch.request_counts)
+        return batch.processing_status == "ended"
+
+    def results(self, batch_id):
+        """
+        Yield (custom_id, reply content blocks or None) for every request in an ended batch.
+        The results are read in full first, so a retried read never yields an entry twice.
+        """
+        entries = _with_retries(
+            f"Batch {batch_id} results", lambda: list(get_anthropic_client().messages.batches.results(batch_id))
+        )
+        for entry in entries:
+            if entry.result.type == "succeeded":
+                yield entry.custom_id, entry.result.message.content
+            else:
+                logger.warning("Batch %s request %s ended as %s", batch_id, entry.custom_id, entry.result.type)
+                yield entry.custom_id, None
+
+
+class LocalBatchClient:
+    """
+    In-process stand-in for the batch endpoint. Each request is answered by responder
+    (params -> reply content blocks), which defaults to a synchronous Claude call through the
+    dispatcher. Batches end as soon as they are created; results live in memory only.
+    """
+
+    def __init__(self, responder=None):
+        self.responder = responder or self._call_claude
+        self._batches = {}
+        self._lock = threading.Lock()
+        self._next_id = 0
+
+    @staticmethod
+    def _call_claude(params):
+        response = claude_dispatcher.create(
+            get_anthropic_client(),
+            priority=claude_dispatcher.PRIORITY_BACKGROUND,
+            **params,
+        )
+        return response.content
+
+    def create(self, requests):
+        answers = {}
+        for request in requests:
+            try:
+                answers[request["custom_id"]] = self.responder(request["params"])
+            except Exception as e:
+                logger.error("Local batch request %s failed: %s", request["custom_id"], e)
+                answers[request["custom_id"]] = None
+        with self._lock:
+            self._next_id += 1
+            batch_id = f"local_batch_{self._next_id}"
+            self._batches[batch_id] = answers
+        return batch_id
+
+    def is_ended(self, batch_id):
+        return True
+
+    def results(self, batch_id):
+        with self._lock:
+            answers = dict(self._batches.get(batch_id, {}))
+        yield from answers.items()
+
+
+_batch_client = None
+
+
+def get_batch_client():
+    global _batch_client
+    if _batch_client is None:
+        _batch_client = LocalBatchClient() if BACKFILL_BATCH_BACKEND == "local" else AnthropicBatchClient()
+    return _batch_client
+
+
+def set_batch_client(client):
+    """
+    Replace the batch endpoint client (e.g. with a LocalBatchClient using a fixed responder).
+    """
+    global _batch_client
+    _batch_client = client
+
+
+# ── checkpoint storage ───────────────────────────────────────────────────────
+def _update_job(job_id, **fields):
+    fields["updated_at"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    supabase.table("backfill_jobs").update(fields).eq("id", job_id).execute()
+
+
+def get_job(job_id):
+    response = supabase.table("backfill_jobs").select("*").eq("id", job_id).execute()
+    return response.data[0] if response.data else None
+
+
+def get_latest_job(email):
+    response = (
+        supabase.table("backfill_jobs")
+        .select("*")
+        .eq("email", email)
+        .order("created_at", desc=True)
+        .limit(1)
+        .execute()
+    )
+    return response.data[0] if response.data else None
+
+
+def _get_user(email):
+    user = user_store.get_user_by_email(email)
+    if not user:
+        raise Exception(f"User with email {email} not found in Supabase.")
+    return user
+
+
+# ── job steps ────────────────────────────────────────────────────────────────
+def _list_messages(job, service):
+    """
+    Page through INBOX messages newer than the job's window, checkpointing after every page.
+    """
+    message_ids = list(job.get("message_ids") or [])
+    page_token = job.get("page_token")
+    while True:
+        params = {
+            "userId": "me",
+            "labelIds": ["INBOX"],
+            "q": f"newer_than:{job['days']}d",
+            "maxResults": 500,
+            "fields": "messages/id,nextPageToken",
+        }
+        if page_token:
+            params["pageToken"] = page_token
+        response = service.users().messages().list(**params).execute()
+        known = set(message_ids)
+        message_ids.extend(m["id"] for m in response.get("messages", []) if m["id"] not in known)
+        page_token = response.get("nextPageToken")
+        if not page_token:
+            break
+        _update_job(job["id"], message_ids=message_ids, page_token=page_token)
+    _update_job(job["id"], message_ids=message_ids, page_token=None, status="submitting")
+    logger.info("Backfill %s listed %d message(s)", job["id"], len(message_ids))
+    return message_ids
+
+
+def _build_requests(job, user):
+    """
+    Build one batch request per unprocessed message, keyed by the Gmail message ID.
+    Returns (requests, precomputed, preclassified): messages answered by the
+    pre-classifier or the classification cache go into precomputed instead of the batch,
+    and preclassified lists the pre-classifier's share of them.
+    """
+    processed, _ = dedup_store.load(job["email"], user)
+    pending = [msg_id for msg_id in job.get("message_ids") or [] if msg_id not in processed]
+    previous_analysis = user.get("analysis") or "No previous analysis available"
+    client = AsyncGoogleClient(job["email"], user.get("token") or {})
+    requests = []
+    precomputed = {}
+    preclassified = []
+    for start in range(0, len(pending), BACKFILL_FETCH_CHUNK):
+        chunk = pending[start:start + BACKFILL_FETCH_CHUNK]
+        details = async_google.run(client.get_messages(chunk, format="full"))
+        for msg_id in chunk:
+            detail = details.get(msg_id)
+            if isinstance(detail, HttpError) and detail.resp.status == 404:
+                continue
+            if isinstance(detail, Exception):
+                # Left out of the batch; the apply step classifies it synchronously.
+                logger.warning("Backfill could not fetch %s: %s", msg_id, detail)
+                continue
+            ruled = preclassifier.classify(job["email"], detail)
+            if ruled is not None:
+                precomputed[msg_id] = ruled
+                preclassified.append(msg_id)
+                continue
+            subject, from_email, body_text = extract_email_content(detail)
+            email_context = classification_engine.build_email_context(
+                msg_id, subject, from_email, body_text, detail.get("threadId", "")
+            )
+            cached = classification_cache.get(classification_cache.make_key(
+                msg_id, email_context, classification_engine.PROMPT_VERSION, previous_analysis
+            ))
+            if cached is not None:
+                precomputed[msg_id] = cached
+                continue
+            requests.append({
+                "custom_id": msg_id,
+                "params": classification_engine.classification_params(
+                    previous_analysis, classification_engine.build_classification_message(email_context)
+                ),
+            })
+    return requests, precomputed, preclassified
+
+
+def _collect_results(batch_id):
+    classifications = {}
+    for custom_id, content_blocks in get_batch_client().results(batch_id):
+        if content_blocks is None:
+            continue
+        classification = classification_engine.parse_tool_response(content_blocks, custom_id)
+        if classification is None:
+            # Left out; the apply step classifies it synchronously, with a repair attempt.
+            logger.warning("Batch result for email %s has no valid classification", custom_id)
+            continue
+        classifications[custom_id] = classification
+    return classifications
+
+
+def _apply_task(email, service, message_ids, classifications, preclassified):
+    user = _get_user(email)
+    precomputed = {msg_id: classifications[msg_id] for msg_id in message_ids if msg_id in classifications}
+    run = classification_engine.run_classification(
+        service,
+        email,
+        user.get("token") or {},
+        user,
+        message_ids,
+        precomputed=precomputed or None,
+        preclassified=preclassified,
+    )
+    classification_engine.persist_state(email, run["state"])
+
+
+def _apply(job, service, classifications, preclassified=()):
+    """
+    Apply the batch results through the engine, checkpointing after every
+    BACKFILL_APPLY_CHUNK messages. Messages without a usable batch result are classified
+    synchronously.
+    """
+    message_ids = job.get("message_ids") or []
+    applied = job.get("applied_count") or 0
+    while applied < len(message_ids):
+        chunk = message_ids[applied:applied + BACKFILL_APPLY_CHUNK]
+        # The chunk runs on the mailbox's lane (it reads and writes the users row) as
+        # tasks of BACKFILL_LANE_TASK messages, so pushes and process_latest for users
+        # sharing the lane interleave with the backfill instead of waiting for a whole chunk.
+        for start in range(0, len(chunk), BACKFILL_LANE_TASK):
+            mailbox_lanes.run(
+                job["email"], _apply_task, job["email"], service,
+                chunk[start:start + BACKFILL_LANE_TASK], classifications, preclassified,
+            )
+        applied += len(chunk)
+        _update_job(job["id"], applied_count=applied)
+        logger.info("Backfill %s applied %d/%d message(s)", job["id"], applied, len(message_ids))
+
+
+def run_job(job_id):
+    """
+    Drive a job from its checkpointed status to completion. Safe to call again after a
+    restart; each step resumes from the stored progress.
+    """
+    with _running_lock:
+        if job_id in _running_jobs:
+            return
+        _running_jobs.add(job_id)
+    job = None
+    try:
+        job = get_job(job_id)
+        if not job or job["status"] not in ACTIVE_STATUSES:
+            return
+        user = _get_user(job["email"])
+        service = get_service("gmail", "v1", user.get("token") or {}, job["email"])
+
+        if job["status"] == "listing":
+            job["message_ids"] = _list_messages(job, service)
+            job["status"] = "submitting"
+
+        if job["status"] == "submitting":
+            requests, precomputed, preclassified = _build_requests(job, user)
+            batch_id = get_batch_client().create(requests) if requests else None
+            _update_job(
+                job_id, batch_id=batch_id, precomputed=precomputed, preclassified=preclassified, status="submitted"
+            )
+            logger.info(
+                "Backfill %s submitted %d request(s) as batch %s; %d answered without Claude",
+                job_id, len(requests), batch_id, len(precomputed),
+            )
+            job.update(batch_id=batch_id, precomputed=precomputed, preclassified=preclassified, status="submitted")
+
+        if job["status"] == "submitted":
+            while job.get("batch_id") and not get_batch_client().is_ended(job["batch_id"]):
+                time.sleep(BACKFILL_POLL_SECONDS)
+            _update_job(job_id, status="applying")
+            job["status"] = "applying"
+
+        if job["status"] == "applying":
+            classifications = dict(job.get("precomputed") or {})
+            if job.get("batch_id"):
+                classifications.update(_collect_results(job["batch_id"]))
+            _apply(job, service, classifications, set(job.get("preclassified") or []))
+            _update_job(job_id, status="done")
+            logger.info("Backfill %s done", job_id)
+    except Exception as e:
+        logger.error("Backfill %s failed: %s", job_id, e, exc_info=True)
+        _update_job(job_id, status="failed", error=str(e), failed_status=job["status"] if job else None)
+    finally:
+        with _running_lock:
+            _running_jobs.discard(job_id)
+
+
+def _start(job_id):
+    threading.Thread(target=run_job, args=(job_id,), name=f"backfill-{job_id}", daemon=True).start()
+
+
+def start_backfill(email, days=None):
+    """
+    Create a backfill job for email (or return its active one) and run it in the background.
+    A failed job is resumed from the step it failed in, reusing its listing and batch.
+    """
+    existing = get_latest_job(email)
+    if existing and existing["status"] == "failed" and existing.get("failed_status") in ACTIVE_STATUSES:
+        logger.info("Resuming failed backfill job %s from %s", existing["id"], existing["failed_status"])
+        _update_job(existing["id"], status=existing["failed_status"], failed_status=None, error=None)
+        existing = get_job(existing["id"])
+    if existing and existing["status"] in ACTIVE_STATUSES:
+        _start(existing["id"])
+        return existing
+    days = max(1, min(int(days or BACKFILL_DAYS), BACKFILL_MAX_DAYS))
+    response = supabase.table("backfill_jobs").insert({
+        "email": email,
+        "days": days,
+        "status": "listing",
+        "message_ids": [],
+        "applied_count": 0,
+    }).execute()
+    job = response.data[0]
+    logger.info("Created backfill job %s for %s (%d days)", job["id"], email, days)
+    _start(job["id"])
+    return job
+
+
+def resume_pending_jobs():
+    """
+    Restart every job that was still active when the process stopped.
+    """
+    response = supabase.table("backfill_jobs").select("id").in_("status", list(ACTIVE_STATUSES)).execute()
+    for job in response.data or []:
+        logger.info("Resuming backfill job %s", job["id"])
+        _start(job["id"])
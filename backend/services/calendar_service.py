@@ -1,14 +1,12 @@
 # services/calendar_service.py
-import os
 import logging
 import re
 from datetime import datetime, timedelta, timezone
-import googleapiclient.discovery
-from google.oauth2.credentials import Credentials
 from flask import request
-from utils.supabae_utils import get_token_from_supabase  # fetch token from Supabase
+from utils.supabae_utils import get_user_from_supabase  # fetch user and token from Supabase
+from services.google_clients import get_service, invalidate_user
 from google.auth.exceptions import RefreshError
-from supabase_client import supabase  # your Supabase client
+from user_store import clear_token
 from dateutil.parser import parse
 
 # Configure logger
@@ -56,29 +54,20 @@ def _get_calendar_service():
     and returns a Google Calendar API service instance.
     """
     logger.debug("Entering _get_calendar_service()")
-    token = get_token_from_supabase()
+    user = get_user_from_supabase()
+    token = user.get("token")
     if not token:
         logger.error("No token found: user is not authenticated.")
         raise Exception("User not authenticated")
     try:
-        logger.debug("Found token. Building credentials object...")
-        creds = Credentials(
-            token=token.get('access_token'),
-            refresh_token=token.get('refresh_token'),
-            token_uri='https://oauth2.googleapis.com/token',
-            client_id=os.getenv("CLIENT_ID"),
-            client_secret=os.getenv("CLIENT_SECRET"),
-            scopes=token.get('scope').split() if token.get('scope') else None,
-            id_token=token.get('id_token')
-        )
-        logger.debug("Credentials object built. Building Calendar service...")
-        service = googleapiclient.discovery.build('calendar', 'v3', credentials=creds)
-        logger.info("Calendar service built successfully.")
+        service = get_service('calendar', 'v3', token, user.get("email"))
+        logger.info("Calendar service ready.")
         return service
     except RefreshError as e:
+        invalidate_user(user.get("email"))
         session_id = request.cookies.get("session_id")
         if session_id:
-            supabase.table("users").update({"token": {}}).eq("session_id", session_id).execute()
+            clear_token(session_id=session_id)
         raise Exception("Authentication failed: invalid credentials. Please reauthenticate.") from e
     except Exception as e:
         logger.exception("Failed to build Google Calendar service.")
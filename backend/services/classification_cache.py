@@ -0,0 +1,61 @@
+# services/classification_cache.py
+"""
+Content-addressed cache of parsed Claude classifications. The key is a hash of the
+email content, the prompt template version and the user's analysis profile, so a
+redelivered or re-processed email reuses its earlier result, while a prompt change or a
+new profile naturally misses. Entries are evicted by size (LRU) and age.
+"""
+import copy
+import hashlib
+import logging
+import os
+import threading
+
+from cachetools import TTLCache
+
+logger = logging.getLogger(__name__)
+
+CLASSIFICATION_CACHE_SIZE = int(os.getenv("CLASSIFICATION_CACHE_SIZE", "4096"))
+CLASSIFICATION_CACHE_TTL = int(os.getenv("CLASSIFICATION_CACHE_TTL", str(7 * 24 * 3600)))
+
+_cache = TTLCache(maxsize=CLASSIFICATION_CACHE_SIZE, ttl=CLASSIFICATION_CACHE_TTL)
+_cache_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "stores": 0}
+
+
+def _digest(text):
+    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+
+
+def make_key(email_id, email_content, prompt_version, analysis):
+    """
+    Build the cache key for one email. email_content is everything the prompt includes
+    about the email (subject, sender, body); the analysis profile is hashed on its own
+    so that a new profile version invalidates every entry for that user.
+    """
+    material = "\x1f".join([email_id or "", _digest(email_content), str(prompt_version), _digest(analysis)])
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+def get(key):
+    """
+    Return a copy of the cached classification for key, or None.
+    """
+    with _cache_lock:
+        classification = _cache.get(key)
+        if classification is None:
+            _stats["misses"] += 1
+            return None
+        _stats["hits"] += 1
+    return copy.deepcopy(classification)
+
+
+def put(key, classification):
+    with _cache_lock:
+        _cache[key] = copy.deepcopy(classification)
+        _stats["stores"] += 1
+
+
+def stats():
+    with _cache_lock:
+        return dict(_stats, size=len(_cache), maxsize=CLASSIFICATION_CACHE_SIZE, ttl=CLASSIFICATION_CACHE_TTL)
@@ -0,0 +1,596 @@
+# services/classification_engine.py
+"""
+Shared classification engine used by process_latest_emails and the Gmail push
+notification webhook. Each email goes through three stages -- fetch (full message),
+classify (prompt + Claude tool call + validation) and apply (labels, drafts, category lists) --
+on a bounded worker pool with a concurrency limit per stage, and the accumulated
+per-user state is written back to Supabase once, by persist_state.
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from googleapiclient.errors import HttpError
+
+import user_store
+from supabase_client import supabase
+from services import (
+    async_google,
+    claude_dispatcher,
+    classification_cache,
+    classification_schema,
+    dedup_store,
+    preclassifier,
+)
+from services.async_google import AsyncGoogleClient
+from services.anthropic_client import cached_text_block, get_anthropic_client
+from services.email_content import extract_email_content
+from services.gmail_service import create_draft_email, find_draft_for_thread, tag_email
+
+logger = logging.getLogger(__name__)
+
+CLAUDE_MODEL = "claude-3-5-haiku-20241022"
+# Bump whenever the classification prompt or its output format changes; it is part of
+# the classification cache key.
+PROMPT_VERSION = "4"
+
+# Per-stage concurrency limits. The pool is sized so every stage can run at its limit.
+FETCH_CONCURRENCY = int(os.getenv("CLASSIFY_FETCH_CONCURRENCY", "8"))
+CLASSIFY_CONCURRENCY = int(os.getenv("CLASSIFY_LLM_CONCURRENCY", "6"))
+APPLY_CONCURRENCY = int(os.getenv("CLASSIFY_APPLY_CONCURRENCY", "4"))
+MAX_WORKERS = max(FETCH_CONCURRENCY, CLASSIFY_CONCURRENCY, APPLY_CONCURRENCY)
+
+# Batched classification: up to CLASSIFY_BATCH_MAX_EMAILS emails are packed into one
+# Claude call while their estimated input stays under CLASSIFY_BATCH_TOKEN_BUDGET.
+# Set CLASSIFY_BATCH_MAX_EMAILS=1 to classify every email with its own call.
+BATCH_MAX_EMAILS = int(os.getenv("CLASSIFY_BATCH_MAX_EMAILS", "10"))
+BATCH_TOKEN_BUDGET = int(os.getenv("CLASSIFY_BATCH_TOKEN_BUDGET", "8000"))
+MAX_TOKENS_PER_EMAIL = 500
+BATCH_MAX_OUTPUT_TOKENS = 8192
+
+# Category -> (users column, Gmail label). "Draft" is handled separately.
+CATEGORY_TARGETS = {
+    "Promotion": ("promotions", "Promotion"),
+    "Information": ("information", "Information"),
+    "Action Required": ("action_required", "Action Required"),
+    "Receipts": ("receipts", "Receipts"),
+    "Meeting Update": ("meeting_updates", "Meeting Update"),
+    "None": ("others", "Other"),
+}
+CATEGORY_COLUMNS = ["promotions", "information", "drafts", "action_required", "receipts", "meeting_updates", "others"]
+
+
+# Static classification instructions. They are sent as a cached system block, so keep
+# anything per-user or per-email out of this text. The per-category output shapes are
+# the tool schemas in services/classification_schema.py.
+CLASSIFICATION_INSTRUCTIONS = (
+    "You are an assistant that analyzes and writes emails mimicking your client.\n"
+    "Classify the email you are given by calling exactly one of the classification tools. "
+    "Each tool's description says when to use it; if an email requires a reply via email, "
+    "always use classify_draft.\n"
+    "Fill in every field from the email itself and use an empty string for details the email does not contain."
+)
+# Instructions for batched calls, which offer only the classify_emails tool.
+BATCH_CLASSIFICATION_INSTRUCTIONS = (
+    "You are an assistant that analyzes and writes emails mimicking your client.\n"
+    "Classify every email you are given and record all of them with one call to classify_emails, "
+    "one item per email. The tool's description says when to use each category, and each item's "
+    "content must follow the schema of its category; if an email requires a reply via email, "
+    "always use the Draft category.\n"
+    "Fill in every field from the email itself and use an empty string for details the email does not contain."
+)
+# Output tokens allowed for the one-shot repair of an invalid tool call.
+REPAIR_MAX_TOKENS = 500
+
+
+def build_email_context(email_id, subject, from_email, body_text, thread_id):
+    return (
+        f"Email ID: {email_id}\n"
+        f"Subject: {subject}\n"
+        f"From: {from_email}\n"
+        f"Body: {body_text}\n"
+        f"Thread ID: {thread_id}\n"
+    )
+
+
+def build_classification_system(previous_analysis, batch=False):
+    """
+    System blocks for a classification call: the static instructions (single-email or
+    batched), then the user's analysis profile. Each ends with a cache breakpoint, so
+    repeated calls only pay full price for the email itself.
+    """
+    return [
+        cached_text_block(BATCH_CLASSIFICATION_INSTRUCTIONS if batch else CLASSIFICATION_INSTRUCTIONS),
+        cached_text_block(f"Previous analysis of your client:\n{previous_analysis}"),
+    ]
+
+
+def build_classification_message(email_context):
+    return "Email:\n" + email_context
+
+
+def classification_params(previous_analysis, message, max_tokens=MAX_TOKENS_PER_EMAIL, batch=False):
+    """
+    messages.create parameters for a classification call; also used for the requests
+    of an offline message batch (services/backfill.py). The reply is a forced tool call:
+    one of the per-category tools, or classify_emails for a batch.
+    """
+    if batch:
+        tools = [classification_schema.build_batch_tool()]
+        tool_choice = {"type": "tool", "name": classification_schema.BATCH_TOOL_NAME}
+    else:
+        tools = classification_schema.build_tools()
+        # One tool call per reply, so the repair turn has a single tool_use to answer.
+        tool_choice = {"type": "any", "disable_parallel_tool_use": True}
+    return {
+        "model": CLAUDE_MODEL,
+        "system": build_classification_system(previous_analysis, batch=batch),
+        "tools": tools,
+        "tool_choice": tool_choice,
+        "messages": [{"role": "user", "content": message}],
+        "max_tokens": max_tokens,
+        "temperature": 0.7,
+    }
+
+
+def build_batch_message(email_contexts):
+    parts = [
+        f"Classify each of the following {len(email_contexts)} emails independently and record "
+        "all of them with one call to classify_emails: one item per email, carrying that email's "
+        "Email ID as emailId.\n"
+    ]
+    for index, email_context in enumerate(email_contexts, start=1):
+        parts.append(f"Email {index}:\n{email_context}")
+    return "\n".join(parts)
+
+
+def estimate_tokens(text):
+    # ~4 characters per token is close enough for packing batches.
+    return len(text) // 4 + 1
+
+
+def parse_tool_response(content_blocks, email_id):
+    """
+    Return the valid classification for email_id from a single-email tool call, or None.
+    """
+    for _, name, tool_input in classification_schema.tool_uses(content_blocks):
+        if name in classification_schema.CATEGORY_BY_TOOL:
+            classification = classification_schema.classification_from_tool(name, tool_input)
+            if not classification_schema.validate_classification(classification, email_id):
+                return classification
+    return None
+
+
+def _assistant_turn(content_blocks):
+    # Echo the assistant's reply back as plain dicts for the repair request.
+    turn = []
+    for block in content_blocks:
+        if getattr(block, "type", None) == "tool_use":
+            turn.append({"type": "tool_use", "id": block.id, "name": block.name, "input": block.input})
+        elif getattr(block, "type", None) == "text":
+            turn.append({"type": "text", "text": block.text})
+    return turn
+
+
+def load_state(user_email, user_data):
+    """
+    Build a run's state from the users row (user_store.USER_COLUMNS) and load the
+    deduplication sets. The category items are not read: state["added"] collects the
+    items this run adds, and persist_state sends only those.
+    """
+    state = {"added": {column: [] for column in CATEGORY_COLUMNS}}
+    state["seen_emails"], state["seen_threads"] = dedup_store.load(user_email, user_data)
+    # Legacy dedup arrays still on the row are emptied once the sets are persisted.
+    state["clear_legacy_dedup"] = bool(user_data.get("latest_processed_emails") or user_data.get("latest_processed_threads"))
+    state["processed_emails"] = user_data.get("processed_emails") or 0
+    return state
+
+
+def persist_state(user_email, state, extra_fields=None):
+    """
+    Write the run's results back: the items it added go through user_store.add_items
+    (which touches only the affected categories), the dedup sets to their table, and the
+    counters to the users row in a single update.
+    """
+    update_data = {}
+    for column, items in state["added"].items():
+        user_store.add_items(user_email, column, items)
+    dedup_store.save(user_email, state["seen_emails"], state["seen_threads"])
+    if state.get("clear_legacy_dedup"):
+        update_data["latest_processed_emails"] = []
+        update_data["latest_processed_threads"] = []
+    update_data["processed_emails"] = state["processed_emails"]
+    update_data.update(extra_fields or {})
+    update_resp = supabase.table("users").update(update_data).eq("email", user_email).execute()
+    user_store.invalidate_user_cache(email=user_email)
+    if update_resp.dict().get("error"):
+        logger.error("Failed to update user record for %s: %s", user_email, update_resp.dict().get("error"))
+    else:
+        logger.info("User record updated for %s", user_email)
+    return update_resp
+
+
+class _Run:
+    """
+    State shared by the workers of one classification run. Every mutation of the
+    per-user lists happens under self.lock.
+    """
+
+    def __init__(self, service, user_email, token, user_data, skip_seen_threads):
+        self.service = service
+        self.user_email = user_email
+        self.client = AsyncGoogleClient(user_email, token)
+        self.state = load_state(user_email, user_data)
+        self.previous_analysis = user_data.get("analysis") or "No previous analysis available"
+        self.skip_seen_threads = skip_seen_threads
+        # Threads that were already handled before this run started.
+        self.seen_threads = self.state["seen_threads"].copy()
+        self.claimed_threads = set()
+        self.lock = threading.Lock()
+        self.fetch_slots = threading.BoundedSemaphore(FETCH_CONCURRENCY)
+        self.classify_slots = threading.BoundedSemaphore(CLASSIFY_CONCURRENCY)
+        self.apply_slots = threading.BoundedSemaphore(APPLY_CONCURRENCY)
+        self.claude_client = get_anthropic_client()
+        self.new_emails_count = 0
+
+    def mark_processed(self, email_id, thread_id=None, counted=True):
+        with self.lock:
+            self.state["seen_emails"].add(email_id)
+            if thread_id:
+                self.state["seen_threads"].add(thread_id)
+            if counted:
+                self.state["processed_emails"] += 1
+                self.new_emails_count += 1
+
+    # ── stage 1: fetch ───────────────────────────────────────────────────────
+    def fetch(self, email_id):
+        with self.fetch_slots:
+            return async_google.run(self.client.get_message(email_id, format="full"))
+
+    # ── stage 2: classify ────────────────────────────────────────────────────
+    def _call_claude(self, message, max_tokens, batch=False, history=None):
+        params = classification_params(self.previous_analysis, message, max_tokens, batch=batch)
+        if history:
+            params["messages"] = params["messages"] + history
+        with self.classify_slots:
+            response = claude_dispatcher.create(
+                self.claude_client,
+                priority=claude_dispatcher.PRIORITY_BACKGROUND,
+                **params,
+            )
+        return response.content
+
+    def classify(self, item):
+        """
+        Classify one email with its own call. An invalid tool call gets one repair
+        attempt: the validation errors go back as an error tool_result. Returns the
+        classification, or None when no valid one was produced.
+        """
+        email_id = item["emailId"]
+        prompt = build_classification_message(item["context"])
+        logger.debug("Claude prompt for email %s: %s", email_id, prompt)
+        content_blocks = self._call_claude(prompt, MAX_TOKENS_PER_EMAIL)
+        logger.debug("Claude response for email %s: %s", email_id, content_blocks)
+        classification = parse_tool_response(content_blocks, email_id)
+        if classification is None:
+            classification = self._repair(item, prompt, content_blocks)
+        if classification is not None:
+            classification_cache.put(item["cacheKey"], classification)
+        return classification
+
+    def _repair(self, item, prompt, content_blocks):
+        email_id = item["emailId"]
+        calls = classification_schema.tool_uses(content_blocks)
+        if not calls:
+            logger.error("Claude returned no tool call for email %s", email_id)
+            return None
+        tool_use_id, name, tool_input = calls[0]
+        if name in classification_schema.CATEGORY_BY_TOOL:
+            errors = classification_schema.validate_classification(
+                classification_schema.classification_from_tool(name, tool_input), email_id
+            )
+        else:
+            errors = [f"unknown tool {name!r}"]
+        logger.warning("Invalid classification for email %s (%s); attempting repair", email_id, "; ".join(errors))
+        # The API rejects a follow-up that leaves any tool_use unanswered, so every call
+        # gets a result; only the first one is the classification being repaired.
+        results = [{
+            "type": "tool_result",
+            "tool_use_id": tool_use_id,
+            "is_error": True,
+            "content": "Invalid input: " + "; ".join(errors) + ". Call the tool again with corrected input.",
+        }]
+        results.extend(
+            {
+                "type": "tool_result",
+                "tool_use_id": extra_id,
+                "is_error": True,
+                "content": "Ignored: classify the email with exactly one tool call.",
+            }
+            for extra_id, _, _ in calls[1:]
+        )
+        history = [
+            {"role": "assistant", "content": _assistant_turn(content_blocks)},
+            {"role": "user", "content": results},
+        ]
+        repaired = parse_tool_response(self._call_claude(prompt, REPAIR_MAX_TOKENS, history=history), email_id)
+        if repaired is None:
+            logger.error("Repair attempt for email %s did not produce a valid classification", email_id)
+        return repaired
+
+    def classify_batch(self, batch):
+        """
+        Classify several emails with one call. Returns {emailId: classification} for
+        the items that came back valid; the caller re-sends the rest individually.
+        """
+        prompt = build_batch_message([item["context"] for item in batch])
+        max_tokens = min(BATCH_MAX_OUTPUT_TOKENS, MAX_TOKENS_PER_EMAIL * len(batch))
+        content_blocks = self._call_claude(prompt, max_tokens, batch=True)
+        logger.debug("Claude batch response for %d emails: %s", len(batch), content_blocks)
+        entries = []
+        for _, name, tool_input in classification_schema.tool_uses(content_blocks):
+            if name == classification_schema.BATCH_TOOL_NAME and isinstance(tool_input.get("classifications"), list):
+                entries.extend(entry for entry in tool_input["classifications"] if isinstance(entry, dict))
+        by_id = {entry.get("emailId"): entry for entry in entries}
+        classified = {}
+        for item in batch:
+            classification = by_id.get(item["emailId"])
+            if classification is not None and not classification_schema.validate_classification(classification, item["emailId"]):
+                classification_cache.put(item["cacheKey"], classification)
+                classified[item["emailId"]] = classification
+        return classified
+
+    def _pack(self, items):
+        batches = []
+        current, current_tokens = [], 0
+        for item in items:
+            tokens = estimate_tokens(item["context"])
+            if current and (len(current) >= BATCH_MAX_EMAILS or current_tokens + tokens > BATCH_TOKEN_BUDGET):
+                batches.append(current)
+                current, current_tokens = [], 0
+            current.append(item)
+            current_tokens += tokens
+        if current:
+            batches.append(current)
+        return batches
+
+    def classify_all(self, items, pool, precomputed=None, preclassified=()):
+        """
+        Classify every prepared item: precomputed results, pre-classifier rules and
+        cache hits first, then the misses in packed batches, then each item a batch did
+        not return validly on its own. Returns {emailId: classification, None (no valid
+        tool call) or the raised exception}.
+        """
+        classifications = {}
+        misses = []
+        for item in items:
+            if precomputed and item["emailId"] in precomputed:
+                # Pre-classifier results are kept out of the sender history, wherever they ran.
+                item["preclassified"] = item["emailId"] in preclassified
+                classifications[item["emailId"]] = precomputed[item["emailId"]]
+                continue
+            ruled = preclassifier.classify(self.user_email, item["detail"])
+            if ruled is not None:
+                item["preclassified"] = True
+                classifications[item["emailId"]] = ruled
+                continue
+            cached = classification_cache.get(item["cacheKey"])
+            if cached is not None:
+                logger.info("Reusing cached classification for email %s", item["emailId"])
+                classifications[item["emailId"]] = cached
+            else:
+                misses.append(item)
+
+        singles = []
+        batches = self._pack(misses) if BATCH_MAX_EMAILS > 1 else [[item] for item in misses]
+        multi = [batch for batch in batches if len(batch) > 1]
+        singles.extend(batch[0] for batch in batches if len(batch) == 1)
+
+        def run_batch(batch):
+            try:
+                return self.classify_batch(batch)
+            except Exception as e:
+                logger.error("Batched classification of %d emails failed: %s", len(batch), e, exc_info=True)
+                return e
+
+        for batch, outcome in zip(multi, pool.map(run_batch, multi)):
+            if isinstance(outcome, Exception):
+                for item in batch:
+                    classifications[item["emailId"]] = outcome
+                continue
+            classifications.update(outcome)
+            retry = [item for item in batch if item["emailId"] not in outcome]
+            if retry:
+                logger.info("Re-sending %d of %d batched emails individually.", len(retry), len(batch))
+            singles.extend(retry)
+        if multi:
+            logger.info("Classified %d emails in %d batched call(s).", sum(len(b) for b in multi), len(multi))
+
+        def run_single(item):
+            try:
+                return self.classify(item)
+            except Exception as e:
+                logger.error("Classification of email %s failed: %s", item["emailId"], e, exc_info=True)
+                return e
+
+        for item, outcome in zip(singles, pool.map(run_single, singles)):
+            classifications[item["emailId"]] = outcome
+        return classifications
+
+    # ── stage 3: apply ───────────────────────────────────────────────────────
+    def apply(self, email_id, classification, subject, from_email, thread_id):
+        """
+        Tag the message and record it under its category. Returns False when the
+        email should stay unprocessed so a later run can retry it.
+        """
+        category = classification.get("category", "")
+        content = classification.get("content", {})
+        sender = classification.get("sender", {})
+
+        with self.apply_slots:
+            if category == "Draft":
+                return self._apply_draft(email_id, content, sender, subject, from_email, thread_id)
+
+            target = CATEGORY_TARGETS.get(category)
+            if target is None:
+                logger.info("Email %s classified as unrecognized category: %s", email_id, category)
+                return True
+            column, label = target
+            try:
+                tag_email(email_id, add_labels=[label], service=self.service)
+            except Exception as tag_err:
+                logger.error("Failed to tag email %s as %s: %s", email_id, label, tag_err)
+        with self.lock:
+            # A reprocessed email (e.g. after /watch resets deduplication) replaces its old
+            # entry: add_items replaces items by emailId.
+            item = {
+                "emailId": email_id,
+                "sender": sender,
+                "content": content
+            }
+            added = self.state["added"][column]
+            added[:] = [existing for existing in added if existing.get("emailId") != email_id]
+            added.append(item)
+        logger.info("Email %s classified as %s.", email_id, category)
+        return True
+
+    def _apply_draft(self, email_id, content, sender, subject, from_email, thread_id):
+        logger.info("Email %s classified as Draft.", email_id)
+        gmail_draft_id = find_draft_for_thread(self.service, thread_id)
+        if gmail_draft_id is None and thread_id not in self.seen_threads:
+            reply_subject = f"Re: {subject}" if not subject.lower().startswith("re:") else subject
+            try:
+                draft_response = create_draft_email(
+                    to=from_email,
+                    subject=reply_subject,
+                    body=content.get("draftContent", ""),
+                    service=self.service,
+                    thread_id=thread_id,
+                )
+                gmail_draft_id = draft_response.get("id")
+                logger.info("Created Gmail draft %s for email %s", gmail_draft_id, email_id)
+            except Exception as draft_err:
+                logger.error("Failed to create draft for email %s: %s", email_id, draft_err)
+                return False
+            try:
+                tag_email(email_id, add_labels=["To Respond"], service=self.service)
+            except Exception as tag_err:
+                logger.error("Failed to tag email %s as 'To Respond': %s", email_id, tag_err)
+        elif gmail_draft_id is not None:
+            logger.info("Draft already exists for email %s.", email_id)
+
+        if gmail_draft_id is not None:
+            with self.lock:
+                if not any(d.get("emailId") == email_id for d in self.state["added"]["drafts"]):
+                    item = {
+                        "emailId": email_id,
+                        "sender": sender,
+                        "draft": content,
+                        "gmailDraftId": gmail_draft_id
+                    }
+                    self.state["added"]["drafts"].append(item)
+        return True
+
+    # ── per-email steps around classification ────────────────────────────────
+    def prepare(self, email_id):
+        """
+        Fetch one email and build what classification needs. Returns the prepared
+        item, a result dict on error, or None when the email is skipped.
+        """
+        try:
+            try:
+                email_detail = self.fetch(email_id)
+            except HttpError as e:
+                if e.resp.status == 404:
+                    logger.error("Email %s not found; skipping.", email_id)
+                    self.mark_processed(email_id, counted=False)
+                    return None
+                raise
+
+            subject, from_email, body_text = extract_email_content(email_detail)
+            thread_id = email_detail.get("threadId", "")
+            if self.skip_seen_threads:
+                with self.lock:
+                    already_seen = thread_id in self.seen_threads or thread_id in self.claimed_threads
+                    self.claimed_threads.add(thread_id)
+                if already_seen:
+                    logger.info("Thread %s already processed; skipping Claude classification for email %s.", thread_id, email_id)
+                    self.mark_processed(email_id, counted=False)
+                    return None
+
+            email_context = build_email_context(email_id, subject, from_email, body_text, thread_id)
+            return {
+                "emailId": email_id,
+                "detail": email_detail,
+                "subject": subject,
+                "from": from_email,
+                "threadId": thread_id,
+                "context": email_context,
+                "cacheKey": classification_cache.make_key(email_id, email_context, PROMPT_VERSION, self.previous_analysis),
+            }
+        except Exception as e:
+            logger.error("Error processing email %s: %s", email_id, e, exc_info=True)
+            return {"emailId": email_id, "error": "Processing error"}
+
+    def finish(self, item, classification):
+        email_id = item["emailId"]
+        try:
+            if isinstance(classification, Exception):
+                return {"emailId": email_id, "error": "Processing error"}
+            # None means Claude did not produce a valid tool call, even after the repair attempt.
+            if not isinstance(classification, dict) or classification.get("emailId") != email_id:
+                logger.error("No valid classification for email %s.", email_id)
+                self.mark_processed(email_id)
+                return {"emailId": email_id, "error": "Invalid classification format"}
+
+            if not self.apply(email_id, classification, item["subject"], item["from"], item["threadId"]):
+                return {"emailId": email_id, "error": "Processing error"}
+            if not item.get("preclassified"):
+                preclassifier.record(self.user_email, item["detail"], classification.get("category"))
+            self.mark_processed(email_id, item["threadId"])
+            return {"emailId": email_id, "classification": classification}
+        except Exception as e:
+            logger.error("Error processing email %s: %s", email_id, e, exc_info=True)
+            return {"emailId": email_id, "error": "Processing error"}
+
+
+def run_classification(service, user_email, token, user_data, email_ids, skip_seen_threads=False,
+                       precomputed=None, preclassified=()):
+    """
+    Classify email_ids for one user. Emails already in the user's dedup set are
+    skipped; with skip_seen_threads, emails whose thread was already processed are
+    skipped before calling Claude. precomputed maps email IDs to classifications that
+    were obtained elsewhere (e.g. an offline batch) and are applied as-is; those listed in
+    preclassified came from the pre-classifier and do not feed its sender history. Cache misses
+    are classified in packed batches. Returns a dict with the updated "state" (ready for
+    persist_state), per-email "results" in input order, and "new_emails_count".
+    """
+    run = _Run(service, user_email, token, user_data, skip_seen_threads)
+    already_processed = run.state["seen_emails"]
+    pending = []
+    for email_id in email_ids:
+        if email_id in already_processed:
+            logger.info("Skipping already processed email ID: %s", email_id)
+        elif email_id not in pending:
+            pending.append(email_id)
+
+    results_by_id = {}
+    if pending:
+        with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(pending)), thread_name_prefix="classify") as pool:
+            items = []
+            for email_id, prepared in zip(pending, pool.map(run.prepare, pending)):
+                if prepared is None:
+                    continue
+                if "error" in prepared:
+                    results_by_id[email_id] = prepared
+                else:
+                    items.append(prepared)
+
+            classifications = run.classify_all(items, pool, precomputed, preclassified)
+            finished = pool.map(lambda item: run.finish(item, classifications.get(item["emailId"])), items)
+            for item, result in zip(items, finished):
+                results_by_id[item["emailId"]] = result
+    results = [results_by_id[email_id] for email_id in pending if email_id in results_by_id]
+
+    return {"state": run.state, "results": results, "new_emails_count": run.new_emails_count}
@@ -0,0 +1,261 @@
+# services/classification_schema.py
+"""
+Tool definitions and validation for structured email classification.
+
+Each category is a Claude tool whose input_schema is the category's content shape, so
+Claude returns the classification as a tool call instead of free-form JSON text. A
+second tool, classify_emails, carries several classifications at once for batched calls;
+its items repeat the per-category guidance and content schemas.
+validate_classification checks a result against the same schemas with a small
+JSON-schema subset (object/string/array types, required, enum).
+"""
+
+SENDER_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "name": {"type": "string", "description": "Sender name"},
+        "type": {"type": "string", "enum": ["Individual", "Company"]},
+    },
+    "required": ["name", "type"],
+}
+
+
+def _content_schema(properties, required):
+    return {
+        "type": "object",
+        "properties": {name: {"type": "string", "description": description} for name, description in properties},
+        "required": required,
+    }
+
+
+# category, tool name, when to use it, content schema
+CATEGORY_SPECS = [
+    (
+        "Draft",
+        "classify_draft",
+        "Use this classification for all emails that require a reply via email. If choosing between "
+        "another classification and this one, always choose this one. It should include a subject line "
+        "for the reply and a draft version of the reply content, written the way the client writes.",
+        _content_schema(
+            [("replySubject", "Subject for the reply"), ("draftContent", "Draft reply content")],
+            ["replySubject", "draftContent"],
+        ),
+    ),
+    (
+        "Promotion",
+        "classify_promotion",
+        "Use this classification when the email is advertising a product, service, or special offer. "
+        "Include a clear promotion title, detailed information about the promotion, and the expiration "
+        "date in the form mm/dd/yyyy. If you cannot find a specific expiration date, please give your best estimate.",
+        _content_schema(
+            [
+                ("title", "Promotion title"),
+                ("details", "Promotion details"),
+                ("expiration", "Promotion expiration date, mm/dd/yyyy"),
+            ],
+            ["title", "details", "expiration"],
+        ),
+    ),
+    (
+        "Information",
+        "classify_information",
+        "Use this classification when the email is primarily providing general information or updates "
+        "without requiring any action or response.",
+        _content_schema([("summary", "Summary of the information")], ["summary"]),
+    ),
+    (
+        "Action Required",
+        "classify_action_required",
+        "Use this classification when the email includes specific tasks, requests, or instructions that go "
+        "beyond a response email. Include a list of the action items and a summary of why these actions are needed.",
+        _content_schema(
+            [("actionPoints", "Summary of action items"), ("summary", "Summary of the purpose of the actions")],
+            ["actionPoints", "summary"],
+        ),
+    ),
+    (
+        "Receipts",
+        "classify_receipt",
+        "Use this classification when the email pertains to financial transactions or orders. It should include "
+        "an order or receipt number, the total amount (if applicable), and a brief summary of the transaction details.",
+        _content_schema(
+            [
+                ("orderNumber", "Order or receipt number if available"),
+                ("totalAmount", "Total amount if applicable"),
+                ("summary", "Receipt details summary"),
+            ],
+            ["summary"],
+        ),
+    ),
+    (
+        "Meeting Update",
+        "classify_meeting_update",
+        "Use this classification when the email communicates changes to a scheduled meeting. It should list the "
+        "previous meeting details (date, time, and location) and the updated meeting details, along with any "
+        "additional notes.",
+        _content_schema(
+            [
+                ("meetingSubject", "Meeting subject"),
+                ("oldDateTime", "Old meeting date and time"),
+                ("oldLocation", "Old meeting location or link"),
+                ("newDateTime", "New meeting date and time"),
+                ("newLocation", "New meeting location or link"),
+                ("additionalNotes", "Any additional meeting details"),
+                ("summary", "Summary of the meeting update"),
+            ],
+            ["meetingSubject", "summary"],
+        ),
+    ),
+    (
+        "None",
+        "classify_other",
+        "Use this classification when the email does not clearly fit into any of the above categories. "
+        "Simply provide a brief summary of the email content.",
+        _content_schema([("summary", "Summary of the email")], ["summary"]),
+    ),
+]
+
+CATEGORY_BY_TOOL = {tool_name: category for category, tool_name, _, _ in CATEGORY_SPECS}
+CONTENT_SCHEMAS = {category: schema for category, _, _, schema in CATEGORY_SPECS}
+BATCH_TOOL_NAME = "classify_emails"
+
+
+def _tool(tool_name, description, content_schema):
+    return {
+        "name": tool_name,
+        "description": description,
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "emailId": {"type": "string", "description": "The Email ID given with the email"},
+                "sender": SENDER_SCHEMA,
+                "content": content_schema,
+            },
+            "required": ["emailId", "sender", "content"],
+        },
+    }
+
+
+def build_tools():
+    """
+    One tool per category. The last tool carries a cache breakpoint so the whole tool
+    list is served from the prompt cache.
+    """
+    tools = [_tool(tool_name, description, schema) for _, tool_name, description, schema in CATEGORY_SPECS]
+    tools[-1] = dict(tools[-1], cache_control={"type": "ephemeral"})
+    return tools
+
+
+def _batch_item(category, description, content_schema):
+    return {
+        "type": "object",
+        "description": f"{category}: {description}",
+        "properties": {
+            "category": {"type": "string", "enum": [category]},
+            "emailId": {"type": "string", "description": "The Email ID given with the email"},
+            "sender": SENDER_SCHEMA,
+            "content": content_schema,
+        },
+        "required": ["category", "emailId", "sender", "content"],
+    }
+
+
+def build_batch_tool():
+    """
+    A single tool carrying one classification per email, for batched calls. Each item is
+    one of the per-category shapes (anyOf keyed on category), with the same guidance and
+    content schema as the matching single-email tool.
+    """
+    guidance = "\n".join(f"- {category}: {description}" for category, _, description, _ in CATEGORY_SPECS)
+    return {
+        "name": BATCH_TOOL_NAME,
+        "description": (
+            "Record the classification of every email in the request, one item per email. "
+            "Choose each item's category as follows:\n" + guidance
+        ),
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "classifications": {
+                    "type": "array",
+                    "items": {
+                        "anyOf": [
+                            _batch_item(category, description, schema)
+                            for category, _, description, schema in CATEGORY_SPECS
+                        ],
+                    },
+                }
+            },
+            "required": ["classifications"],
+        },
+        "cache_control": {"type": "ephemeral"},
+    }
+
+
+def _errors(value, schema, path):
+    expected = schema.get("type")
+    if expected == "object":
+        if not isinstance(value, dict):
+            return [f"{path} must be an object"]
+        errors = [f"{path}.{key} is required" for key in schema.get("required", []) if key not in value]
+        for key, subschema in schema.get("properties", {}).items():
+            if key in value:
+                errors.extend(_errors(value[key], subschema, f"{path}.{key}"))
+        return errors
+    if expected == "array":
+        if not isinstance(value, list):
+            return [f"{path} must be an array"]
+        errors = []
+        for index, item in enumerate(value):
+            errors.extend(_errors(item, schema.get("items", {}), f"{path}[{index}]"))
+        return errors
+    if expected == "string":
+        if not isinstance(value, str):
+            return [f"{path} must be a string"]
+        if "enum" in schema and value not in schema["enum"]:
+            return [f"{path} must be one of {schema['enum']}"]
+    return []
+
+
+def validate_classification(classification, email_id=None):
+    """
+    Return a list of problems with a classification dict (empty when it is valid).
+    """
+    if not isinstance(classification, dict):
+        return ["classification must be an object"]
+    category = classification.get("category")
+    if category not in CONTENT_SCHEMAS:
+        return [f"unknown category {category!r}"]
+    errors = []
+    if email_id is not None and classification.get("emailId") != email_id:
+        errors.append(f"emailId must be {email_id!r}")
+    errors.extend(_errors(classification.get("sender"), SENDER_SCHEMA, "sender"))
+    errors.extend(_errors(classification.get("content"), CONTENT_SCHEMAS[category], "content"))
+    return errors
+
+
+def _field(block, name):
+    return block.get(name) if isinstance(block, dict) else getattr(block, name, None)
+
+
+def tool_uses(content_blocks):
+    """
+    Return (id, name, input) for every tool_use block in a response's content.
+    """
+    return [
+        (_field(block, "id"), _field(block, "name"), _field(block, "input") or {})
+        for block in content_blocks or []
+        if _field(block, "type") == "tool_use"
+    ]
+
+
+def classification_from_tool(name, tool_input):
+    """
+    Turn a single-category tool call into the classification dict the app stores.
+    """
+    return {
+        "category": CATEGORY_BY_TOOL.get(name),
+        "emailId": tool_input.get("emailId"),
+        "sender": tool_input.get("sender"),
+        "content": tool_input.get("content"),
+    }
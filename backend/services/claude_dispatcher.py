@@ -0,0 +1,263 @@
+# services/claude_dispatcher.py
+"""
+Admission control in front of every Claude messages.create call.
+
+Calls are admitted in priority order against two token buckets, one for requests per
+minute (CLAUDE_RPM_LIMIT) and one for tokens per minute (CLAUDE_TPM_LIMIT). A call that
+would wait longer than its priority's queue budget, or that finds the queue full, is
+rejected with DispatcherOverloaded instead of piling up. A 429 or 529 from Anthropic
+pauses all admissions for the retry-after period before the call is retried. The SDK's
+own retries are off (max_retries=0), so transient 5xx responses, connection errors and
+timeouts are retried here with a short backoff.
+"""
+import heapq
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+import anthropic
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+RPM_LIMIT = int(os.getenv("CLAUDE_RPM_LIMIT", "50"))
+TPM_LIMIT = int(os.getenv("CLAUDE_TPM_LIMIT", "50000"))
+MAX_QUEUE_DEPTH = int(os.getenv("CLAUDE_MAX_QUEUE_DEPTH", "200"))
+# Longest a call may wait for admission before it is rejected, per priority.
+MAX_QUEUE_WAIT = {
+    PRIORITY_INTERACTIVE: float(os.getenv("CLAUDE_MAX_WAIT_INTERACTIVE", "30")),
+    PRIORITY_BACKGROUND: float(os.getenv("CLAUDE_MAX_WAIT_BACKGROUND", "300")),
+}
+MAX_RETRIES = int(os.getenv("CLAUDE_DISPATCH_RETRIES", "3"))
+RETRY_STATUSES = {429, 529}
+# Transient server errors are retried with a short backoff without pausing other calls,
+# as are connection failures and timeouts (APITimeoutError is an APIConnectionError).
+TRANSIENT_STATUSES = {500, 502, 503, 504}
+TRANSIENT_ERRORS = (anthropic.APIConnectionError,)
+DEFAULT_RETRY_AFTER = 5.0
+
+
+class DispatcherOverloaded(Exception):
+    """Raised when a Claude call cannot be admitted within its queue budget."""
+
+
+class _TokenBucket:
+    """
+    Bucket refilled continuously at capacity per minute. Not thread-safe on its own;
+    the dispatcher only touches it while holding _cond.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = float(capacity)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount):
+        self.tokens -= min(amount, self.capacity)
+
+    def give_back(self, amount):
+        # Negative amounts put the bucket into debt when a call used more than estimated.
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+_cond = threading.Condition()
+_queue = []
+_sequence = itertools.count()
+_request_bucket = _TokenBucket(RPM_LIMIT)
+_token_bucket = _TokenBucket(TPM_LIMIT)
+_paused_until = 0.0
+_in_flight = 0
+_recent_waits = deque(maxlen=200)
+_counters = {"admitted": 0, "rejected": 0, "throttled": 0, "failed": 0}
+USAGE_FIELDS = ("input_tokens", "output_tokens", "cache_creation_input_tokens", "cache_read_input_tokens")
+_usage_totals = dict.fromkeys(USAGE_FIELDS, 0)
+
+
+def estimate_tokens(params):
+    """
+    Rough token estimate for a messages.create call: ~4 characters per input token plus
+    the full max_tokens allowance for the reply.
+    """
+    text = json.dumps(
+        [params.get("system"), params.get("messages"), params.get("tools")],
+        default=str,
+    )
+    return len(text) // 4 + int(params.get("max_tokens") or 0)
+
+
+def _reject(reason, priority):
+    _counters["rejected"] += 1
+    logger.warning("Rejected Claude call (priority %s): %s", priority, reason)
+    raise DispatcherOverloaded(reason)
+
+
+def _admit(priority, estimated_tokens):
+    global _in_flight
+    with _cond:
+        if len(_queue) >= MAX_QUEUE_DEPTH:
+            _reject(f"queue full ({len(_queue)} waiting)", priority)
+        ticket = (priority, next(_sequence))
+        heapq.heappush(_queue, ticket)
+        enqueued = time.monotonic()
+        deadline = enqueued + MAX_QUEUE_WAIT.get(priority, MAX_QUEUE_WAIT[PRIORITY_BACKGROUND])
+        try:
+            while True:
+                now = time.monotonic()
+                if _queue[0] == ticket:
+                    wait = max(
+                        _paused_until - now,
+                        _request_bucket.wait_time(1, now),
+                        _token_bucket.wait_time(estimated_tokens, now),
+                    )
+                    if wait <= 0:
+                        _request_bucket.take(1)
+                        _token_bucket.take(estimated_tokens)
+                        break
+                    if now + wait > deadline:
+                        _reject(f"rate limit wait {wait:.1f}s exceeds queue budget", priority)
+                    _cond.wait(wait)
+                else:
+                    if now >= deadline:
+                        _reject("timed out waiting behind higher-priority calls", priority)
+                    _cond.wait(deadline - now)
+        finally:
+            _queue.remove(ticket)
+            heapq.heapify(_queue)
+            _cond.notify_all()
+        waited = time.monotonic() - enqueued
+        _recent_waits.append(waited)
+        _counters["admitted"] += 1
+        _in_flight += 1
+    if waited > 1:
+        logger.info("Claude call waited %.2fs for admission (priority %s)", waited, priority)
+
+
+def _release(estimated_tokens, response):
+    global _in_flight
+    usage = getattr(response, "usage", None)
+    counts = {field: getattr(usage, field, 0) or 0 for field in USAGE_FIELDS} if usage is not None else None
+    with _cond:
+        _in_flight -= 1
+        if counts is not None:
+            for field, value in counts.items():
+                _usage_totals[field] += value
+            # Cached prefix tokens still count towards the input token limit.
+            actual = sum(counts.values())
+            _token_bucket.give_back(estimated_tokens - actual)
+        _cond.notify_all()
+    if counts is not None:
+        logger.info(
+            "Claude usage: input=%d cache_write=%d cache_read=%d output=%d",
+            counts["input_tokens"],
+            counts["cache_creation_input_tokens"],
+            counts["cache_read_input_tokens"],
+            counts["output_tokens"],
+        )
+
+
+def _retry_after(exc):
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    value = headers.get("retry-after")
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER
+
+
+def is_transient(exc):
+    """
+    True for errors worth retrying: rate limits, overload, transient 5xx responses,
+    connection errors and timeouts. Also used by callers that reach the API without going
+    through create() (the message batch client in services/backfill.py).
+    """
+    status = getattr(exc, "status_code", None)
+    return status in RETRY_STATUSES or status in TRANSIENT_STATUSES or isinstance(exc, TRANSIENT_ERRORS)
+
+
+def _pause(seconds):
+    global _paused_until
+    with _cond:
+        _paused_until = max(_paused_until, time.monotonic() + seconds)
+        _counters["throttled"] += 1
+        _cond.notify_all()
+
+
+def create(client, priority=PRIORITY_INTERACTIVE, **params):
+    """
+    Call client.messages.create(**params) once admitted by the rate limiter. Raises
+    DispatcherOverloaded when the call cannot be admitted in time; any other API error
+    is raised unchanged once retries are exhausted.
+    """
+    estimated_tokens = estimate_tokens(params)
+    attempt = 0
+    while True:
+        _admit(priority, estimated_tokens)
+        response = None
+        try:
+            response = client.messages.create(**params)
+            return response
+        except Exception as e:
+            status = getattr(e, "status_code", None)
+            if status in RETRY_STATUSES and attempt < MAX_RETRIES:
+                attempt += 1
+                delay = _retry_after(e)
+                logger.warning("Claude returned %s; pausing dispatch for %.1fs (retry %d)", status, delay, attempt)
+                _pause(delay)
+                continue
+            if (status in TRANSIENT_STATUSES or isinstance(e, TRANSIENT_ERRORS)) and attempt < MAX_RETRIES:
+                attempt += 1
+                logger.warning("Claude call failed (%s); retrying (retry %d)", status or type(e).__name__, attempt)
+                time.sleep(0.5 * (2 ** attempt))
+                continue
+            with _cond:
+                _counters["failed"] += 1
+            raise
+        finally:
+            _release(estimated_tokens, response)
+
+
+def stats():
+    """
+    Snapshot of the dispatcher: queue depth per priority, in-flight calls, admission
+    wait times, bucket levels and counters.
+    """
+    with _cond:
+        now = time.monotonic()
+        _request_bucket._refill(now)
+        _token_bucket._refill(now)
+        waits = sorted(_recent_waits)
+        depth = {"interactive": 0, "background": 0}
+        for priority, _ in _queue:
+            depth["interactive" if priority == PRIORITY_INTERACTIVE else "background"] += 1
+        return {
+            "queue_depth": len(_queue),
+            "queue_depth_by_priority": depth,
+            "in_flight": _in_flight,
+            "avg_wait_seconds": round(sum(waits) / len(waits), 3) if waits else 0.0,
+            "p95_wait_seconds": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 3) if waits else 0.0,
+            "paused_for_seconds": round(max(0.0, _paused_until - now), 3),
+            "requests_available": round(_request_bucket.tokens, 2),
+            "tokens_available": round(_token_bucket.tokens),
+            "usage": dict(_usage_totals),
+            "limits": {"rpm": RPM_LIMIT, "tpm": TPM_LIMIT, "max_queue_depth": MAX_QUEUE_DEPTH},
+            **_counters,
+        }
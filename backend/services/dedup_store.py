@@ -0,0 +1,195 @@
+# services/dedup_store.py
+"""
+Bounded deduplication of processed email and thread IDs.
+
+Each user has two DedupSets (emails and threads). A DedupSet keeps the most recent
+DEDUP_WINDOW IDs in an exact set; IDs that fall out of the window go into a Bloom
+filter. The filter rotates through two generations of DEDUP_BLOOM_CAPACITY IDs each,
+so the stored size is fixed no matter how long the mailbox has been processed, and
+membership is O(1). A Bloom filter answers "maybe" for a small fraction
+(about 2 x DEDUP_BLOOM_ERROR) of IDs it never saw; keep the error rate low, since such
+an email is skipped as already processed.
+
+Sets are persisted as one row per user in the processed_dedup table (see
+sql/processed_dedup.sql). The first load for a user without a row seeds the sets
+from the legacy latest_processed_emails / latest_processed_threads arrays. Filter bits
+are stored zlib-compressed, since a filter that is far from full is mostly zeros.
+"""
+import base64
+import hashlib
+import logging
+import math
+import os
+import time
+import zlib
+from collections import OrderedDict
+
+from supabase_client import supabase
+
+logger = logging.getLogger(__name__)
+
+DEDUP_WINDOW = int(os.getenv("DEDUP_WINDOW", "500"))
+DEDUP_BLOOM_CAPACITY = int(os.getenv("DEDUP_BLOOM_CAPACITY", "10000"))
+DEDUP_BLOOM_ERROR = float(os.getenv("DEDUP_BLOOM_ERROR", "0.0001"))
+
+
+class BloomFilter:
+    """
+    Fixed-size Bloom filter over strings, using double hashing of one blake2b digest.
+    """
+
+    def __init__(self, num_bits, num_hashes, bits=None, count=0):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bits if bits is not None else bytearray((num_bits + 7) // 8)
+        self.count = count
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate):
+        num_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        num_hashes = max(1, int(round(num_bits / capacity * math.log(2))))
+        return cls(num_bits, num_hashes)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    def to_dict(self):
+        return {
+            "bits": base64.b64encode(zlib.compress(bytes(self.bits))).decode("ascii"),
+            "num_bits": self.num_bits,
+            "num_hashes": self.num_hashes,
+            "count": self.count,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data["num_bits"],
+            data["num_hashes"],
+            bytearray(zlib.decompress(base64.b64decode(data["bits"]))),
+            data.get("count", 0),
+        )
+
+
+class DedupSet:
+    """
+    Windowed exact set in front of a two-generation Bloom filter.
+    """
+
+    def __init__(self, recent=(), current=None, previous=None):
+        self.recent = OrderedDict((key, None) for key in recent)
+        # Filters are created on the first eviction, so small mailboxes store only the window.
+        self.current = current
+        self.previous = previous
+        self.dirty = False
+
+    def __contains__(self, key):
+        if not key:
+            return False
+        return any(key in part for part in (self.recent, self.current, self.previous) if part is not None)
+
+    def add(self, key):
+        if not key or key in self.recent:
+            return
+        self.recent[key] = None
+        self.dirty = True
+        while len(self.recent) > DEDUP_WINDOW:
+            evicted, _ = self.recent.popitem(last=False)
+            self._remember(evicted)
+
+    def _remember(self, key):
+        if self.current is None or self.current.count >= DEDUP_BLOOM_CAPACITY:
+            self.previous = self.current
+            self.current = BloomFilter.for_capacity(DEDUP_BLOOM_CAPACITY, DEDUP_BLOOM_ERROR)
+        self.current.add(key)
+
+    def copy(self):
+        return DedupSet.from_dict(self.to_dict())
+
+    def to_dict(self):
+        return {
+            "recent": list(self.recent),
+            "current": self.current.to_dict() if self.current is not None else None,
+            "previous": self.previous.to_dict() if self.previous is not None else None,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        data = data or {}
+        return cls(
+            data.get("recent") or [],
+            BloomFilter.from_dict(data["current"]) if data.get("current") else None,
+            BloomFilter.from_dict(data["previous"]) if data.get("previous") else None,
+        )
+
+    @classmethod
+    def from_ids(cls, ids):
+        dedup = cls()
+        for key in ids or []:
+            dedup.add(key)
+        return dedup
+
+
+def load(user_email, user_data=None):
+    """
+    Return (emails, threads) DedupSets for a user. Without a stored row they are seeded
+    from the legacy arrays in user_data and marked dirty so the next save creates the row.
+    """
+    response = (
+        supabase.table("processed_dedup")
+        .select("emails, threads")
+        .eq("user_email", user_email)
+        .execute()
+    )
+    if response.data:
+        row = response.data[0]
+        return DedupSet.from_dict(row.get("emails")), DedupSet.from_dict(row.get("threads"))
+    user_data = user_data or {}
+    emails = DedupSet.from_ids(user_data.get("latest_processed_emails"))
+    threads = DedupSet.from_ids(user_data.get("latest_processed_threads"))
+    emails.dirty = threads.dirty = True
+    if user_data.get("latest_processed_emails") or user_data.get("latest_processed_threads"):
+        logger.info("Seeded dedup sets for %s from the legacy arrays", user_email)
+    return emails, threads
+
+
+def save(user_email, emails, threads):
+    """
+    Persist both sets if either changed.
+    """
+    if not emails.dirty and not threads.dirty:
+        return None
+    response = supabase.table("processed_dedup").upsert(
+        {
+            "user_email": user_email,
+            "emails": emails.to_dict(),
+            "threads": threads.to_dict(),
+            "updated_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        },
+        on_conflict="user_email",
+    ).execute()
+    emails.dirty = threads.dirty = False
+    return response
+
+
+def reset(user_email):
+    """
+    Forget everything processed for a user (e.g. when a new Gmail watch starts).
+    """
+    return save(user_email, _dirty(DedupSet()), _dirty(DedupSet()))
+
+
+def _dirty(dedup):
+    dedup.dirty = True
+    return dedup
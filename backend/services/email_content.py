@@ -0,0 +1,275 @@
+# services/email_content.py
+"""
+Plain-text extraction from Gmail message resources for the classifier.
+
+The MIME tree is walked for the best body part (text/plain preferred, text/html
+converted to text otherwise, attachments skipped), quoted reply history and signatures
+are removed, and the result is capped at EMAIL_BODY_TOKEN_BUDGET tokens. Results are
+cached per message ID since a message's content never changes.
+"""
+import base64
+import logging
+import os
+import re
+import threading
+from html.parser import HTMLParser
+
+from cachetools import LRUCache
+
+logger = logging.getLogger(__name__)
+
+EMAIL_BODY_TOKEN_BUDGET = int(os.getenv("EMAIL_BODY_TOKEN_BUDGET", "1500"))
+EMAIL_CONTENT_CACHE_SIZE = int(os.getenv("EMAIL_CONTENT_CACHE_SIZE", "2048"))
+CHARS_PER_TOKEN = 4
+TRUNCATION_MARKER = " [truncated]"
+
+_content_cache = LRUCache(maxsize=EMAIL_CONTENT_CACHE_SIZE)
+_content_cache_lock = threading.Lock()
+
+# Lines that start quoted history: everything from the first match on is dropped.
+QUOTE_START_PATTERNS = [
+    re.compile(r"^On .{1,200}wrote:\s*$"),
+    re.compile(r"^-{2,}\s*Original Message\s*-{2,}", re.IGNORECASE),
+    re.compile(r"^_{10,}\s*$"),
+]
+# A forwarded message is content to classify: only the marker and the header block
+# after it are dropped.
+FORWARD_MARKER = re.compile(r"^-{2,}\s*Forwarded message\s*-{2,}", re.IGNORECASE)
+HEADER_LINE = re.compile(r"^(From|Sent|Date|To|Cc|Subject):\s", re.IGNORECASE)
+# "From:" only starts quoted history as the first line of an Outlook-style header block.
+OUTLOOK_FROM = re.compile(r"^From:\s.+$")
+OUTLOOK_NEXT_HEADER = re.compile(r"^(Sent|Date|To|Subject):\s", re.IGNORECASE)
+# Lines that start a signature block.
+SIGNATURE_PATTERNS = [
+    re.compile(r"^--\s*$"),
+    re.compile(r"^Sent from my \w+", re.IGNORECASE),
+    re.compile(r"^Get Outlook for \w+", re.IGNORECASE),
+]
+
+
+class _HTMLToText(HTMLParser):
+    SKIP_TAGS = {"script", "style", "head", "title"}
+    BLOCK_TAGS = {"p", "div", "br", "tr", "li", "h1", "h2", "h3", "h4", "h5", "h6", "table", "blockquote", "hr"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self._skip_depth = 0
+        # Quoted history in HTML mail lives in <blockquote> and Gmail's div.gmail_quote.
+        self._blockquote_depth = 0
+        self._div_depth = 0
+        self._quote_div_depth = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self._skip_depth += 1
+        elif tag == "blockquote":
+            self._blockquote_depth += 1
+        elif tag == "div":
+            self._div_depth += 1
+            classes = (dict(attrs).get("class") or "").split()
+            if "gmail_quote" in classes and self._quote_div_depth is None:
+                self._quote_div_depth = self._div_depth
+        if tag in self.BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS and self._skip_depth:
+            self._skip_depth -= 1
+        elif tag == "blockquote" and self._blockquote_depth:
+            self._blockquote_depth -= 1
+        elif tag == "div" and self._div_depth:
+            if self._quote_div_depth == self._div_depth:
+                self._quote_div_depth = None
+            self._div_depth -= 1
+        if tag in self.BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self._skip_depth and not self._blockquote_depth and self._quote_div_depth is None:
+            self.parts.append(data)
+
+    def text(self):
+        return "".join(self.parts)
+
+
+def html_to_text(html):
+    """
+    Convert HTML to readable text: drops scripts, styles and quoted blocks, keeps
+    paragraph breaks and decodes entities.
+    """
+    parser = _HTMLToText()
+    try:
+        parser.feed(html)
+        parser.close()
+    except Exception as e:
+        logger.error("Error converting HTML body: %s", e)
+    return parser.text()
+
+
+def strip_html_tags(text):
+    """
+    Remove HTML markup from a given string.
+    """
+    return html_to_text(text)
+
+
+def _is_attachment(part):
+    if part.get("filename"):
+        return True
+    for header in part.get("headers") or []:
+        if header["name"].lower() == "content-disposition" and header["value"].lower().startswith("attachment"):
+            return True
+    return False
+
+
+def _charset(part):
+    for header in part.get("headers") or []:
+        if header["name"].lower() == "content-type":
+            match = re.search(r'charset="?([\w.-]+)"?', header["value"], re.IGNORECASE)
+            if match:
+                return match.group(1)
+    return "utf-8"
+
+
+def _decode_part(part):
+    data = part.get("body", {}).get("data")
+    if not data:
+        return ""
+    raw = base64.urlsafe_b64decode(data.encode("UTF-8"))
+    try:
+        return raw.decode(_charset(part), errors="replace")
+    except LookupError:
+        return raw.decode("utf-8", errors="replace")
+
+
+def walk_parts(payload):
+    """
+    Yield the leaf parts of a message payload in document order, skipping attachments.
+    """
+    stack = [payload or {}]
+    while stack:
+        part = stack.pop(0)
+        children = part.get("parts")
+        if children:
+            stack[0:0] = children
+        elif not _is_attachment(part):
+            yield part
+
+
+def extract_body(payload):
+    """
+    Return the message body as plain text: the first text/plain part, otherwise the
+    first text/html part converted to text, otherwise "".
+    """
+    html_part = None
+    for part in walk_parts(payload):
+        mime_type = (part.get("mimeType") or "").lower()
+        try:
+            if mime_type == "text/plain":
+                text = _decode_part(part)
+                if text.strip():
+                    return text
+            elif mime_type == "text/html" and html_part is None:
+                html_part = part
+        except Exception as decode_error:
+            logger.error("Error decoding email body part: %s", decode_error)
+    if html_part is not None:
+        try:
+            return html_to_text(_decode_part(html_part))
+        except Exception as decode_error:
+            logger.error("Error decoding email body part: %s", decode_error)
+    return ""
+
+
+def _starts_outlook_header(lines, index):
+    if not OUTLOOK_FROM.match(lines[index].strip()):
+        return False
+    following = next((line.strip() for line in lines[index + 1:] if line.strip()), "")
+    return bool(OUTLOOK_NEXT_HEADER.match(following))
+
+
+def strip_quoted_text(text):
+    """
+    Drop quoted reply history ("On ... wrote:", "> " lines, original message blocks,
+    Outlook "From:/Sent:" headers) and a trailing signature. Forwarded messages are kept
+    without their header lines.
+    """
+    lines = text.splitlines()
+    kept = []
+    in_forward_header = False
+    for index, line in enumerate(lines):
+        stripped = line.strip()
+        if in_forward_header:
+            if HEADER_LINE.match(stripped):
+                continue
+            in_forward_header = False
+            if not stripped:
+                continue
+        if FORWARD_MARKER.match(stripped):
+            in_forward_header = True
+            continue
+        if any(p.match(stripped) for p in QUOTE_START_PATTERNS) or _starts_outlook_header(lines, index):
+            break
+        if any(p.match(stripped) for p in SIGNATURE_PATTERNS):
+            break
+        if stripped.startswith(">"):
+            continue
+        kept.append(line.rstrip())
+    return "\n".join(kept)
+
+
+def _normalize_whitespace(text):
+    text = re.sub(r"[ \t\u00a0]+", " ", text)
+    text = re.sub(r" *\n *", "\n", text)
+    return re.sub(r"\n{3,}", "\n\n", text).strip()
+
+
+def truncate_to_budget(text, token_budget=None):
+    """
+    Cap text at token_budget tokens (approximated as CHARS_PER_TOKEN characters each),
+    cutting at a word boundary.
+    """
+    token_budget = EMAIL_BODY_TOKEN_BUDGET if token_budget is None else token_budget
+    max_chars = token_budget * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    cut = text.rfind(" ", 0, max_chars)
+    return text[:cut if cut > max_chars // 2 else max_chars].rstrip() + TRUNCATION_MARKER
+
+
+def clean_body_text(payload, fallback=""):
+    """
+    Extract, de-quote and budget the body of a message payload.
+    """
+    body = _normalize_whitespace(strip_quoted_text(extract_body(payload)))
+    if not body:
+        body = fallback or ""
+    return truncate_to_budget(body)
+
+
+def extract_email_content(email_detail):
+    """
+    Helper to extract subject, sender, and plain text body from email_detail.
+    Only returns the relevant text.
+    """
+    payload = email_detail.get("payload", {})
+    # Metadata-only resources have no body, so they are cached separately from full ones.
+    has_body = bool(payload.get("parts") or payload.get("body", {}).get("data"))
+    cache_key = (email_detail.get("id"), has_body)
+    if cache_key[0]:
+        with _content_cache_lock:
+            cached = _content_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    headers = payload.get("headers", [])
+    subject = next((h["value"] for h in headers if h["name"].lower() == "subject"), "")
+    from_email = next((h["value"] for h in headers if h["name"].lower() == "from"), "")
+    plain_body_text = clean_body_text(payload, fallback=email_detail.get("snippet", ""))
+
+    result = (subject, from_email, plain_body_text)
+    if cache_key[0]:
+        with _content_cache_lock:
+            _content_cache[cache_key] = result
+    return result
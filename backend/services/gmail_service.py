@@ -1,46 +1,185 @@
 # services/gmail_service.py
 import base64
-import os
-import googleapiclient.discovery
-from google.oauth2.credentials import Credentials
+import threading
+import time
+from cachetools import TTLCache
 from flask import request
-from utils.supabae_utils import get_token_from_supabase  # fetch token from Supabase
+from utils.supabae_utils import get_user_from_supabase  # fetch user and token from Supabase
+from services.google_clients import get_service, invalidate_user, service_owner
+from services import mailbox_mirror
 from google.auth.exceptions import RefreshError
 from googleapiclient.errors import HttpError
-from supabase_client import supabase  # your Supabase client
+from user_store import clear_token
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Gmail rejects batches above 100 sub-requests and throttles large ones, so
+# pages are hydrated in chunks of at most 50 (Google's recommended ceiling).
+BATCH_CHUNK_SIZE = 50
+BATCH_MAX_RETRIES = 3
+BATCH_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# The inbox list view only renders these headers plus the snippet, so summary
+# pages are hydrated with format=metadata and a field mask instead of full bodies.
+SUMMARY_HEADERS = ['Subject', 'From', 'To', 'Date']
+SUMMARY_FIELDS = 'id,threadId,snippet,internalDate,labelIds,payload/headers'
+
+# Background colors for the category labels applied by the classifier.
+CATEGORY_LABEL_COLORS = {
+    "Promotion": "#3c78d8",        # Allowed blue
+    "Information": "#16a766",      # Allowed green
+    "To Respond": "#fb4c2f",       # Allowed red
+    "Action Required": "#ffad47",  # bright orange from palette
+    "Receipts": "#d5ae49",         # golden tone for receipts
+    "Meeting Update": "#a4c2f4",   # light blue for meeting updates
+    "Other": "#666666",            # grey for emails with no tags
+}
+DEFAULT_LABEL_COLOR = "#3c78d8"
+
+# Per-user label name -> ID map, filled once by bootstrap_labels.
+_label_maps = {}
+_label_maps_lock = threading.Lock()
+
+# Per-user threadId <-> draftId index, filled once by build_draft_index and then kept
+# current by create_draft_email / delete_draft / forget_draft. A thread can have several
+# drafts, so by_thread maps each thread to the list of its draft IDs, oldest first. It is
+# rebuilt after DRAFT_INDEX_TTL seconds to pick up drafts created or discarded outside the app.
+DRAFT_INDEX_TTL = 900
+_draft_indexes = {}
+_draft_indexes_lock = threading.Lock()
+
+# Full threads are cached per mailbox and revalidated against the thread's current
+# historyId (a cheap format=minimal probe) before being served. Message -> thread
+# mappings never change, so they are cached separately for longer.
+THREAD_CACHE_SIZE = 512
+THREAD_CACHE_TTL = 900
+_thread_cache = TTLCache(maxsize=THREAD_CACHE_SIZE, ttl=THREAD_CACHE_TTL)
+_message_threads = TTLCache(maxsize=THREAD_CACHE_SIZE * 8, ttl=THREAD_CACHE_TTL * 4)
+_thread_cache_lock = threading.Lock()
+_thread_cache_stats = {"hits": 0, "misses": 0, "stale": 0}
+
 def _get_gmail_service():
-    token = get_token_from_supabase()
+    user = get_user_from_supabase()
+    token = user.get("token")
     if not token:
         raise Exception("User not authenticated")
-    creds = Credentials(
-        token=token.get('access_token'),
-        refresh_token=token.get('refresh_token'),
-        token_uri='https://oauth2.googleapis.com/token',
-        client_id=os.getenv("CLIENT_ID"),
-        client_secret=os.getenv("CLIENT_SECRET"),
-        scopes=token.get('scope').split() if token.get('scope') else None,
-        id_token=token.get('id_token')
-    )
     try:
-        service = googleapiclient.discovery.build('gmail', 'v1', credentials=creds)
-        return service
+        return get_service('gmail', 'v1', token, user.get("email"))
     except RefreshError as e:
         # If refresh fails, clear the token in Supabase so that the user is forced to reauthenticate.
+        invalidate_user(user.get("email"))
         session_id = request.cookies.get("session_id")
         if session_id:
-            supabase.table("users").update({"token": {}}).eq("session_id", session_id).execute()
+            clear_token(session_id=session_id)
         raise Exception("Authentication failed: invalid credentials. Please reauthenticate.") from e
 
-def list_emails(max_results=20, page_token=None, label_ids=None):
+def batch_execute(service, request_factories, chunk_size=BATCH_CHUNK_SIZE, max_retries=BATCH_MAX_RETRIES):
+    """
+    Execute many Gmail API requests through the batch HTTP endpoint.
+    request_factories maps a caller-chosen key to a zero-argument callable that
+    builds the HttpRequest, so that failed sub-requests can be rebuilt and retried
+    on their own. Returns (results, errors) dicts keyed the same way; keys whose
+    sub-request never succeeded end up in errors with their last HttpError.
+    """
+    results = {}
+    errors = {}
+    pending = list(request_factories.keys())
+    attempt = 0
+    while pending:
+        retry = []
+        for start in range(0, len(pending), chunk_size):
+            chunk = pending[start:start + chunk_size]
+
+            def callback(request_id, response, exception):
+                key = chunk[int(request_id)]
+                if exception is None:
+                    results[key] = response
+                    errors.pop(key, None)
+                    return
+                errors[key] = exception
+                status = exception.resp.status if isinstance(exception, HttpError) else None
+                if status in BATCH_RETRY_STATUSES:
+                    retry.append(key)
+
+            batch = service.new_batch_http_request(callback=callback)
+            for index, key in enumerate(chunk):
+                batch.add(request_factories[key](), request_id=str(index))
+            batch.execute()
+
+        if not retry or attempt >= max_retries:
+            break
+        attempt += 1
+        logger.warning("Retrying %d failed batch sub-request(s), attempt %d", len(retry), attempt)
+        time.sleep(0.5 * (2 ** attempt))
+        pending = retry
+    return results, errors
+
+def _hydrate_messages(service, msg_ids, hydrate="batch", **get_params):
+    """
+    Fetch message resources for msg_ids, preserving order. In "batch" mode the
+    messages are loaded through batch_execute; "sequential" issues one get per message.
+    Messages deleted between listing and hydration (404) are skipped.
+    """
+    if hydrate == "sequential":
+        return [
+            service.users().messages().get(userId='me', id=msg_id, **get_params).execute()
+            for msg_id in msg_ids
+        ]
+
+    factories = {
+        msg_id: (lambda msg_id=msg_id: service.users().messages().get(userId='me', id=msg_id, **get_params))
+        for msg_id in msg_ids
+    }
+    results, errors = batch_execute(service, factories)
+    for msg_id, error in errors.items():
+        if isinstance(error, HttpError) and error.resp.status == 404:
+            logger.info("Message %s disappeared before hydration; skipping.", msg_id)
+            continue
+        raise error
+    return [results[msg_id] for msg_id in msg_ids if msg_id in results]
+
+def _mirror_owner(service):
+    """
+    Return the mailbox owner when reads for this service can be served from the local
+    mirror (enabled, owner known, and synced); None means go to Gmail, including while
+    the mailbox is first being mirrored in the background.
+    """
+    if not mailbox_mirror.enabled():
+        return None
+    owner = service_owner(service)
+    if not owner:
+        return None
+    try:
+        return owner if mailbox_mirror.ensure_synced(service, owner) else None
+    except Exception as e:
+        logger.error("Mailbox mirror unavailable for %s; reading from Gmail: %s", owner, e, exc_info=True)
+        return None
+
+def list_emails(max_results=20, page_token=None, label_ids=None, hydrate="batch", view="full"):
+    """
+    List a page of messages. view="full" returns each message's full payload;
+    view="summary" returns only the list-view headers (payload.headers), snippet,
+    labels and date, leaving bodies to be loaded when a message is opened.
+    Pages are served from the local mailbox mirror when it is enabled.
+    """
     service = _get_gmail_service()
+    continuation = mailbox_mirror.continuation_query(page_token)
+    if continuation is None and (not page_token or page_token.startswith(mailbox_mirror.PAGE_TOKEN_PREFIX)):
+        owner = _mirror_owner(service)
+        if owner:
+            return mailbox_mirror.list_messages(owner, label_ids, max_results, page_token, view)
+        if page_token:
+            # A mirror offset token without a usable mirror: start over from Gmail.
+            page_token = None
     params = {
         'userId': 'me',
-        'maxResults': max_results
+        'maxResults': max_results,
+        'fields': 'messages/id,nextPageToken'
     }
+    if continuation is not None:
+        # Past the mirrored window: Gmail pages older than the mirror's oldest message.
+        params['q'], page_token, before_seconds = continuation
     if page_token:
         params['pageToken'] = page_token
     if label_ids:
@@ -48,14 +187,19 @@ def list_emails(max_results=20, page_token=None, label_ids=None):
     results = service.users().messages().list(**params).execute()
     messages = results.get('messages', [])
     next_page_token = results.get('nextPageToken')
-    emails = []
-    for msg in messages:
+    if continuation is not None and next_page_token:
+        next_page_token = mailbox_mirror.continuation_token(before_seconds * 1000, next_page_token)
+    if view == "summary":
+        get_params = {'format': 'metadata', 'metadataHeaders': SUMMARY_HEADERS, 'fields': SUMMARY_FIELDS}
+    else:
         # Retrieve full message details including headers and internalDate.
-        msg_detail = service.users().messages().get(
-            userId='me', id=msg['id'], format='full'
-        ).execute()
+        get_params = {'format': 'full'}
+    emails = []
+    details = _hydrate_messages(service, [msg['id'] for msg in messages], hydrate=hydrate, **get_params)
+    for msg_detail in details:
         email_data = {
             'id': msg_detail.get('id'),
+            'threadId': msg_detail.get('threadId'),
             'snippet': msg_detail.get('snippet'),
             'payload': msg_detail.get('payload'),
             'internalDate': msg_detail.get('internalDate'),
@@ -64,8 +208,66 @@ def list_emails(max_results=20, page_token=None, label_ids=None):
         emails.append(email_data)
     return emails, next_page_token
 
+def get_thread_id_for_message(service, msg_id):
+    """
+    Resolve a message's threadId with a minimal, field-masked lookup.
+    """
+    key = (_mailbox_key(service), msg_id)
+    with _thread_cache_lock:
+        thread_id = _message_threads.get(key)
+    if thread_id is None:
+        message = service.users().messages().get(
+            userId='me', id=msg_id, format='minimal', fields='threadId'
+        ).execute()
+        thread_id = message.get('threadId')
+        with _thread_cache_lock:
+            _message_threads[key] = thread_id
+    return thread_id
+
+def get_thread(service, thread_id):
+    """
+    Return the full thread, served from the per-mailbox cache when its historyId
+    shows the thread has not changed since it was cached.
+    """
+    key = (_mailbox_key(service), thread_id)
+    with _thread_cache_lock:
+        cached = _thread_cache.get(key)
+    if cached is not None:
+        probe = service.users().threads().get(
+            userId='me', id=thread_id, format='minimal', fields='id,historyId'
+        ).execute()
+        if probe.get('historyId') == cached.get('historyId'):
+            with _thread_cache_lock:
+                _thread_cache_stats["hits"] += 1
+            return cached
+        with _thread_cache_lock:
+            _thread_cache_stats["stale"] += 1
+
+    thread = service.users().threads().get(userId='me', id=thread_id, format='full').execute()
+    with _thread_cache_lock:
+        _thread_cache_stats["misses"] += 1
+        _thread_cache[key] = thread
+    return thread
+
+def get_thread_cache_stats():
+    """
+    Hit/miss counters for the thread cache. "stale" counts cached threads that
+    failed historyId validation (they are also counted as misses).
+    """
+    with _thread_cache_lock:
+        stats = dict(_thread_cache_stats)
+        stats["size"] = len(_thread_cache)
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else 0.0
+    return stats
+
 def get_email_by_id(msg_id):
     service = _get_gmail_service()
+    owner = _mirror_owner(service)
+    if owner:
+        msg_detail = mailbox_mirror.get_message(owner, msg_id)
+        if msg_detail:
+            return msg_detail
     msg_detail = service.users().messages().get(userId='me', id=msg_id, format='full').execute()
     return msg_detail
 
@@ -106,84 +308,119 @@ def create_draft_email(to, subject, body, cc=None, service=None, thread_id=None)
         userId='me',
         body={'message': message_body}
     ).execute()
+    record_draft(service, draft.get('id'), draft.get('message', {}).get('threadId') or thread_id)
     return draft
 
-def create_label_if_not_exists(label_name, service):
+def _mailbox_key(service):
     """
-    Check if a label with the given name exists; if not, create it with a unique color
-    based on the label name and return its ID.
+    Key per-user caches by the mailbox owner when the service came from the client cache.
     """
-    # List existing labels
-    existing = service.users().labels().list(userId="me").execute()
-    labels = existing.get("labels", [])
-    for label in labels:
-        if label.get("name") == label_name:
-            return label.get("id")
-    
-    # Determine colors based on label type.
-    if label_name == "Promotion":
-        background_color = "#3c78d8"  # Allowed blue
-        text_color = "#ffffff"
-    elif label_name == "Information":
-        background_color = "#16a766"  # Allowed green
-        text_color = "#ffffff"
-    elif label_name == "To Respond":
-        background_color = "#fb4c2f"  # Allowed red
-        text_color = "#ffffff"
-    elif label_name == "Action Required":
-        background_color = "#ffad47"  # bright orange from palette
-        text_color = "#ffffff"
-    elif label_name == "Receipts":
-        background_color = "#d5ae49"  # golden tone for receipts
-        text_color = "#ffffff"
-    elif label_name == "Meeting Update":
-        background_color = "#a4c2f4"  # light blue for meeting updates
-        text_color = "#ffffff"
-    elif label_name == "Other":
-        background_color = "#666666"  # grey for emails with no tags
-        text_color = "#ffffff"
-    else:
-        # Default colors if label is not one of the specified ones.
-        background_color = "#3c78d8"
-        text_color = "#ffffff"
-    
-    label_body = {
+    return service_owner(service) or id(service)
+
+def _label_body(label_name):
+    return {
         "name": label_name,
         "labelListVisibility": "labelShow",
         "messageListVisibility": "show",
         "color": {
-            "backgroundColor": background_color,
-            "textColor": text_color
+            "backgroundColor": CATEGORY_LABEL_COLORS.get(label_name, DEFAULT_LABEL_COLOR),
+            "textColor": "#ffffff"
         }
     }
-    new_label = service.users().labels().create(userId="me", body=label_body).execute()
-    logger.info("Created new label '%s' with ID %s and color %s", label_name, new_label.get("id"), background_color)
+
+def bootstrap_labels(service):
+    """
+    List the user's labels once, create every missing category label in a single
+    batch, and cache the resulting name -> ID map for the mailbox.
+    """
+    existing = service.users().labels().list(userId="me").execute()
+    label_map = {label.get("name"): label.get("id") for label in existing.get("labels", [])}
+
+    missing = [name for name in CATEGORY_LABEL_COLORS if name not in label_map]
+    if missing:
+        factories = {
+            name: (lambda name=name: service.users().labels().create(userId="me", body=_label_body(name)))
+            for name in missing
+        }
+        created, errors = batch_execute(service, factories)
+        for name, new_label in created.items():
+            label_map[name] = new_label.get("id")
+            logger.info("Created new label '%s' with ID %s", name, new_label.get("id"))
+        for name, error in errors.items():
+            logger.error("Failed to create label '%s': %s", name, error)
+
+    with _label_maps_lock:
+        _label_maps[_mailbox_key(service)] = label_map
+    return label_map
+
+def get_label_map(service):
+    """
+    Return the cached label name -> ID map for the mailbox, bootstrapping it on first use.
+    """
+    with _label_maps_lock:
+        label_map = _label_maps.get(_mailbox_key(service))
+    if label_map is None:
+        label_map = bootstrap_labels(service)
+    return label_map
+
+def invalidate_labels(service):
+    with _label_maps_lock:
+        _label_maps.pop(_mailbox_key(service), None)
+
+def create_label_if_not_exists(label_name, service):
+    """
+    Return the ID of the label with the given name, creating it (with the category
+    color for known labels) if it does not exist yet.
+    """
+    label_map = get_label_map(service)
+    label_id = label_map.get(label_name)
+    if label_id:
+        return label_id
+
+    new_label = service.users().labels().create(userId="me", body=_label_body(label_name)).execute()
+    logger.info("Created new label '%s' with ID %s", label_name, new_label.get("id"))
+    with _label_maps_lock:
+        label_map[label_name] = new_label.get("id")
     return new_label.get("id")
 
+def _is_unknown_label_error(error):
+    return error.resp.status in (400, 404) and "label" in str(error).lower()
+
 def tag_email(msg_id, add_labels=[], remove_labels=[], service=None):
     """
     Modify the Gmail message with the given labels. If an add_label does not exist,
-    it will be created.
+    it will be created. Label IDs come from the per-user label map; if Gmail rejects
+    one as unknown (e.g. the user deleted it), the map is refreshed and the modify retried once.
     """
     if service is None:
         service = _get_gmail_service()
-    # First, assume the labels in add_labels might be names. We need to convert them to valid label IDs.
-    valid_add_label_ids = []
-    for label in add_labels:
-        # Try to create (or fetch) the label. If it exists, its ID is returned.
-        try:
-            label_id = create_label_if_not_exists(label, service)
-            valid_add_label_ids.append(label_id)
-        except Exception as create_err:
-            logger.error("Failed to create or retrieve label '%s': %s", label, create_err)
+
+    def resolve_label_ids():
+        valid_add_label_ids = []
+        for label in add_labels:
+            try:
+                valid_add_label_ids.append(create_label_if_not_exists(label, service))
+            except Exception as create_err:
+                logger.error("Failed to create or retrieve label '%s': %s", label, create_err)
+        return valid_add_label_ids
+
     # For removal, you might already have valid label IDs or you can do a similar conversion.
     body = {
-        'addLabelIds': valid_add_label_ids,
+        'addLabelIds': resolve_label_ids(),
         'removeLabelIds': remove_labels
     }
     try:
-        modified_message = service.users().messages().modify(userId='me', id=msg_id, body=body).execute()
-        return modified_message
+        return service.users().messages().modify(userId='me', id=msg_id, body=body).execute()
+    except HttpError as e:
+        if not add_labels or not _is_unknown_label_error(e):
+            logger.error("Failed to tag message %s: %s", msg_id, e)
+            raise
+        logger.warning("Label map for message %s looks stale (%s); refreshing.", msg_id, e)
+
+    invalidate_labels(service)
+    body['addLabelIds'] = resolve_label_ids()
+    try:
+        return service.users().messages().modify(userId='me', id=msg_id, body=body).execute()
     except HttpError as e:
         logger.error("Failed to tag message %s: %s", msg_id, e)
         raise
@@ -191,6 +428,12 @@ def tag_email(msg_id, add_labels=[], remove_labels=[], service=None):
 def analyze_user_emails(max_results=100):
     from datetime import datetime, timedelta
     service = _get_gmail_service()
+    owner = _mirror_owner(service)
+    if owner:
+        sent, _ = mailbox_mirror.list_messages(owner, ['SENT'], max_results)
+        # Only when the mirror window holds a full sample; otherwise ask Gmail.
+        if len(sent) >= max_results:
+            return [mailbox_mirror.get_message(owner, email['id']) for email in sent]
     five_years_ago = datetime.now() - timedelta(days=5*365)
     query = f"after:{five_years_ago.strftime('%Y/%m/%d')}"
     results = service.users().messages().list(userId='me', labelIds=['SENT'], q=query, maxResults=max_results).execute()
@@ -207,4 +450,103 @@ def delete_draft(draft_id, service=None):
     """
     if service is None:
         service = _get_gmail_service()
-    return service.users().drafts().delete(userId='me', id=draft_id).execute()
+    result = service.users().drafts().delete(userId='me', id=draft_id).execute()
+    forget_draft(service, draft_id)
+    return result
+
+def build_draft_index(service):
+    """
+    Build the threadId -> draftIds index for the mailbox. drafts.list already returns
+    each draft's message id and threadId, so the whole index normally costs one call
+    per 500 drafts; drafts listed without a threadId are resolved with a batched
+    format='minimal' get.
+    """
+    by_thread, by_draft = {}, {}
+    unresolved = []
+    page_token = None
+    while True:
+        params = {
+            'userId': 'me',
+            'maxResults': 500,
+            'fields': 'drafts(id,message(id,threadId)),nextPageToken'
+        }
+        if page_token:
+            params['pageToken'] = page_token
+        drafts_resp = service.users().drafts().list(**params).execute()
+        for d in drafts_resp.get('drafts', []):
+            thread_id = d.get('message', {}).get('threadId')
+            if thread_id:
+                by_thread.setdefault(thread_id, []).append(d['id'])
+                by_draft[d['id']] = thread_id
+            else:
+                unresolved.append(d['id'])
+        page_token = drafts_resp.get('nextPageToken')
+        if not page_token:
+            break
+
+    if unresolved:
+        factories = {
+            draft_id: (lambda draft_id=draft_id: service.users().drafts().get(userId='me', id=draft_id, format='minimal'))
+            for draft_id in unresolved
+        }
+        details, errors = batch_execute(service, factories)
+        for draft_id, detail in details.items():
+            thread_id = detail.get('message', {}).get('threadId')
+            if thread_id:
+                by_thread.setdefault(thread_id, []).append(draft_id)
+                by_draft[draft_id] = thread_id
+        for draft_id, error in errors.items():
+            logger.error("Failed to resolve thread for draft %s: %s", draft_id, error)
+
+    index = {'by_thread': by_thread, 'by_draft': by_draft, 'built_at': time.monotonic()}
+    with _draft_indexes_lock:
+        _draft_indexes[_mailbox_key(service)] = index
+    logger.info("Built draft index with %d draft(s).", len(by_draft))
+    return index
+
+def _get_draft_index(service):
+    with _draft_indexes_lock:
+        index = _draft_indexes.get(_mailbox_key(service))
+    if index is None or time.monotonic() - index['built_at'] > DRAFT_INDEX_TTL:
+        index = build_draft_index(service)
+    return index
+
+def find_draft_for_thread(service, thread_id):
+    """
+    Return a Gmail draft ID for the given thread (its oldest known draft), or None if
+    there is no draft.
+    """
+    if not thread_id:
+        return None
+    index = _get_draft_index(service)
+    with _draft_indexes_lock:
+        draft_ids = index['by_thread'].get(thread_id)
+        return draft_ids[0] if draft_ids else None
+
+def record_draft(service, draft_id, thread_id):
+    """
+    Add a newly created draft to the mailbox's index (if the index has been built).
+    """
+    if not draft_id or not thread_id:
+        return
+    with _draft_indexes_lock:
+        index = _draft_indexes.get(_mailbox_key(service))
+        if index is not None and draft_id not in index['by_draft']:
+            index['by_thread'].setdefault(thread_id, []).append(draft_id)
+            index['by_draft'][draft_id] = thread_id
+
+def forget_draft(service, draft_id):
+    """
+    Remove a sent or deleted draft from the mailbox's index.
+    """
+    with _draft_indexes_lock:
+        index = _draft_indexes.get(_mailbox_key(service))
+        if index is None:
+            return
+        thread_id = index['by_draft'].pop(draft_id, None)
+        draft_ids = index['by_thread'].get(thread_id)
+        if draft_ids and draft_id in draft_ids:
+            draft_ids.remove(draft_id)
+            # The thread keeps its mapping while it still has other drafts.
+            if not draft_ids:
+                index['by_thread'].pop(thread_id)
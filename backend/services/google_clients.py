@@ -0,0 +1,189 @@
+# services/google_clients.py
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+
+import google_auth_httplib2
+import googleapiclient.discovery
+import googleapiclient.http
+import httplib2
+from cachetools import TTLCache
+from google.auth.credentials import AnonymousCredentials
+from google.auth.exceptions import RefreshError
+from google.oauth2.credentials import Credentials
+from googleapiclient import discovery_cache
+
+logger = logging.getLogger(__name__)
+
+# Built service objects are kept per (user, api, version). The cache is LRU-bounded
+# and entries expire after SERVICE_CACHE_TTL seconds so stale credentials do not linger.
+SERVICE_CACHE_SIZE = int(os.getenv("GOOGLE_SERVICE_CACHE_SIZE", "256"))
+SERVICE_CACHE_TTL = int(os.getenv("GOOGLE_SERVICE_CACHE_TTL", "1800"))
+
+_service_cache = TTLCache(maxsize=SERVICE_CACHE_SIZE, ttl=SERVICE_CACHE_TTL)
+_service_cache_lock = threading.RLock()
+# Maps each built service back to the user it was built for, so per-mailbox caches
+# (labels, drafts, threads) can be keyed by user when only the service is passed around.
+_service_owners = weakref.WeakKeyDictionary()
+
+# Discovery documents are pinned: they come from GOOGLE_DISCOVERY_DIR when set, otherwise
+# from the static copies shipped with the pinned google-api-python-client release. They are
+# parsed once per process and every service is built from the parsed template, so no request
+# ever re-reads, re-parses or fetches a discovery document.
+PINNED_DISCOVERY_APIS = (("gmail", "v1"), ("calendar", "v3"))
+DISCOVERY_DIR = os.getenv("GOOGLE_DISCOVERY_DIR")
+
+_discovery_documents = {}
+_discovery_lock = threading.Lock()
+
+
+def _load_discovery_document(api, version):
+    content = None
+    if DISCOVERY_DIR:
+        path = os.path.join(DISCOVERY_DIR, f"{api}.{version}.json")
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                content = f.read()
+    if content is None:
+        content = discovery_cache.get_static_doc(api, version)
+    if content is None:
+        raise Exception(f"No pinned discovery document available for {api} {version}.")
+    return json.loads(content)
+
+
+def get_discovery_document(api, version):
+    """
+    Return the parsed discovery document for api/version, loading it on first use.
+    """
+    document = _discovery_documents.get((api, version))
+    if document is None:
+        with _discovery_lock:
+            document = _discovery_documents.get((api, version))
+            if document is None:
+                document = _load_discovery_document(api, version)
+                _discovery_documents[(api, version)] = document
+    return document
+
+
+def warm_discovery():
+    """
+    Load and parse the pinned discovery documents and build one throwaway client per API,
+    so that the first real request in a worker does not pay for parsing or lazy imports.
+    Returns the time spent per API in milliseconds.
+    """
+    timings = {}
+    for api, version in PINNED_DISCOVERY_APIS:
+        started = time.perf_counter()
+        document = get_discovery_document(api, version)
+        googleapiclient.discovery.build_from_document(document, credentials=AnonymousCredentials())
+        timings[f"{api}.{version}"] = round((time.perf_counter() - started) * 1000, 2)
+    logger.info("Warmed Google discovery documents: %s", timings)
+    return timings
+
+
+def token_fingerprint(token):
+    """
+    Return a short, stable digest of the stored OAuth token. A re-authentication
+    or token rewrite in Supabase changes the fingerprint and therefore the cache entry.
+    """
+    material = "|".join(
+        str(token.get(field) or "") for field in ("access_token", "refresh_token", "scope")
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()[:16]
+
+
+def build_credentials(token):
+    """
+    Build google-auth Credentials from the token dict stored on the users row.
+    """
+    return Credentials(
+        token=token.get("access_token"),
+        refresh_token=token.get("refresh_token"),
+        token_uri="https://oauth2.googleapis.com/token",
+        client_id=os.getenv("CLIENT_ID"),
+        client_secret=os.getenv("CLIENT_SECRET"),
+        scopes=token.get("scope").split() if token.get("scope") else None,
+        id_token=token.get("id_token")
+    )
+
+
+def _request_builder(credentials, user_key):
+    """
+    httplib2.Http is not thread-safe, so a cached service must not share one transport
+    between request threads. Each thread gets its own authorized Http (reused for all of
+    that thread's calls), and a RefreshError raised while executing evicts the user's
+    cached services.
+    """
+    local = threading.local()
+
+    class _CachedServiceRequest(googleapiclient.http.HttpRequest):
+        def __init__(self, http, *args, **kwargs):
+            authed_http = getattr(local, "http", None)
+            if authed_http is None:
+                authed_http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http())
+                local.http = authed_http
+            super().__init__(authed_http, *args, **kwargs)
+
+        def execute(self, *args, **kwargs):
+            try:
+                return super().execute(*args, **kwargs)
+            except RefreshError:
+                invalidate_user(user_key)
+                raise
+
+    return _CachedServiceRequest
+
+
+def get_service(api, version, token, user_key):
+    """
+    Return a built Google API service for the given user, reusing a cached instance
+    while the stored token is unchanged. Safe to call from multiple threads.
+    """
+    fingerprint = token_fingerprint(token)
+    cache_key = (user_key, api, version)
+    with _service_cache_lock:
+        entry = _service_cache.get(cache_key)
+        if entry and entry[0] == fingerprint:
+            return entry[1]
+
+    credentials = build_credentials(token)
+    service = googleapiclient.discovery.build_from_document(
+        get_discovery_document(api, version),
+        credentials=credentials,
+        requestBuilder=_request_builder(credentials, user_key),
+    )
+    with _service_cache_lock:
+        # Another thread may have built the same client meanwhile; keep the first one.
+        entry = _service_cache.get(cache_key)
+        if entry and entry[0] == fingerprint:
+            return entry[1]
+        if entry:
+            logger.info("Token changed for %s; replacing cached %s service.", user_key, api)
+        _service_cache[cache_key] = (fingerprint, service)
+        _service_owners[service] = user_key
+    logger.debug("Built and cached %s %s service for %s", api, version, user_key)
+    return service
+
+
+def service_owner(service):
+    """
+    Return the user key a cached service was built for, or None for services built elsewhere.
+    """
+    try:
+        return _service_owners.get(service)
+    except TypeError:
+        return None
+
+
+def invalidate_user(user_key):
+    """
+    Drop every cached service belonging to user_key (e.g. after a RefreshError).
+    """
+    with _service_cache_lock:
+        for cache_key in [k for k in list(_service_cache.keys()) if k[0] == user_key]:
+            _service_cache.pop(cache_key, None)
+    logger.info("Invalidated cached Google services for %s", user_key)
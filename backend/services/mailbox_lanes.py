@@ -0,0 +1,102 @@
+# services/mailbox_lanes.py
+"""
+Per-mailbox work lanes. Each mailbox hashes (crc32) onto one of MAILBOX_LANES lanes;
+a lane is a queue with a single consumer thread, so all work for a mailbox runs one
+task at a time and in submission order, while different lanes run in parallel.
+Anything that reads, modifies and writes back a user's row (Pub/Sub notification
+passes, process_latest, backfill chunks) goes through the mailbox's lane instead of
+taking a lock.
+
+Tasks should not depend on the Flask request context: resolve the session, user and
+Gmail service in the request thread and pass them in.
+"""
+import logging
+import os
+import queue
+import threading
+import zlib
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+MAILBOX_LANES = max(1, int(os.getenv("MAILBOX_LANES", "8")))
+
+
+class _Lane:
+    def __init__(self, index):
+        self.index = index
+        self.queue = queue.Queue()
+        self.processed = 0
+        self.failed = 0
+        self.thread = None
+
+
+_lanes = [_Lane(index) for index in range(MAILBOX_LANES)]
+_start_lock = threading.Lock()
+_current = threading.local()
+
+
+def lane_for(mailbox):
+    """
+    Return the lane index for a mailbox address.
+    """
+    return zlib.crc32((mailbox or "").strip().lower().encode("utf-8")) % MAILBOX_LANES
+
+
+def _consume(lane):
+    _current.lane = lane.index
+    while True:
+        future, fn, args, kwargs = lane.queue.get()
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                    lane.processed += 1
+                except BaseException as e:
+                    lane.failed += 1
+                    logger.error("Lane %d task %s failed: %s", lane.index, getattr(fn, "__name__", fn), e)
+                    future.set_exception(e)
+        finally:
+            lane.queue.task_done()
+
+
+def _ensure_started(lane):
+    if lane.thread is not None:
+        return
+    with _start_lock:
+        if lane.thread is None:
+            lane.thread = threading.Thread(
+                target=_consume, args=(lane,), name=f"mailbox-lane-{lane.index}", daemon=True
+            )
+            lane.thread.start()
+
+
+def submit(mailbox, fn, *args, **kwargs):
+    """
+    Queue fn(*args, **kwargs) on the mailbox's lane and return a Future for its result.
+    """
+    lane = _lanes[lane_for(mailbox)]
+    _ensure_started(lane)
+    future = Future()
+    lane.queue.put((future, fn, args, kwargs))
+    return future
+
+
+def run(mailbox, fn, *args, **kwargs):
+    """
+    Run fn on the mailbox's lane and wait for its result (exceptions are re-raised).
+    Called from a task already on that lane, fn runs inline to avoid a deadlock.
+    """
+    if getattr(_current, "lane", None) == lane_for(mailbox):
+        return fn(*args, **kwargs)
+    return submit(mailbox, fn, *args, **kwargs).result()
+
+
+def stats():
+    return {
+        "lanes": MAILBOX_LANES,
+        "queued": [lane.queue.qsize() for lane in _lanes],
+        "processed": sum(lane.processed for lane in _lanes),
+        "failed": sum(lane.failed for lane in _lanes),
+        "started": sum(1 for lane in _lanes if lane.thread is not None),
+    }
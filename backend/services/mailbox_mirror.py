@@ -0,0 +1,416 @@
+# services/mailbox_mirror.py
+"""
+Optional local SQLite mirror of each user's mailbox (message metadata, labels, full
+message JSON and decoded body text). It is enabled by pointing MAILBOX_MIRROR_PATH at
+a database file and is kept current with Gmail history().list deltas, so inbox reads
+are served from local disk instead of Gmail round trips.
+
+Loading a mailbox (bootstrap) hydrates MIRROR_BOOTSTRAP_SIZE full messages, so it runs on
+a background thread; until it finishes, ensure_synced reports the mirror as unavailable
+and reads go to Gmail.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from googleapiclient.errors import HttpError
+
+from services.email_content import extract_body
+
+logger = logging.getLogger(__name__)
+
+MIRROR_PATH = os.getenv("MAILBOX_MIRROR_PATH")
+# A mirror older than this is brought up to date with one history().list delta before a read.
+MIRROR_MAX_AGE = float(os.getenv("MAILBOX_MIRROR_MAX_AGE", "30"))
+# Number of most recent messages loaded when a mailbox is first mirrored.
+MIRROR_BOOTSTRAP_SIZE = int(os.getenv("MAILBOX_MIRROR_BOOTSTRAP_SIZE", "500"))
+# Page tokens handed out for mirror-backed pages; Gmail page tokens never use this prefix.
+PAGE_TOKEN_PREFIX = "mirror:"
+# The mirror holds only the newest messages. Once a listing runs past them, paging
+# continues in Gmail with a "before:" query; those tokens carry this prefix, the query's
+# cutoff and Gmail's own page token.
+CONTINUATION_PREFIX = PAGE_TOKEN_PREFIX + "gmail:"
+
+HISTORY_TYPES = ["messageAdded", "messageDeleted", "labelAdded", "labelRemoved"]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    owner TEXT NOT NULL,
+    id TEXT NOT NULL,
+    thread_id TEXT,
+    internal_date INTEGER,
+    snippet TEXT,
+    headers TEXT,
+    message TEXT,
+    body_text TEXT,
+    PRIMARY KEY (owner, id)
+);
+CREATE INDEX IF NOT EXISTS messages_owner_date ON messages (owner, internal_date DESC);
+CREATE TABLE IF NOT EXISTS message_labels (
+    owner TEXT NOT NULL,
+    label_id TEXT NOT NULL,
+    message_id TEXT NOT NULL,
+    PRIMARY KEY (owner, label_id, message_id)
+);
+CREATE INDEX IF NOT EXISTS message_labels_message ON message_labels (owner, message_id);
+CREATE TABLE IF NOT EXISTS sync_state (
+    owner TEXT PRIMARY KEY,
+    history_id TEXT NOT NULL,
+    synced_at REAL NOT NULL
+);
+"""
+
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schema_ready = False
+_owner_locks = {}
+_owner_locks_guard = threading.Lock()
+_bootstrapping = set()
+
+
+def enabled():
+    return bool(MIRROR_PATH)
+
+
+def _connection():
+    """
+    One connection per thread; the database runs in WAL mode so readers never block
+    the writer that applies history deltas.
+    """
+    global _schema_ready
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(MIRROR_PATH, timeout=10, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=10000")
+        _local.conn = conn
+    if not _schema_ready:
+        with _schema_lock:
+            if not _schema_ready:
+                conn.executescript(_SCHEMA)
+                _schema_ready = True
+    return conn
+
+
+def _owner_lock(owner):
+    with _owner_locks_guard:
+        return _owner_locks.setdefault(owner, threading.Lock())
+
+
+def _store_messages(conn, owner, messages):
+    for message in messages:
+        payload = message.get("payload", {})
+        conn.execute(
+            "INSERT OR REPLACE INTO messages "
+            "(owner, id, thread_id, internal_date, snippet, headers, message, body_text) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                owner,
+                message.get("id"),
+                message.get("threadId"),
+                int(message.get("internalDate") or 0),
+                message.get("snippet"),
+                json.dumps(payload.get("headers", [])),
+                json.dumps(message),
+                extract_body(payload),
+            ),
+        )
+        _set_labels(conn, owner, message.get("id"), message.get("labelIds", []), update_message=False)
+
+
+def _set_labels(conn, owner, message_id, label_ids, update_message=True):
+    conn.execute("DELETE FROM message_labels WHERE owner = ? AND message_id = ?", (owner, message_id))
+    conn.executemany(
+        "INSERT OR IGNORE INTO message_labels (owner, label_id, message_id) VALUES (?, ?, ?)",
+        [(owner, label_id, message_id) for label_id in label_ids],
+    )
+    if not update_message:
+        return
+    row = conn.execute("SELECT message FROM messages WHERE owner = ? AND id = ?", (owner, message_id)).fetchone()
+    if row:
+        message = json.loads(row["message"])
+        message["labelIds"] = list(label_ids)
+        conn.execute(
+            "UPDATE messages SET message = ? WHERE owner = ? AND id = ?",
+            (json.dumps(message), owner, message_id),
+        )
+
+
+def _delete_messages(conn, owner, message_ids):
+    for message_id in message_ids:
+        conn.execute("DELETE FROM messages WHERE owner = ? AND id = ?", (owner, message_id))
+        conn.execute("DELETE FROM message_labels WHERE owner = ? AND message_id = ?", (owner, message_id))
+
+
+def _save_state(conn, owner, history_id):
+    conn.execute(
+        "INSERT OR REPLACE INTO sync_state (owner, history_id, synced_at) VALUES (?, ?, ?)",
+        (owner, str(history_id), time.time()),
+    )
+
+
+def _get_state(owner):
+    return _connection().execute(
+        "SELECT history_id, synced_at FROM sync_state WHERE owner = ?", (owner,)
+    ).fetchone()
+
+
+def _stored_history_id(owner):
+    from supabase_client import supabase
+
+    user_resp = supabase.table("users").select("last_history_id").eq("email", owner).execute()
+    return user_resp.data[0].get("last_history_id") if user_resp.data else None
+
+
+def bootstrap(service, owner, seed_history_id=None, replay_from_stored=True):
+    """
+    Mirror the most recent messages of the mailbox and start tracking history from the
+    mailbox's current historyId. When the users.last_history_id column (or seed_history_id)
+    is older, deltas are replayed from it instead so nothing since the last webhook is missed.
+    """
+    from services.gmail_service import _hydrate_messages
+
+    profile = service.users().getProfile(userId="me").execute()
+    history_id = profile.get("historyId")
+    if replay_from_stored and not seed_history_id:
+        seed_history_id = _stored_history_id(owner)
+    if seed_history_id and int(seed_history_id) < int(history_id):
+        history_id = seed_history_id
+
+    message_ids = []
+    page_token = None
+    while len(message_ids) < MIRROR_BOOTSTRAP_SIZE:
+        params = {
+            "userId": "me",
+            "maxResults": min(500, MIRROR_BOOTSTRAP_SIZE - len(message_ids)),
+            "fields": "messages/id,nextPageToken",
+        }
+        if page_token:
+            params["pageToken"] = page_token
+        listing = service.users().messages().list(**params).execute()
+        message_ids.extend(m["id"] for m in listing.get("messages", []))
+        page_token = listing.get("nextPageToken")
+        if not page_token:
+            break
+
+    messages = _hydrate_messages(service, message_ids, format="full")
+    conn = _connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DELETE FROM messages WHERE owner = ?", (owner,))
+        conn.execute("DELETE FROM message_labels WHERE owner = ?", (owner,))
+        _store_messages(conn, owner, messages)
+        _save_state(conn, owner, history_id)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    logger.info("Mirrored %d message(s) for %s from historyId %s", len(messages), owner, history_id)
+
+
+def start_bootstrap(service, owner, seed_history_id=None, replay_from_stored=True):
+    """
+    Run bootstrap on a background thread, at most one per mailbox at a time.
+    """
+    with _owner_locks_guard:
+        if owner in _bootstrapping:
+            return
+        _bootstrapping.add(owner)
+
+    def run():
+        try:
+            bootstrap(service, owner, seed_history_id, replay_from_stored)
+        except Exception as e:
+            logger.error("Mirror bootstrap for %s failed: %s", owner, e, exc_info=True)
+        finally:
+            with _owner_locks_guard:
+                _bootstrapping.discard(owner)
+
+    threading.Thread(target=run, name="mirror-bootstrap", daemon=True).start()
+
+
+def bootstrapping(owner):
+    with _owner_locks_guard:
+        return owner in _bootstrapping
+
+
+def sync(service, owner, seed_history_id=None):
+    """
+    Apply every history().list delta since the mirror's cursor and return True. When the
+    mailbox has never been mirrored or Gmail no longer has the cursor's history (404), a
+    background bootstrap is started instead and False is returned.
+    """
+    from services.gmail_service import _hydrate_messages
+
+    state = _get_state(owner)
+    if state is None:
+        start_bootstrap(service, owner, seed_history_id)
+        return False
+
+    added, deleted, relabeled = [], set(), {}
+    latest_history_id = state["history_id"]
+    page_token = None
+    try:
+        while True:
+            params = {"userId": "me", "startHistoryId": state["history_id"], "historyTypes": HISTORY_TYPES}
+            if page_token:
+                params["pageToken"] = page_token
+            history_response = service.users().history().list(**params).execute()
+            for event in history_response.get("history", []):
+                for item in event.get("messagesAdded", []):
+                    added.append(item["message"]["id"])
+                for item in event.get("messagesDeleted", []):
+                    deleted.add(item["message"]["id"])
+                for item in event.get("labelsAdded", []) + event.get("labelsRemoved", []):
+                    relabeled[item["message"]["id"]] = item["message"].get("labelIds", [])
+            latest_history_id = history_response.get("historyId", latest_history_id)
+            page_token = history_response.get("nextPageToken")
+            if not page_token:
+                break
+    except HttpError as e:
+        if e.resp.status == 404:
+            logger.warning("History cursor for %s expired; re-bootstrapping mirror.", owner)
+            start_bootstrap(service, owner, replay_from_stored=False)
+            return False
+        raise
+
+    added = [message_id for message_id in dict.fromkeys(added) if message_id not in deleted]
+    messages = _hydrate_messages(service, added, format="full") if added else []
+    conn = _connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        _store_messages(conn, owner, messages)
+        for message_id, label_ids in relabeled.items():
+            if message_id not in deleted:
+                _set_labels(conn, owner, message_id, label_ids)
+        _delete_messages(conn, owner, deleted)
+        _save_state(conn, owner, latest_history_id)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    logger.debug(
+        "Mirror sync for %s: %d added, %d deleted, %d relabeled (historyId %s)",
+        owner, len(messages), len(deleted), len(relabeled), latest_history_id,
+    )
+    return True
+
+
+def ensure_synced(service, owner, seed_history_id=None):
+    """
+    Sync the mirror if it is older than MIRROR_MAX_AGE seconds and return whether reads
+    can be served from it (False while the mailbox is being bootstrapped). Concurrent
+    callers for the same mailbox wait for a single sync instead of each running their own.
+    """
+    if bootstrapping(owner):
+        return False
+    state = _get_state(owner)
+    if state is not None and time.time() - state["synced_at"] < MIRROR_MAX_AGE:
+        return True
+    with _owner_lock(owner):
+        if bootstrapping(owner):
+            return False
+        state = _get_state(owner)
+        if state is not None and time.time() - state["synced_at"] < MIRROR_MAX_AGE:
+            return True
+        return sync(service, owner, seed_history_id)
+
+
+def mark_stale(owner):
+    """
+    Force the next read for the mailbox to sync first (e.g. after a push notification).
+    """
+    if not enabled():
+        return
+    _connection().execute("UPDATE sync_state SET synced_at = 0 WHERE owner = ?", (owner,))
+
+
+def list_messages(owner, label_ids=None, max_results=20, page_token=None, view="full"):
+    """
+    Return (emails, next_page_token) in the same shape as gmail_service.list_emails.
+    When the mirrored messages run out, the next token is a continuation token (see
+    continuation_query) so older pages are read from Gmail.
+    """
+    offset = int(page_token[len(PAGE_TOKEN_PREFIX):]) if page_token else 0
+    query = "SELECT m.* FROM messages m WHERE m.owner = ?"
+    params = [owner]
+    for label_id in label_ids or []:
+        query += (
+            " AND EXISTS (SELECT 1 FROM message_labels l"
+            " WHERE l.owner = m.owner AND l.message_id = m.id AND l.label_id = ?)"
+        )
+        params.append(label_id)
+    query += " ORDER BY m.internal_date DESC LIMIT ? OFFSET ?"
+    params.extend([max_results + 1, offset])
+    rows = _connection().execute(query, params).fetchall()
+
+    emails = []
+    for row in rows[:max_results]:
+        message = json.loads(row["message"])
+        if view == "summary":
+            payload = {"headers": json.loads(row["headers"])}
+        else:
+            payload = message.get("payload")
+        emails.append({
+            "id": row["id"],
+            "threadId": row["thread_id"],
+            "snippet": row["snippet"],
+            "payload": payload,
+            "internalDate": message.get("internalDate"),
+            "labelIds": message.get("labelIds", []),
+        })
+    if len(rows) > max_results:
+        next_page_token = f"{PAGE_TOKEN_PREFIX}{offset + max_results}"
+    else:
+        next_page_token = continuation_token(_oldest_internal_date(owner))
+    return emails, next_page_token
+
+
+def _oldest_internal_date(owner):
+    row = _connection().execute(
+        "SELECT MIN(internal_date) AS oldest FROM messages WHERE owner = ?", (owner,)
+    ).fetchone()
+    return row["oldest"] if row else None
+
+
+def continuation_token(before_ms, gmail_page_token=None):
+    """
+    Token for the Gmail pages older than the mirror (internal dates are in ms).
+    """
+    if before_ms is None:
+        return None
+    token = f"{CONTINUATION_PREFIX}{int(before_ms) // 1000}"
+    return f"{token}:{gmail_page_token}" if gmail_page_token else token
+
+
+def continuation_query(page_token):
+    """
+    Return (q, gmail_page_token, before_seconds) for a continuation token, or None for
+    any other token.
+    """
+    if not page_token or not page_token.startswith(CONTINUATION_PREFIX):
+        return None
+    before, _, gmail_page_token = page_token[len(CONTINUATION_PREFIX):].partition(":")
+    return f"before:{before}", gmail_page_token or None, int(before)
+
+
+def get_message(owner, msg_id):
+    """
+    Return the mirrored full message resource, or None if it is not mirrored.
+    """
+    row = _connection().execute(
+        "SELECT message FROM messages WHERE owner = ? AND id = ?", (owner, msg_id)
+    ).fetchone()
+    return json.loads(row["message"]) if row else None
+
+
+def get_body_text(owner, msg_id):
+    row = _connection().execute(
+        "SELECT body_text FROM messages WHERE owner = ? AND id = ?", (owner, msg_id)
+    ).fetchone()
+    return row["body_text"] if row else None
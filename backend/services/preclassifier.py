@@ -0,0 +1,316 @@
+# services/preclassifier.py
+"""
+Deterministic pre-classifier that runs before Claude. Obvious mail (bulk promotions
+with List-Unsubscribe, noreply receipts, calendar invitations, and bulk senders whose
+mail has always landed in the same category) is classified from headers, sender and
+MIME structure alone, producing the same dict shape Claude returns. Anything ambiguous
+returns None and goes to the LLM.
+
+Rules are data: DEFAULT_RULES below, or a JSON list in the file named by
+PRECLASSIFIER_RULES_PATH. A rule has a "name", a "category" and a "when"; a rules file
+that does not validate is ignored in favour of DEFAULT_RULES. Every condition in a
+rule's "when" must hold:
+  header_present:    header names, any of which must be present
+  header_matches:    {header name: regex} (case-insensitive search)
+  sender_matches:    regex on the From address
+  subject_matches:   regex on the subject
+  mime_type_present: MIME types, any of which must appear in the message
+"""
+import datetime
+import email.utils
+import json
+import logging
+import os
+import re
+import threading
+from collections import Counter
+
+from cachetools import LRUCache
+
+from services.classification_schema import CONTENT_SCHEMAS
+
+logger = logging.getLogger(__name__)
+
+PRECLASSIFIER_ENABLED = os.getenv("PRECLASSIFIER_ENABLED", "1") != "0"
+PRECLASSIFIER_RULES_PATH = os.getenv("PRECLASSIFIER_RULES_PATH")
+# A bulk sender is classified from history once this many of its emails to the same user
+# were classified by Claude and at least HISTORY_AGREEMENT of them landed in one category.
+# History is kept per (user, sender): categories follow each user's own analysis profile.
+HISTORY_MIN_SAMPLES = int(os.getenv("PRECLASSIFIER_HISTORY_MIN", "5"))
+HISTORY_AGREEMENT = float(os.getenv("PRECLASSIFIER_HISTORY_AGREEMENT", "0.9"))
+HISTORY_SIZE = int(os.getenv("PRECLASSIFIER_HISTORY_SIZE", "5000"))
+# Only categories whose content can be filled in without the LLM are reused from history.
+HISTORY_CATEGORIES = {"Promotion", "Information", "Receipts"}
+PROMOTION_DEFAULT_DAYS = 7
+
+DEFAULT_RULES = [
+    {
+        "name": "calendar_invitation",
+        "category": "Meeting Update",
+        "when": {"mime_type_present": ["text/calendar", "application/ics"]},
+    },
+    {
+        "name": "noreply_receipt",
+        "category": "Receipts",
+        "when": {
+            "sender_matches": r"(^|[._-])(no-?reply|do-?not-?reply|receipts?|billing|orders?|payments?)@",
+            "subject_matches": r"\b(receipt|invoice|order (confirmation|confirmed|#)|your order|payment (received|confirmation)|purchase confirmation)\b",
+        },
+    },
+    {
+        "name": "bulk_promotion",
+        "category": "Promotion",
+        "when": {
+            "header_present": ["List-Unsubscribe"],
+            "subject_matches": r"(\d+\s*% off|\bsale\b|\bdeals?\b|\boffer\b|\bdiscount\b|\bcoupon\b|\bpromo\b|free shipping|limited time|\bsave \$?\d+)",
+        },
+    },
+]
+
+_rules = None
+_rules_lock = threading.Lock()
+_sender_history = LRUCache(maxsize=HISTORY_SIZE)
+_history_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_stats = {"seen": 0, "short_circuited": 0, "by_rule": Counter()}
+
+
+CONDITIONS = {"header_present", "header_matches", "sender_matches", "subject_matches", "mime_type_present"}
+
+
+def validate_rules(rules):
+    """
+    Return a list of problems with a rules list (empty when it is usable).
+    """
+    if not isinstance(rules, list):
+        return ["rules must be a list"]
+    errors = []
+    for index, rule in enumerate(rules):
+        where = f"rule {index}"
+        if not isinstance(rule, dict):
+            errors.append(f"{where} must be an object")
+            continue
+        for key in ("name", "category"):
+            if not isinstance(rule.get(key), str) or not rule[key]:
+                errors.append(f"{where}: {key} is required")
+        if isinstance(rule.get("category"), str) and rule["category"] and rule["category"] not in CONTENT_SCHEMAS:
+            errors.append(f"{where}: unknown category {rule['category']!r}")
+        when = rule.get("when")
+        if not isinstance(when, dict) or not when:
+            errors.append(f"{where}: when must be a non-empty object")
+            continue
+        for condition in set(when) - CONDITIONS:
+            errors.append(f"{where}: unknown condition {condition!r}")
+        patterns = [when[key] for key in ("sender_matches", "subject_matches") if key in when]
+        header_matches = when.get("header_matches", {})
+        if not isinstance(header_matches, dict):
+            errors.append(f"{where}: header_matches must be an object")
+        else:
+            patterns.extend(header_matches.values())
+        for pattern in patterns:
+            try:
+                re.compile(pattern)
+            except (re.error, TypeError) as e:
+                errors.append(f"{where}: bad pattern {pattern!r}: {e}")
+        for key in ("header_present", "mime_type_present"):
+            if key in when and not (isinstance(when[key], list) and all(isinstance(v, str) for v in when[key])):
+                errors.append(f"{where}: {key} must be a list of strings")
+    return errors
+
+
+def _load_rules():
+    if PRECLASSIFIER_RULES_PATH:
+        try:
+            with open(PRECLASSIFIER_RULES_PATH, "r", encoding="utf-8") as f:
+                rules = json.load(f)
+            errors = validate_rules(rules)
+            if not errors:
+                logger.info("Loaded %d pre-classifier rule(s) from %s", len(rules), PRECLASSIFIER_RULES_PATH)
+                return rules
+            logger.error(
+                "Ignoring pre-classifier rules in %s (%s); using the defaults",
+                PRECLASSIFIER_RULES_PATH, "; ".join(errors),
+            )
+        except Exception as e:
+            logger.error("Could not load pre-classifier rules from %s: %s", PRECLASSIFIER_RULES_PATH, e)
+    return DEFAULT_RULES
+
+
+def get_rules():
+    global _rules
+    if _rules is None:
+        with _rules_lock:
+            if _rules is None:
+                _rules = _load_rules()
+    return _rules
+
+
+def set_rules(rules):
+    """
+    Replace the rules; raises ValueError if they do not validate.
+    """
+    global _rules
+    errors = validate_rules(rules)
+    if errors:
+        raise ValueError("Invalid pre-classifier rules: " + "; ".join(errors))
+    with _rules_lock:
+        _rules = rules
+
+
+# ── message features ─────────────────────────────────────────────────────────
+def _headers(email_detail):
+    return {h["name"].lower(): h["value"] for h in email_detail.get("payload", {}).get("headers", [])}
+
+
+def _mime_types(payload):
+    types = set()
+    stack = [payload or {}]
+    while stack:
+        part = stack.pop()
+        if part.get("mimeType"):
+            types.add(part["mimeType"].lower())
+        if (part.get("filename") or "").lower().endswith(".ics"):
+            types.add("application/ics")
+        stack.extend(part.get("parts") or [])
+    return types
+
+
+def _features(email_detail):
+    headers = _headers(email_detail)
+    name, address = email.utils.parseaddr(headers.get("from", ""))
+    return {
+        "headers": headers,
+        "subject": headers.get("subject", ""),
+        "sender_name": name,
+        "sender": address.lower(),
+        "mime_types": _mime_types(email_detail.get("payload")),
+        "snippet": email_detail.get("snippet", ""),
+        "bulk": "list-unsubscribe" in headers or headers.get("precedence", "").lower() in ("bulk", "list"),
+    }
+
+
+def _matches(when, features):
+    headers = features["headers"]
+    if "header_present" in when and not any(h.lower() in headers for h in when["header_present"]):
+        return False
+    for header, pattern in (when.get("header_matches") or {}).items():
+        if not re.search(pattern, headers.get(header.lower(), ""), re.IGNORECASE):
+            return False
+    if "sender_matches" in when and not re.search(when["sender_matches"], features["sender"], re.IGNORECASE):
+        return False
+    if "subject_matches" in when and not re.search(when["subject_matches"], features["subject"], re.IGNORECASE):
+        return False
+    if "mime_type_present" in when and not features["mime_types"] & {t.lower() for t in when["mime_type_present"]}:
+        return False
+    return True
+
+
+# ── output in the classification dict shape ──────────────────────────────────
+def _content(category, features):
+    subject, snippet = features["subject"], features["snippet"]
+    if category == "Promotion":
+        expiration = datetime.date.today() + datetime.timedelta(days=PROMOTION_DEFAULT_DAYS)
+        return {"title": subject, "details": snippet, "expiration": expiration.strftime("%m/%d/%Y")}
+    if category == "Receipts":
+        text = f"{subject} {snippet}"
+        order = re.search(r"(?:order|receipt|invoice)\s*(?:#|no\.?|number)?\s*[:#]?\s*((?=[A-Z0-9-]*\d)[A-Z0-9][A-Z0-9-]{3,})", text, re.IGNORECASE)
+        amount = re.search(r"[$€£]\s?\d[\d,]*(?:\.\d{2})?", text)
+        return {
+            "orderNumber": order.group(1) if order else "",
+            "totalAmount": amount.group(0) if amount else "",
+            "summary": snippet or subject,
+        }
+    if category == "Meeting Update":
+        return {
+            "meetingSubject": subject,
+            "oldDateTime": "",
+            "oldLocation": "",
+            "newDateTime": "",
+            "newLocation": "",
+            "additionalNotes": "",
+            "summary": snippet or subject,
+        }
+    return {"summary": snippet or subject}
+
+
+def _classification(email_id, category, features):
+    sender_name = features["sender_name"] or features["sender"].split("@")[-1]
+    return {
+        "category": category,
+        "emailId": email_id,
+        "sender": {"name": sender_name, "type": "Company"},
+        "content": _content(category, features),
+    }
+
+
+def _from_history(user_email, features):
+    if not features["bulk"] or not features["sender"] or not user_email:
+        return None
+    with _history_lock:
+        counts = _sender_history.get((user_email, features["sender"]))
+        if not counts:
+            return None
+        total = sum(counts.values())
+        category, hits = counts.most_common(1)[0]
+    if total >= HISTORY_MIN_SAMPLES and hits / total >= HISTORY_AGREEMENT and category in HISTORY_CATEGORIES:
+        return category
+    return None
+
+
+def _count(rule_name):
+    with _stats_lock:
+        _stats["seen"] += 1
+        if rule_name:
+            _stats["short_circuited"] += 1
+            _stats["by_rule"][rule_name] += 1
+
+
+def classify(user_email, email_detail):
+    """
+    Return a classification dict for an obvious email in user_email's mailbox, or None
+    when Claude is needed.
+    """
+    if not PRECLASSIFIER_ENABLED:
+        return None
+    features = _features(email_detail)
+    email_id = email_detail.get("id")
+    for rule in get_rules():
+        if _matches(rule.get("when") or {}, features):
+            _count(rule["name"])
+            logger.info("Email %s pre-classified as %s by rule %s", email_id, rule["category"], rule["name"])
+            return _classification(email_id, rule["category"], features)
+    category = _from_history(user_email, features)
+    if category:
+        _count("sender_history")
+        logger.info("Email %s pre-classified as %s from sender history", email_id, category)
+        return _classification(email_id, category, features)
+    _count(None)
+    return None
+
+
+def record(user_email, email_detail, category):
+    """
+    Remember the category Claude chose for a sender in user_email's mailbox, for
+    history-based pre-classification.
+    """
+    sender = email.utils.parseaddr(_headers(email_detail).get("from", ""))[1].lower()
+    if not user_email or not sender or not category:
+        return
+    key = (user_email, sender)
+    with _history_lock:
+        counts = _sender_history.get(key) or Counter()
+        counts[category] += 1
+        _sender_history[key] = counts
+
+
+def stats():
+    with _stats_lock:
+        seen = _stats["seen"]
+        return {
+            "enabled": PRECLASSIFIER_ENABLED,
+            "seen": seen,
+            "short_circuited": _stats["short_circuited"],
+            "short_circuited_fraction": round(_stats["short_circuited"] / seen, 4) if seen else 0.0,
+            "by_rule": dict(_stats["by_rule"]),
+            "senders_tracked": len(_sender_history),
+        }
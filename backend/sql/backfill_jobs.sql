@@ -0,0 +1,28 @@
+-- sql/backfill_jobs.sql
+-- Checkpoints for services/backfill.py. One row per backfill job; the job updates its
+-- row after every step so it can resume after a restart.
+create table if not exists backfill_jobs (
+    id uuid primary key default gen_random_uuid(),
+    email text not null,
+    status text not null default 'listing',  -- listing | submitting | submitted | applying | done | failed
+    days integer not null default 30,
+    page_token text,                           -- next messages.list page while listing
+    message_ids jsonb not null default '[]'::jsonb,
+    batch_id text,                             -- message batch holding the classification requests
+    precomputed jsonb not null default '{}'::jsonb,   -- emailId -> classification answered without Claude
+    preclassified jsonb not null default '[]'::jsonb, -- the pre-classifier's share of precomputed
+    applied_count integer not null default 0,  -- how many of message_ids have been applied
+    error text,
+    failed_status text,                        -- step a failed job stopped in; start_backfill resumes it from there
+    created_at timestamptz not null default now(),
+    updated_at timestamptz not null default now()
+);
+
+-- Tables created before these columns existed.
+alter table backfill_jobs add column if not exists failed_status text;
+alter table backfill_jobs add column if not exists precomputed jsonb not null default '{}'::jsonb;
+alter table backfill_jobs add column if not exists preclassified jsonb not null default '[]'::jsonb;
+
+create index if not exists backfill_jobs_email_created_idx on backfill_jobs (email, created_at desc);
+create index if not exists backfill_jobs_active_idx on backfill_jobs (status)
+    where status in ('listing', 'submitting', 'submitted', 'applying');
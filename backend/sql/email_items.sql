@@ -0,0 +1,43 @@
+-- sql/email_items.sql
+-- Normalized storage for the per-category email items (promotions, information, drafts,
+-- action_required, receipts, meeting_updates, others, sent_emails) that used to live as
+-- JSON arrays on the users row. One row per (user, category, emailId), so appends and
+-- removals touch only the affected rows. Used when EMAIL_ITEMS_STORE=table.
+--
+-- Switching over:
+--   1. run this file (creates the table and copies the arrays; the arrays are left as they are,
+--      so the default EMAIL_ITEMS_STORE=users keeps working);
+--   2. deploy with EMAIL_ITEMS_STORE=table;
+--   3. run sql/email_items_cutover.sql to empty the legacy arrays.
+create table if not exists email_items (
+    id bigserial primary key,           -- insertion order; items are listed oldest first
+    user_email text not null,
+    category text not null,             -- named after the legacy users column
+    email_id text not null,
+    item jsonb not null,                -- the item exactly as the array held it
+    created_at timestamptz not null default now(),
+    unique (user_email, category, email_id)
+);
+
+-- The unique constraint's index serves lookups by (user_email, category[, email_id]);
+-- this one serves the ordered listing of one user's items.
+create index if not exists email_items_user_id_idx on email_items (user_email, id);
+
+-- One-time copy of the legacy arrays, preserving their order. Safe to re-run (before the
+-- cutover). Items without an emailId are kept under a stable key made from their position.
+insert into email_items (user_email, category, email_id, item)
+select u.email, c.category, coalesce(e.value ->> 'emailId', 'legacy:' || e.position), e.value
+from users u
+cross join lateral (values
+    ('promotions', u.promotions),
+    ('information', u.information),
+    ('drafts', u.drafts),
+    ('action_required', u.action_required),
+    ('receipts', u.receipts),
+    ('meeting_updates', u.meeting_updates),
+    ('others', u.others),
+    ('sent_emails', u.sent_emails)
+) as c (category, items)
+cross join lateral jsonb_array_elements(coalesce(c.items, '[]'::jsonb)) with ordinality as e (value, position)
+order by u.email, c.category, e.position
+on conflict (user_email, category, email_id) do nothing;
@@ -0,0 +1,37 @@
+-- sql/email_items_cutover.sql
+-- Post-cutover cleanup for sql/email_items.sql. Run only once the app is deployed with
+-- EMAIL_ITEMS_STORE=table: it empties the legacy per-category arrays on the users row,
+-- which the default EMAIL_ITEMS_STORE=users still reads.
+--
+-- A user's arrays are only emptied when email_items holds at least as many rows as the
+-- arrays have distinct item keys, in every category, so a user the copy missed keeps
+-- their items.
+update users u set
+    promotions = '[]'::jsonb,
+    information = '[]'::jsonb,
+    drafts = '[]'::jsonb,
+    action_required = '[]'::jsonb,
+    receipts = '[]'::jsonb,
+    meeting_updates = '[]'::jsonb,
+    others = '[]'::jsonb,
+    sent_emails = '[]'::jsonb
+where not exists (
+    select 1
+    from (values
+        ('promotions', u.promotions),
+        ('information', u.information),
+        ('drafts', u.drafts),
+        ('action_required', u.action_required),
+        ('receipts', u.receipts),
+        ('meeting_updates', u.meeting_updates),
+        ('others', u.others),
+        ('sent_emails', u.sent_emails)
+    ) as c (category, items)
+    where (
+        -- Distinct keys, as the copy stores them (duplicates collapse into one row).
+        select count(distinct coalesce(e.value ->> 'emailId', 'legacy:' || e.position))
+        from jsonb_array_elements(coalesce(c.items, '[]'::jsonb)) with ordinality as e (value, position)
+    ) > (
+        select count(*) from email_items i where i.user_email = u.email and i.category = c.category
+    )
+);
@@ -0,0 +1,68 @@
+-- sql/email_items_rpc.sql
+-- Delta updates for the legacy per-category JSONB arrays on the users row
+-- (EMAIL_ITEMS_STORE=users). Each call is a single UPDATE, so the change is atomic and
+-- the request carries only the affected items instead of the whole array.
+-- The category columns must be jsonb. Called from user_store.py through supabase.rpc
+-- when EMAIL_ITEMS_RPC=1. Only the backend's service role may execute them.
+
+create or replace function email_items_check_column(p_column text)
+returns void
+language plpgsql
+as $$
+begin
+    if p_column not in ('promotions', 'information', 'drafts', 'action_required',
+                        'receipts', 'meeting_updates', 'others', 'sent_emails') then
+        raise exception 'Unknown item category: %', p_column;
+    end if;
+end;
+$$;
+
+-- Append p_items (a JSONB array of objects with "emailId") to users.<p_column>. An
+-- existing element with the same emailId is removed first, so the new item replaces it.
+create or replace function email_items_append(p_email text, p_column text, p_items jsonb)
+returns void
+language plpgsql
+as $$
+begin
+    perform email_items_check_column(p_column);
+    execute format(
+        'update users set %1$I = coalesce((
+             select jsonb_agg(e.value order by e.position)
+             from jsonb_array_elements(coalesce(%1$I, ''[]''::jsonb)) with ordinality as e (value, position)
+             where not exists (
+                 select 1 from jsonb_array_elements($2) as n (value)
+                 where n.value ->> ''emailId'' = e.value ->> ''emailId''
+             )
+         ), ''[]''::jsonb) || $2
+         where email = $1',
+        p_column
+    ) using p_email, p_items;
+end;
+$$;
+
+-- Remove every element whose emailId is in p_email_ids from users.<p_column>.
+create or replace function email_items_remove(p_email text, p_column text, p_email_ids text[])
+returns void
+language plpgsql
+as $$
+begin
+    perform email_items_check_column(p_column);
+    execute format(
+        'update users set %1$I = coalesce((
+             select jsonb_agg(e.value order by e.position)
+             from jsonb_array_elements(coalesce(%1$I, ''[]''::jsonb)) with ordinality as e (value, position)
+             where not (e.value ->> ''emailId'' = any($2))
+         ), ''[]''::jsonb)
+         where email = $1',
+        p_column
+    ) using p_email, p_email_ids;
+end;
+$$;
+
+-- The functions take an arbitrary p_email, so they must not be callable by clients.
+revoke execute on function email_items_check_column(text) from public, anon, authenticated;
+revoke execute on function email_items_append(text, text, jsonb) from public, anon, authenticated;
+revoke execute on function email_items_remove(text, text, text[]) from public, anon, authenticated;
+grant execute on function email_items_check_column(text) to service_role;
+grant execute on function email_items_append(text, text, jsonb) to service_role;
+grant execute on function email_items_remove(text, text, text[]) to service_role;
@@ -0,0 +1,11 @@
+-- sql/processed_dedup.sql
+-- Bounded dedup state for services/dedup_store.py, replacing the ever-growing
+-- latest_processed_emails / latest_processed_threads arrays on the users row.
+-- Each column holds a DedupSet: {"recent": [...], "current": filter, "previous": filter},
+-- where a filter is {"bits": base64(zlib(bits)), "num_bits", "num_hashes", "count"}.
+create table if not exists processed_dedup (
+    user_email text primary key,
+    emails jsonb not null default '{}'::jsonb,
+    threads jsonb not null default '{}'::jsonb,
+    updated_at timestamptz not null default now()
+);
@@ -0,0 +1,125 @@
+import copy
+import os
+import sys
+import types
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+
+
+class FakeQuery:
+    """
+    The subset of the supabase-py query builder the backend uses, over in-memory rows.
+    """
+
+    def __init__(self, tables, name):
+        self.tables = tables
+        self.name = name
+        self.filters = []
+        self.operation = "select"
+        self.payload = None
+        self.ordering = None
+        self.row_limit = None
+        self.on_conflict = []
+
+    def select(self, *columns):
+        self.operation = "select"
+        return self
+
+    def eq(self, column, value):
+        self.filters.append(lambda row: row.get(column) == value)
+        return self
+
+    def in_(self, column, values):
+        self.filters.append(lambda row: row.get(column) in values)
+        return self
+
+    def order(self, column, desc=False):
+        self.ordering = (column, desc)
+        return self
+
+    def limit(self, count):
+        self.row_limit = count
+        return self
+
+    def insert(self, payload):
+        self.operation, self.payload = "insert", payload
+        return self
+
+    def update(self, payload):
+        self.operation, self.payload = "update", payload
+        return self
+
+    def upsert(self, payload, on_conflict=""):
+        self.operation, self.payload = "upsert", payload
+        self.on_conflict = [column for column in on_conflict.split(",") if column]
+        return self
+
+    def delete(self):
+        self.operation = "delete"
+        return self
+
+    def execute(self):
+        rows = self.tables.setdefault(self.name, [])
+        matched = [row for row in rows if all(check(row) for check in self.filters)]
+        if self.operation == "select":
+            if self.ordering:
+                column, desc = self.ordering
+                matched.sort(key=lambda row: row.get(column) or "", reverse=desc)
+            if self.row_limit is not None:
+                matched = matched[:self.row_limit]
+            return FakeResponse(copy.deepcopy(matched))
+        if self.operation == "update":
+            for row in matched:
+                row.update(copy.deepcopy(self.payload))
+            return FakeResponse(copy.deepcopy(matched))
+        if self.operation == "delete":
+            self.tables[self.name] = [row for row in rows if row not in matched]
+            return FakeResponse(copy.deepcopy(matched))
+        written = []
+        for item in self.payload if isinstance(self.payload, list) else [self.payload]:
+            existing = [
+                row for row in rows
+                if self.on_conflict and all(row.get(column) == item.get(column) for column in self.on_conflict)
+            ]
+            if existing:
+                existing[0].update(copy.deepcopy(item))
+                written.append(existing[0])
+            else:
+                row = copy.deepcopy(item)
+                row.setdefault("id", len(rows) + 1)
+                rows.append(row)
+                written.append(row)
+        return FakeResponse(copy.deepcopy(written))
+
+
+class FakeSupabase:
+    def __init__(self):
+        self.tables = {}
+
+    def table(self, name):
+        return FakeQuery(self.tables, name)
+
+    def rpc(self, function, params):
+        raise NotImplementedError(function)
+
+
+# Installed before any backend module is imported, so the tests never reach a real project.
+_fake_supabase = FakeSupabase()
+_supabase_client = types.ModuleType("supabase_client")
+_supabase_client.supabase = _fake_supabase
+sys.modules["supabase_client"] = _supabase_client
+
+
+@pytest.fixture
+def fake_supabase():
+    _fake_supabase.tables.clear()
+    yield _fake_supabase
+    _fake_supabase.tables.clear()
@@ -0,0 +1,319 @@
+import base64
+import re
+
+import pytest
+
+from services import backfill, classification_engine
+
+USER_EMAIL = "owner@example.com"
+INBOX = ["m1", "m2", "m3", "m4", "m5"]
+PAGE_SIZE = 2
+
+
+class FakeRequest:
+    def __init__(self, result):
+        self.result = result
+
+    def execute(self):
+        return self.result
+
+
+class FakeGmail:
+    """
+    users().messages().list over INBOX, PAGE_SIZE messages per page.
+    """
+
+    def __init__(self):
+        self.list_calls = []
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def list(self, **params):
+        self.list_calls.append(params)
+        start = int(params.get("pageToken") or 0)
+        result = {"messages": [{"id": msg_id} for msg_id in INBOX[start:start + PAGE_SIZE]]}
+        if start + PAGE_SIZE < len(INBOX):
+            result["nextPageToken"] = str(start + PAGE_SIZE)
+        return FakeRequest(result)
+
+
+class FakeAsyncGoogleClient:
+    def __init__(self, email, token):
+        self.email = email
+
+    async def get_messages(self, message_ids, format="full"):
+        return {msg_id: _message(msg_id) for msg_id in message_ids}
+
+
+def _message(msg_id):
+    return {
+        "id": msg_id,
+        "threadId": f"t-{msg_id}",
+        "payload": {
+            "mimeType": "text/plain",
+            "headers": [
+                {"name": "Subject", "value": f"Subject {msg_id}"},
+                {"name": "From", "value": "Sender <sender@example.com>"},
+            ],
+            "body": {"data": base64.urlsafe_b64encode(f"Body of {msg_id}".encode()).decode()},
+        },
+    }
+
+
+def _responder(params):
+    msg_id = re.search(r"Email ID: (\S+)", params["messages"][0]["content"]).group(1)
+    return [{
+        "type": "tool_use",
+        "id": f"toolu_{msg_id}",
+        "name": "classify_other",
+        "input": {
+            "emailId": msg_id,
+            "sender": {"name": "Sender", "type": "Individual"},
+            "content": {"summary": f"Summary of {msg_id}"},
+        },
+    }]
+
+
+@pytest.fixture
+def env(fake_supabase, monkeypatch):
+    fake_supabase.table("users").insert({"email": USER_EMAIL, "token": {}, "analysis": "Writes briefly."}).execute()
+    gmail = FakeGmail()
+    batches = backfill.LocalBatchClient(responder=_responder)
+    applied = []
+
+    def run_classification(service, email, token, user, message_ids, precomputed=None, preclassified=()):
+        applied.extend((msg_id, (precomputed or {}).get(msg_id)) for msg_id in message_ids)
+        return {"state": {}}
+
+    monkeypatch.setattr(backfill, "get_service", lambda *args, **kwargs: gmail)
+    monkeypatch.setattr(backfill, "AsyncGoogleClient", FakeAsyncGoogleClient)
+    monkeypatch.setattr(backfill, "BACKFILL_APPLY_CHUNK", 2)
+    monkeypatch.setattr(classification_engine, "run_classification", run_classification)
+    monkeypatch.setattr(classification_engine, "persist_state", lambda email, state: None)
+    monkeypatch.setattr(backfill, "_batch_client", batches)
+    return fake_supabase, gmail, batches, applied
+
+
+def _create_job(db, **fields):
+    job = {"email": USER_EMAIL, "days": 30, "status": "listing", "message_ids": [], "applied_count": 0}
+    job.update(fields)
+    return db.table("backfill_jobs").insert(job).execute().data[0]
+
+
+def _summary(msg_id):
+    return {
+        "category": "None",
+        "emailId": msg_id,
+        "sender": {"name": "Sender", "type": "Individual"},
+        "content": {"summary": f"Summary of {msg_id}"},
+    }
+
+
+def test_run_job_from_listing_applies_every_message(env):
+    db, gmail, batches, applied = env
+    job = _create_job(db)
+
+    backfill.run_job(job["id"])
+
+    stored = backfill.get_job(job["id"])
+    assert stored["status"] == "done"
+    assert stored["message_ids"] == INBOX
+    assert stored["applied_count"] == len(INBOX)
+    assert stored["page_token"] is None
+    assert len(gmail.list_calls) == 3
+    assert applied == [(msg_id, _summary(msg_id)) for msg_id in INBOX]
+
+
+def test_resume_listing_continues_from_the_stored_page(env):
+    db, gmail, batches, applied = env
+    job = _create_job(db, message_ids=INBOX[:2], page_token="2")
+
+    backfill.run_job(job["id"])
+
+    assert [call.get("pageToken") for call in gmail.list_calls] == ["2", "4"]
+    assert backfill.get_job(job["id"])["message_ids"] == INBOX
+    assert [msg_id for msg_id, _ in applied] == INBOX
+
+
+def test_resume_submitting_does_not_list_again(env):
+    db, gmail, batches, applied = env
+    job = _create_job(db, status="submitting", message_ids=INBOX)
+
+    backfill.run_job(job["id"])
+
+    stored = backfill.get_job(job["id"])
+    assert gmail.list_calls == []
+    assert stored["status"] == "done"
+    assert stored["batch_id"]
+    assert applied == [(msg_id, _summary(msg_id)) for msg_id in INBOX]
+
+
+def test_resume_submitting_skips_processed_messages(env):
+    db, gmail, batches, applied = env
+    db.table("users").update({"latest_processed_emails": ["m1", "m2"]}).eq("email", USER_EMAIL).execute()
+    job = _create_job(db, status="submitting", message_ids=INBOX)
+
+    backfill.run_job(job["id"])
+
+    batch_id = backfill.get_job(job["id"])["batch_id"]
+    assert sorted(custom_id for custom_id, _ in batches.results(batch_id)) == ["m3", "m4", "m5"]
+
+
+def test_resume_submitted_reuses_the_stored_batch(env):
+    db, gmail, batches, applied = env
+    batch_id = batches.create([
+        {"custom_id": msg_id, "params": {"messages": [{"role": "user", "content": f"Email ID: {msg_id}\n"}]}}
+        for msg_id in INBOX
+    ])
+    job = _create_job(db, status="submitted", message_ids=INBOX, batch_id=batch_id)
+
+    backfill.run_job(job["id"])
+
+    assert gmail.list_calls == []
+    assert batches._next_id == 1
+    assert backfill.get_job(job["id"])["status"] == "done"
+    assert applied == [(msg_id, _summary(msg_id)) for msg_id in INBOX]
+
+
+def test_resume_applying_skips_applied_messages(env):
+    db, gmail, batches, applied = env
+    batch_id = batches.create([
+        {"custom_id": msg_id, "params": {"messages": [{"role": "user", "content": f"Email ID: {msg_id}\n"}]}}
+        for msg_id in INBOX
+    ])
+    job = _create_job(db, status="applying", message_ids=INBOX, batch_id=batch_id, applied_count=2)
+
+    backfill.run_job(job["id"])
+
+    stored = backfill.get_job(job["id"])
+    assert stored["status"] == "done"
+    assert stored["applied_count"] == len(INBOX)
+    assert [msg_id for msg_id, _ in applied] == INBOX[2:]
+
+
+def test_messages_without_a_batch_result_are_classified_synchronously(env):
+    db, gmail, batches, applied = env
+    backfill.set_batch_client(backfill.LocalBatchClient(
+        responder=lambda params: None if "Email ID: m3" in params["messages"][0]["content"] else _responder(params)
+    ))
+    job = _create_job(db, status="submitting", message_ids=INBOX)
+
+    backfill.run_job(job["id"])
+
+    assert dict(applied)["m3"] is None
+    assert dict(applied)["m4"] == _summary("m4")
+
+
+def test_failed_step_marks_the_job_failed(env, monkeypatch):
+    db, gmail, batches, applied = env
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("gmail unavailable")
+
+    monkeypatch.setattr(gmail, "list", fail)
+    job = _create_job(db)
+
+    backfill.run_job(job["id"])
+
+    stored = backfill.get_job(job["id"])
+    assert stored["status"] == "failed"
+    assert stored["error"] == "gmail unavailable"
+
+
+def test_failed_job_resumes_from_its_stored_batch(env, monkeypatch):
+    db, gmail, batches, applied = env
+    batch_id = batches.create([
+        {"custom_id": msg_id, "params": {"messages": [{"role": "user", "content": f"Email ID: {msg_id}\n"}]}}
+        for msg_id in INBOX
+    ])
+    job = _create_job(db, status="submitted", message_ids=INBOX, batch_id=batch_id)
+    monkeypatch.setattr(batches, "is_ended", lambda batch_id: (_ for _ in ()).throw(RuntimeError("poll failed")))
+
+    backfill.run_job(job["id"])
+
+    stored = backfill.get_job(job["id"])
+    assert (stored["status"], stored["failed_status"]) == ("failed", "submitted")
+
+    monkeypatch.setattr(batches, "is_ended", lambda batch_id: True)
+    monkeypatch.setattr(backfill, "_start", backfill.run_job)
+    resumed = backfill.start_backfill(USER_EMAIL)
+
+    stored = backfill.get_job(job["id"])
+    assert resumed["id"] == job["id"]
+    assert stored["status"] == "done"
+    assert stored["batch_id"] == batch_id
+    assert batches._next_id == 1
+    assert len(db.table("backfill_jobs").select("*").execute().data) == 1
+
+
+def test_batch_client_retries_transient_errors(monkeypatch):
+    import anthropic
+    import httpx
+
+    calls = []
+
+    class Batches:
+        def retrieve(self, batch_id):
+            calls.append(batch_id)
+            if len(calls) < 3:
+                raise anthropic.APIConnectionError(request=httpx.Request("GET", "https://api.anthropic.com"))
+            return type("Batch", (), {"processing_status": "ended", "request_counts": {}})()
+
+    client = type("Client", (), {"messages": type("Messages", (), {"batches": Batches()})()})()
+    monkeypatch.setattr(backfill, "get_anthropic_client", lambda: client)
+    monkeypatch.setattr(backfill.time, "sleep", lambda seconds: None)
+
+    assert backfill.AnthropicBatchClient().is_ended("batch_1")
+    assert len(calls) == 3
+
+
+def test_apply_loads_state_once_per_lane_task(env, monkeypatch):
+    db, gmail, batches, applied = env
+    runs = []
+    monkeypatch.setattr(backfill, "BACKFILL_APPLY_CHUNK", 5)
+    monkeypatch.setattr(backfill, "BACKFILL_LANE_TASK", 2)
+    monkeypatch.setattr(
+        classification_engine, "run_classification",
+        lambda service, email, token, user, message_ids, precomputed=None, preclassified=(): runs.append(list(message_ids)) or {"state": {}},
+    )
+    job = _create_job(db, status="submitting", message_ids=INBOX)
+
+    backfill.run_job(job["id"])
+
+    assert runs == [["m1", "m2"], ["m3", "m4"], ["m5"]]
+
+
+def test_preclassified_messages_stay_out_of_the_batch(env, monkeypatch):
+    db, gmail, batches, applied = env
+    preclassified_ids = []
+
+    class PromotionClient(FakeAsyncGoogleClient):
+        async def get_messages(self, message_ids, format="full"):
+            details = {msg_id: _message(msg_id) for msg_id in message_ids}
+            details["m2"]["payload"]["headers"] = [
+                {"name": "Subject", "value": "Summer sale: 40% off"},
+                {"name": "From", "value": "Shop <news@shop.example>"},
+                {"name": "List-Unsubscribe", "value": "<mailto:unsubscribe@shop.example>"},
+            ]
+            return details
+
+    def run_classification(service, email, token, user, message_ids, precomputed=None, preclassified=()):
+        applied.extend((msg_id, (precomputed or {}).get(msg_id)) for msg_id in message_ids)
+        preclassified_ids.extend(msg_id for msg_id in message_ids if msg_id in preclassified)
+        return {"state": {}}
+
+    monkeypatch.setattr(backfill, "AsyncGoogleClient", PromotionClient)
+    monkeypatch.setattr(classification_engine, "run_classification", run_classification)
+    job = _create_job(db, status="submitting", message_ids=INBOX)
+
+    backfill.run_job(job["id"])
+
+    stored = backfill.get_job(job["id"])
+    assert sorted(custom_id for custom_id, _ in batches.results(stored["batch_id"])) == ["m1", "m3", "m4", "m5"]
+    assert stored["preclassified"] == ["m2"]
+    assert dict(applied)["m2"]["category"] == "Promotion"
+    assert preclassified_ids == ["m2"]
@@ -0,0 +1,35 @@
+import json
+
+import pytest
+
+from services import preclassifier
+
+
+def test_default_rules_validate():
+    assert preclassifier.validate_rules(preclassifier.DEFAULT_RULES) == []
+
+
+@pytest.mark.parametrize("rule, problem", [
+    ({"category": "Promotion", "when": {"header_present": ["List-Unsubscribe"]}}, "name is required"),
+    ({"name": "bad_regex", "category": "Promotion", "when": {"subject_matches": "(sale"}}, "bad pattern"),
+    ({"name": "bad_header_regex", "category": "Promotion", "when": {"header_matches": {"X-Mailer": "["}}}, "bad pattern"),
+    ({"name": "bad_category", "category": "Spam", "when": {"subject_matches": "sale"}}, "unknown category"),
+    ({"name": "bad_condition", "category": "Promotion", "when": {"body_matches": "sale"}}, "unknown condition"),
+    ({"name": "no_conditions", "category": "Promotion", "when": {}}, "when must be a non-empty object"),
+])
+def test_invalid_rules_are_reported(rule, problem):
+    errors = preclassifier.validate_rules([rule])
+    assert any(problem in error for error in errors)
+
+
+def test_invalid_rules_file_falls_back_to_defaults(tmp_path, monkeypatch):
+    path = tmp_path / "rules.json"
+    path.write_text(json.dumps([{"category": "Promotion", "when": {"subject_matches": "(sale"}}]))
+    monkeypatch.setattr(preclassifier, "PRECLASSIFIER_RULES_PATH", str(path))
+
+    assert preclassifier._load_rules() is preclassifier.DEFAULT_RULES
+
+
+def test_set_rules_rejects_invalid_rules():
+    with pytest.raises(ValueError):
+        preclassifier.set_rules([{"name": "bad_regex", "category": "Promotion", "when": {"subject_matches": "(sale"}}])
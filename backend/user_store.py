@@ -1,5 +1,74 @@
+import copy
+import logging
+import os
+import threading
+
+from cachetools import TTLCache
+from flask import g, has_request_context
+
 from supabase_client import supabase
 
+logger = logging.getLogger(__name__)
+
+# Where the per-category email items live: "users" keeps the legacy JSON array columns
+# on the users row; "table" uses the normalized email_items table (sql/email_items.sql).
+EMAIL_ITEMS_STORE = os.getenv("EMAIL_ITEMS_STORE", "users")
+# With the legacy store and EMAIL_ITEMS_RPC=1, appends and removals go through the
+# Postgres functions in sql/email_items_rpc.sql so only the delta is sent. Opt-in, since
+# the functions must be installed first; a failing call falls back to reading and
+# rewriting the array.
+EMAIL_ITEMS_RPC = os.getenv("EMAIL_ITEMS_RPC", "0") == "1"
+# Item categories, named after the legacy users columns.
+ITEM_CATEGORIES = [
+    "promotions",
+    "information",
+    "drafts",
+    "action_required",
+    "receipts",
+    "meeting_updates",
+    "others",
+    "sent_emails",
+]
+
+# Columns of the users row used by request handling and classification runs. The
+# per-category item arrays are deliberately left out; they are read with list_items.
+USER_COLUMNS = (
+    "email, session_id, token, analysis, last_history_id, processed_emails, "
+    "latest_processed_emails, latest_processed_threads"
+)
+
+# Session -> user row, cached in-process for SESSION_CACHE_TTL seconds and memoized on
+# flask.g for the rest of the request, so one request reads the users row at most once.
+# Writes made through this module (and clear_token) drop the affected entries.
+SESSION_CACHE_TTL = int(os.getenv("SESSION_CACHE_TTL", "60"))
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "1024"))
+_session_cache = TTLCache(maxsize=SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL)
+_session_cache_lock = threading.Lock()
+
+
+def _request_memo():
+    if not has_request_context():
+        return None
+    if "users_by_session" not in g:
+        g.users_by_session = {}
+    return g.users_by_session
+
+
+def invalidate_user_cache(session_id=None, email=None):
+    """
+    Drop cached user rows for a session and/or an email address.
+    """
+    with _session_cache_lock:
+        for key, user in list(_session_cache.items()):
+            if key == session_id or (email and user.get("email") == email):
+                _session_cache.pop(key, None)
+    memo = _request_memo()
+    if memo:
+        for key, user in list(memo.items()):
+            if key == session_id or (email and user and user.get("email") == email):
+                memo.pop(key, None)
+
+
 def upsert_user(email, session_id, token):
     """
     Insert or update a user's information (email, session_id, and token).
@@ -12,17 +81,42 @@ def upsert_user(email, session_id, token):
         "token": token
     }
     response = supabase.table("users").upsert(data, on_conflict="email").execute()
+    invalidate_user_cache(session_id=session_id, email=email)
     print("Upsert response:", response)
     return response
 
 def get_user_by_session(session_id):
     """
-    Retrieve the user row by session_id.
+    Retrieve the user row (USER_COLUMNS) by session_id, from the request memo or the
+    process cache when possible.
     """
-    response = supabase.table("users").select("*").eq("session_id", session_id).execute()
-    if response.data and len(response.data) > 0:
-        return response.data[0]
-    return None
+    memo = _request_memo()
+    if memo is not None and session_id in memo:
+        return memo[session_id]
+    with _session_cache_lock:
+        cached = _session_cache.get(session_id)
+    if cached is not None:
+        user = copy.deepcopy(cached)
+        if memo is not None:
+            memo[session_id] = user
+        return user
+
+    response = supabase.table("users").select(USER_COLUMNS).eq("session_id", session_id).execute()
+    user = response.data[0] if response.data else None
+    if user is not None:
+        with _session_cache_lock:
+            _session_cache[session_id] = copy.deepcopy(user)
+    if memo is not None:
+        memo[session_id] = user
+    return user
+
+def get_user_by_email(email):
+    """
+    Read the user row (USER_COLUMNS) by email, bypassing the session cache. Used by code
+    that writes the row back and so needs its current values.
+    """
+    response = supabase.table("users").select(USER_COLUMNS).eq("email", email).execute()
+    return response.data[0] if response.data else None
 
 def update_user_analysis(session_id, analysis):
     """
@@ -32,4 +126,140 @@ def update_user_analysis(session_id, analysis):
         "analysis": analysis
     }
     response = supabase.table("users").update(data).eq("session_id", session_id).execute()
+    invalidate_user_cache(session_id=session_id)
     return response
+
+def clear_token(session_id=None, email=None):
+    """
+    Clear the stored OAuth token (forcing re-authentication) for the user identified by
+    session_id or email.
+    """
+    query = supabase.table("users").update({"token": {}})
+    query = query.eq("session_id", session_id) if session_id else query.eq("email", email)
+    response = query.execute()
+    invalidate_user_cache(session_id=session_id, email=email)
+    return response
+
+
+# ── email items ──────────────────────────────────────────────────────────────
+def uses_item_table():
+    return EMAIL_ITEMS_STORE == "table"
+
+
+def _check_category(category):
+    if category not in ITEM_CATEGORIES:
+        raise ValueError(f"Unknown item category: {category}")
+
+
+def _rpc(function, params):
+    # None tells the caller to fall back to read-and-rewrite (e.g. function not installed).
+    try:
+        return supabase.rpc(function, params).execute()
+    except Exception as e:
+        logger.warning("RPC %s failed (%s); rewriting the array instead", function, e)
+        return None
+
+
+def _legacy_column(email, category):
+    response = supabase.table("users").select(category).eq("email", email).execute()
+    if not response.data:
+        return []
+    return response.data[0].get(category) or []
+
+
+def _legacy_write(email, category, items):
+    return supabase.table("users").update({category: items}).eq("email", email).execute()
+
+
+def list_items(email, categories=None):
+    """
+    Return {category: [item, ...]} for the user, oldest item first.
+    """
+    categories = list(categories or ITEM_CATEGORIES)
+    for category in categories:
+        _check_category(category)
+    if not uses_item_table():
+        response = supabase.table("users").select(", ".join(categories)).eq("email", email).execute()
+        row = response.data[0] if response.data else {}
+        return {category: row.get(category) or [] for category in categories}
+    response = (
+        supabase.table("email_items")
+        .select("category, item")
+        .eq("user_email", email)
+        .in_("category", categories)
+        .order("id")
+        .execute()
+    )
+    items = {category: [] for category in categories}
+    for row in response.data or []:
+        items[row["category"]].append(row["item"])
+    return items
+
+
+def add_items(email, category, items):
+    """
+    Add items to a category. An item whose emailId is already in the category replaces it.
+    """
+    _check_category(category)
+    if not items:
+        return None
+    if not uses_item_table() and EMAIL_ITEMS_RPC:
+        response = _rpc("email_items_append", {"p_email": email, "p_column": category, "p_items": list(items)})
+        if response is not None:
+            return response
+    if not uses_item_table():
+        new_ids = {item.get("emailId") for item in items}
+        kept = [item for item in _legacy_column(email, category) if item.get("emailId") not in new_ids]
+        return _legacy_write(email, category, kept + list(items))
+    rows = [
+        {"user_email": email, "category": category, "email_id": item.get("emailId"), "item": item}
+        for item in items
+    ]
+    return supabase.table("email_items").upsert(rows, on_conflict="user_email,category,email_id").execute()
+
+
+def remove_items(email, category, email_ids):
+    """
+    Remove the items with the given emailIds from a category.
+    """
+    _check_category(category)
+    email_ids = list(email_ids)
+    if not email_ids:
+        return None
+    if not uses_item_table() and EMAIL_ITEMS_RPC:
+        response = _rpc("email_items_remove", {"p_email": email, "p_column": category, "p_email_ids": email_ids})
+        if response is not None:
+            return response
+    if not uses_item_table():
+        removed = set(email_ids)
+        kept = [item for item in _legacy_column(email, category) if item.get("emailId") not in removed]
+        return _legacy_write(email, category, kept)
+    return (
+        supabase.table("email_items")
+        .delete()
+        .eq("user_email", email)
+        .eq("category", category)
+        .in_("email_id", email_ids)
+        .execute()
+    )
+
+
+def clear_items(email, category):
+    """
+    Remove every item in a category.
+    """
+    _check_category(category)
+    if not uses_item_table():
+        return _legacy_write(email, category, [])
+    return supabase.table("email_items").delete().eq("user_email", email).eq("category", category).execute()
+
+
+def replace_items(email, category, items):
+    """
+    Make items the complete contents of a category.
+    """
+    _check_category(category)
+    if not uses_item_table():
+        return _legacy_write(email, category, list(items))
+    response = clear_items(email, category)
+    return add_items(email, category, items) if items else response
@@ -1,5 +1,4 @@
 import React, { useState, useLayoutEffect, useRef, useEffect } from 'react';
-import { supabase } from '../supabaseClient';
 import { useNavigate } from 'react-router-dom';
 import { PieChart, Pie, Cell, Tooltip, Legend } from 'recharts';
 
@@ -224,29 +223,22 @@ const BotSummary = () => {
   }, []);
 
   const fetchUserData = async () => {
-    const {
-      data: { user },
-    } = await supabase.auth.getUser();
-    if (user) {
-      const { data, error } = await supabase
-        .from('users')
-        .select(
-          'drafts, information, promotions, action_required, receipts, meeting_updates, others, sent_emails'
-        )
-        .eq('email', user.email)
-        .single();
-      if (error) {
-        console.error('Error fetching user data:', error);
-      } else {
-        setDrafts(data?.drafts || []);
-        setInfoItems(data?.information || []);
-        setPromotions(filterValidPromotions(data?.promotions || []));
-        setActionRequired(data?.action_required || []);
-        setReceipts(data?.receipts || []);
-        setMeetingUpdates(data?.meeting_updates || []);
-        setOthers(data?.others || []);
-        setSentEmails(data?.sent_emails || []);
-      }
+    try {
+      const response = await fetch(`${API_BASE_URL}/api/emails/items`, {
+        credentials: 'include',
+      });
+      if (!response.ok) throw new Error('Failed to fetch items');
+      const data = await response.json();
+      setDrafts(data?.drafts || []);
+      setInfoItems(data?.information || []);
+      setPromotions(filterValidPromotions(data?.promotions || []));
+      setActionRequired(data?.action_required || []);
+      setReceipts(data?.receipts || []);
+      setMeetingUpdates(data?.meeting_updates || []);
+      setOthers(data?.others || []);
+      setSentEmails(data?.sent_emails || []);
+    } catch (error) {
+      console.error('Error fetching user data:', error);
     }
   };
 
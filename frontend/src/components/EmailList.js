@@ -68,6 +68,7 @@ function EmailList({ emailCache, setEmailCache }) {
           maxResults: 20,
           pageToken: token,
           label: label,
+          view: 'summary',
         },
         withCredentials: true,
       })
@@ -1,6 +1,5 @@
 // src/components/WrittenDrafts.jsx
 import React, { useState, useEffect } from 'react';
-import { supabase } from '../supabaseClient';
 import axios from 'axios';
 import { useNavigate } from 'react-router-dom';
 
@@ -22,24 +21,20 @@ function WrittenDrafts() {
   }, []);
 
   const fetchUserData = async () => {
-    const { data: { user } } = await supabase.auth.getUser();
-    if (user) {
-      let { data, error } = await supabase
-        .from('users')
-        .select('drafts, information, promotions, action_required, receipts, meeting_updates, others')
-        .eq('email', user.email)
-        .single();
-      if (error) {
-        console.error('Error fetching user data:', error);
-      } else {
-        setDrafts(data?.drafts || []);
-        setInfoItems(data?.information || []);
-        setPromotions(data?.promotions || []);
-        setActionRequired(data?.action_required || []);
-        setReceipts(data?.receipts || []);
-        setMeetingUpdates(data?.meeting_updates || []);
-        setOthers(data?.others || []);
-      }
+    try {
+      const { data } = await axios.get(`${API_BASE_URL}/api/emails/items`, {
+        params: { category: 'drafts,information,promotions,action_required,receipts,meeting_updates,others' },
+        withCredentials: true,
+      });
+      setDrafts(data?.drafts || []);
+      setInfoItems(data?.information || []);
+      setPromotions(data?.promotions || []);
+      setActionRequired(data?.action_required || []);
+      setReceipts(data?.receipts || []);
+      setMeetingUpdates(data?.meeting_updates || []);
+      setOthers(data?.others || []);
+    } catch (error) {
+      console.error('Error fetching user data:', error);
     }
   };
 